@@ -0,0 +1,210 @@
+"""
+    Benchmarks the ingest functions offline, against the in-memory Firestore
+    and Cloud Storage stand-ins from testing_fakes.py, using synthetic data
+    for N facilities x D days.
+
+    Reports rows/s, peak memory (traced Python allocations) and the Firestore
+    and Storage traffic of each scenario, e.g.:
+
+        python bench_ingest.py --facilities 500 --days 120
+
+    With --latency-ms, each commit, get_all and ranged read waits that long,
+    to compare how the ingest paths overlap network round trips.
+"""
+import argparse
+from contextlib import contextmanager
+from datetime import date, timedelta
+import json
+import random
+import time
+import tracemalloc
+from unittest.mock import patch
+
+import pandas as pd
+
+import data_ingest
+from testing_fakes import FakeFirestoreClient, FakeStorageClient
+
+BUCKET_NAME = 'bench'
+
+
+def generate_metadata_rows(num_facilities, seed=0):
+    rng = random.Random(seed)
+    return [{
+        'facility_id': str(i),
+        'facility_name': f'Facility {i}',
+        'state': rng.choice(['Alabama', 'Alaska', 'Arizona', 'Arkansas']),
+        'facility_type': rng.choice(list(data_ingest.FACILITY_TYPE_MAPPING)),
+        'capacity': str(rng.randint(50, 5000)),
+        'county': f'County {i} County',
+        'population_year_updated': '2020',
+        'population': str(rng.randint(50, 5000)),
+    } for i in range(num_facilities)]
+
+
+def generate_case_rows(num_facilities, num_days, seed=0):
+    """
+    Cumulative daily counts for each facility, with rows ordered by facility
+    like the BigQuery export.
+    """
+    rng = random.Random(seed)
+    start = date(2020, 4, 1)
+    rows = []
+    for i in range(num_facilities):
+        cases = deaths = tested = 0
+        growth = rng.uniform(.5, 20)
+        for day in range(num_days):
+            tested += rng.randint(0, 50)
+            cases += rng.randint(0, int(growth))
+            deaths += rng.random() < .02
+            rows.append({
+                'facility_id': str(i),
+                'date': (start + timedelta(days=day)).isoformat(),
+                'pop_deaths': str(deaths),
+                'pop_tested': str(tested + cases),
+                'pop_tested_negative': str(tested),
+                'pop_tested_positive': str(cases),
+                'staff_tested_positive': str(cases // 10),
+            })
+    return rows
+
+
+def to_json_lines(rows):
+    return ''.join(json.dumps(row) + '\n' for row in rows)
+
+
+def to_csv(rows):
+    return pd.DataFrame(rows).to_csv(index=False)
+
+
+@contextmanager
+def fake_clients(fs_client=None, latency=0):
+    fs_client = fs_client or FakeFirestoreClient(latency=latency)
+    storage_client = FakeStorageClient(latency=latency)
+    with patch.object(data_ingest, 'get_firestore_client', return_value=fs_client), \
+            patch.object(data_ingest, 'get_storage_client', return_value=storage_client):
+        yield fs_client, storage_client
+
+
+def run_scenario(ingest, file_name, contents, num_rows, prepare=None, trace_memory=True,
+                 latency=0):
+    """
+    Runs `ingest(bucket_name, file_name)` on fresh fakes, after `prepare`
+    (also given the bucket and file name) if set. With `trace_memory`, it
+    runs a second time under tracemalloc to measure peak memory, so tracing
+    doesn't skew the timing.
+    """
+    def run(measure):
+        with fake_clients(latency=latency) as (fs_client, storage_client):
+            blob = storage_client.get_bucket(BUCKET_NAME).blob(file_name)
+            blob.upload_from_string(contents)
+            if prepare is not None:
+                prepare(BUCKET_NAME, file_name)
+            reads_before = fs_client.reads
+            commits_before = len(fs_client.commits)
+            docs_before = sum(fs_client.commits)
+            bytes_written_before = fs_client.bytes_written
+            blob.bytes_read = 0
+
+            with measure():
+                ingest(BUCKET_NAME, file_name)
+
+            return {
+                'readRoundTrips': fs_client.reads - reads_before,
+                'commits': len(fs_client.commits) - commits_before,
+                'docsWritten': sum(fs_client.commits) - docs_before,
+                'bytesWritten': fs_client.bytes_written - bytes_written_before,
+                'bytesDownloaded': blob.bytes_read,
+            }
+
+    timing = {}
+
+    @contextmanager
+    def timed():
+        start = time.perf_counter()
+        yield
+        timing['seconds'] = time.perf_counter() - start
+
+    @contextmanager
+    def traced():
+        tracemalloc.start()
+        yield
+        timing['peakMemoryMB'] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+
+    result = run(timed)
+    if trace_memory:
+        run(traced)
+
+    result.update(timing)
+    result['rows'] = num_rows
+    result['rowsPerSecond'] = num_rows / timing['seconds']
+    return result
+
+
+def run_benchmarks(num_facilities, num_days, trace_memory=True, latency=0):
+    metadata_rows = generate_metadata_rows(num_facilities)
+    case_rows = generate_case_rows(num_facilities, num_days)
+    metadata_json_lines = to_json_lines(metadata_rows)
+    case_json_lines = to_json_lines(case_rows)
+
+    ingest_metadata = data_ingest.ingest_facility_metadata_file
+    ingest_cases = data_ingest.ingest_daily_covid_case_data
+
+    def stream_cases(bucket_name, file_name):
+        ingest_cases(bucket_name, file_name, streaming=True)
+
+    def ingest_cases_async(bucket_name, file_name):
+        ingest_cases(bucket_name, file_name, asynchronous=True)
+
+    scenarios = {
+        'metadata': (ingest_metadata, 'facilities.jsonl', metadata_json_lines,
+                     len(metadata_rows), None),
+        'metadata (unchanged)': (ingest_metadata, 'facilities.jsonl', metadata_json_lines,
+                                 len(metadata_rows), ingest_metadata),
+        'cases': (ingest_cases, 'cases.jsonl', case_json_lines, len(case_rows), None),
+        'cases (streaming)': (stream_cases, 'cases.jsonl', case_json_lines,
+                              len(case_rows), None),
+        'cases (asyncio)': (ingest_cases_async, 'cases.jsonl', case_json_lines,
+                            len(case_rows), None),
+        'cases (columnar csv)': (ingest_cases, 'cases.csv', to_csv(case_rows),
+                                 len(case_rows), None),
+        'cases (unchanged)': (ingest_cases, 'cases.jsonl', case_json_lines,
+                              len(case_rows), ingest_cases),
+    }
+
+    return {
+        name: run_scenario(ingest, file_name, contents, num_rows, prepare, trace_memory, latency)
+        for name, (ingest, file_name, contents, num_rows, prepare) in scenarios.items()
+    }
+
+
+def print_results(results):
+    columns = ['rows', 'seconds', 'rowsPerSecond', 'peakMemoryMB', 'readRoundTrips',
+               'commits', 'docsWritten', 'bytesWritten', 'bytesDownloaded']
+    table = pd.DataFrame.from_dict(results, orient='index').reindex(columns=columns)
+    with pd.option_context('display.width', 250, 'display.max_columns', None,
+                           'display.float_format', '{:,.2f}'.format):
+        print(table)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark the ingest functions against in-memory Firestore and Storage")
+    parser.add_argument("--facilities", type=int, default=200)
+    parser.add_argument("--days", type=int, default=120)
+    parser.add_argument("--skip-memory", action="store_true",
+                        help="don't rerun each scenario to measure peak memory")
+    parser.add_argument("--latency-ms", type=float, default=0,
+                        help="simulated latency of each Firestore and Storage round trip")
+    parser.add_argument("--json", help="also write the results to this file")
+
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.facilities, args.days, trace_memory=not args.skip_memory,
+                             latency=args.latency_ms / 1000)
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,217 @@
+"""
+    Benchmarks the R(t) computation: compute_r_t end to end and each of its
+    stages (case smoothing, posteriors, highest density intervals and final
+    smoothing) over series of 7 to 1000 days, and compute_r_t_batch over
+    batches of facilities. Reports latency percentiles and peak memory
+    (traced Python and NumPy allocations).
+
+    Timings are compared to a baseline file, and the script exits with an
+    error if any median latency or peak memory regressed by more than its
+    threshold:
+
+        python bench_rt.py                    # compare to bench_rt_baseline.json
+        python bench_rt.py --threshold .5     # allow up to 50% slower
+        python bench_rt.py --memory-threshold .5  # allow up to 50% more memory
+        python bench_rt.py --update-baseline  # record new baseline timings
+
+    Baselines are only comparable on the same machine; record a new one
+    before comparing changes on a different machine.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import realtime_rt
+
+SERIES_LENGTHS = [7, 30, 100, 365, 1000]
+BATCH_SIZES = [1, 10, 100]
+# days in each series of a batch benchmark
+BATCH_SERIES_LENGTH = 120
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'bench_rt_baseline.json')
+DEFAULT_THRESHOLD = .25
+# regressions smaller than this are timer noise on the fastest stages
+DEFAULT_MIN_REGRESSION_MS = 1
+DEFAULT_MEMORY_THRESHOLD = .1
+# likewise for the allocations of small inputs
+DEFAULT_MIN_MEMORY_REGRESSION_MB = .5
+
+
+def generate_case_counts(num_days, seed=0):
+    """
+    Cumulative counts from a rise and fall in daily cases, with a random
+    peak size, as a {dates, cases} input.
+    """
+    rng = np.random.RandomState(seed)
+    peak = rng.uniform(5, 200)
+    rate = peak * np.exp(-.5 * ((np.arange(num_days) - num_days / 3) / (num_days / 6 + 1)) ** 2)
+    cases = np.cumsum(rng.poisson(rate + 1))
+    dates = np.datetime64('2020-03-01') + np.arange(num_days)
+
+    return {'dates': [str(date) for date in dates], 'cases': cases.tolist()}
+
+
+def get_stages(case_counts):
+    """
+    Returns the stages of compute_r_t for one input as (name, function)
+    pairs, each given the previous stage's output. The first stage is also
+    given the input.
+    """
+    def prepare_cases(historical_case_counts):
+        return realtime_rt.prepare_case_series(historical_case_counts)
+
+    def get_posteriors(smoothed):
+        # same fixed sigma as compute_r_t
+        posteriors, _ = realtime_rt.compute_posteriors(smoothed.values, sigma=.25)
+        return smoothed, posteriors
+
+    def highest_density_interval(smoothed_and_posteriors):
+        smoothed, posteriors = smoothed_and_posteriors
+        return smoothed, realtime_rt.posterior_statistics(posteriors[1:])
+
+    def smoothing(smoothed_and_statistics):
+        smoothed, statistics = smoothed_and_statistics
+        return realtime_rt.smooth_statistics(statistics, smoothed.index[1:])
+
+    return [
+        ('prepare_cases', prepare_cases),
+        ('get_posteriors', get_posteriors),
+        ('highest_density_interval', highest_density_interval),
+        ('smoothing', smoothing),
+    ]
+
+
+def measure(f, repeats):
+    """
+    Calls f() `repeats` times (after one warm-up call) and returns its
+    latency percentiles in milliseconds, plus peak memory in MB from one
+    more, traced call.
+    """
+    f()
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        f()
+        latencies.append(1000 * (time.perf_counter() - start))
+
+    tracemalloc.start()
+    f()
+    peak_memory = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {'p50': p50, 'p90': p90, 'p99': p99, 'peakMemoryMB': peak_memory}
+
+
+def run_benchmarks(series_lengths=SERIES_LENGTHS, batch_sizes=BATCH_SIZES, repeats=20):
+    results = {}
+
+    for num_days in series_lengths:
+        case_counts = generate_case_counts(num_days)
+        results[f'compute_r_t/{num_days}d'] = measure(
+            lambda: realtime_rt.compute_r_t(case_counts), repeats)
+
+        stage_input = case_counts
+        for name, stage in get_stages(case_counts):
+            results[f'{name}/{num_days}d'] = measure(
+                lambda: stage(stage_input), repeats)
+            stage_input = stage(stage_input)
+
+    for batch_size in batch_sizes:
+        case_counts_by_id = {str(i): generate_case_counts(BATCH_SERIES_LENGTH, seed=i)
+                             for i in range(batch_size)}
+        # big batches take long enough that fewer repeats are as stable
+        results[f'compute_r_t_batch/{batch_size}x{BATCH_SERIES_LENGTH}d'] = measure(
+            lambda: realtime_rt.compute_r_t_batch(case_counts_by_id),
+            max(3, repeats // batch_size))
+
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold, min_regression_ms=DEFAULT_MIN_REGRESSION_MS,
+                        memory_threshold=DEFAULT_MEMORY_THRESHOLD,
+                        min_memory_regression_mb=DEFAULT_MIN_MEMORY_REGRESSION_MB):
+    """
+    Returns a message for each benchmark whose median latency is more than
+    `threshold` (a fraction) and `min_regression_ms` slower than its
+    baseline, and for each whose peak memory is more than `memory_threshold`
+    and `min_memory_regression_mb` higher.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        allowed = max(baseline[name]['p50'] * (1 + threshold),
+                      baseline[name]['p50'] + min_regression_ms)
+        if result['p50'] > allowed:
+            regressions.append(
+                f"{name}: median {result['p50']:.2f}ms vs. baseline "
+                f"{baseline[name]['p50']:.2f}ms (limit {allowed:.2f}ms)")
+
+        allowed = max(baseline[name]['peakMemoryMB'] * (1 + memory_threshold),
+                      baseline[name]['peakMemoryMB'] + min_memory_regression_mb)
+        if result['peakMemoryMB'] > allowed:
+            regressions.append(
+                f"{name}: peak memory {result['peakMemoryMB']:.2f}MB vs. baseline "
+                f"{baseline[name]['peakMemoryMB']:.2f}MB (limit {allowed:.2f}MB)")
+    return regressions
+
+
+def print_results(results, baseline):
+    print(f"{'benchmark':45} {'p50 ms':>10} {'p90 ms':>10} {'p99 ms':>10} "
+          f"{'peak MB':>10} {'vs. base':>9}")
+    for name, result in results.items():
+        change = ''
+        if name in baseline:
+            change = f"{result['p50'] / baseline[name]['p50'] - 1:+.0%}"
+        print(f"{name:45} {result['p50']:10.2f} {result['p90']:10.2f} {result['p99']:10.2f} "
+              f"{result['peakMemoryMB']:10.2f} {change:>9}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark the R(t) computation and check for regressions")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed fractional increase in median latency")
+    parser.add_argument("--min-regression-ms", type=float, default=DEFAULT_MIN_REGRESSION_MS,
+                        help="allowed absolute increase in median latency")
+    parser.add_argument("--memory-threshold", type=float, default=DEFAULT_MEMORY_THRESHOLD,
+                        help="allowed fractional increase in peak memory")
+    parser.add_argument("--min-memory-regression-mb", type=float,
+                        default=DEFAULT_MIN_MEMORY_REGRESSION_MB,
+                        help="allowed absolute increase in peak memory")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--update-baseline", action="store_true")
+
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = run_benchmarks(repeats=args.repeats)
+    print_results(results, baseline)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({name: {key: round(value, 3) for key, value in result.items()}
+                       for name, result in results.items()}, f, indent=2, sort_keys=True)
+        print(f'Saved baseline to {args.baseline}')
+        sys.exit(0)
+
+    regressions = compare_to_baseline(results, baseline, args.threshold,
+                                      args.min_regression_ms, args.memory_threshold,
+                                      args.min_memory_regression_mb)
+    if regressions:
+        print(f'\nRegressed by more than {args.threshold:.0%} in latency '
+              f'or {args.memory_threshold:.0%} in memory:')
+        print('\n'.join(regressions))
+        sys.exit(1)
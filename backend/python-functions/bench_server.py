@@ -0,0 +1,132 @@
+"""
+    Load tests calculate_rt on the server in server.py: sends requests from
+    several concurrent clients and reports the throughput and latency
+    percentiles, e.g.:
+
+        python server.py --workers 4 &
+        python bench_server.py --url http://127.0.0.1:8080/calculate_rt
+
+    or, to start a server in this process and test it:
+
+        python bench_server.py --local-workers 4
+
+    Each request is one facility's {dates, cases} series, from bench_rt.py.
+    By default they are all different, so none are answered from rt_cache;
+    with --distinct N, only N different requests are sent over and over.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+from werkzeug.serving import make_server
+
+from bench_rt import generate_case_counts
+import server
+
+
+def generate_bodies(num_requests, distinct, num_days):
+    bodies = [json.dumps(generate_case_counts(num_days, seed=i)).encode()
+              for i in range(min(num_requests, distinct))]
+    return [bodies[i % len(bodies)] for i in range(num_requests)]
+
+
+def send(url, body):
+    """ POSTs a JSON body and returns the response status """
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def run_load_test(url, bodies, concurrency):
+    """
+    Sends each of `bodies` to `url`, from `concurrency` clients at once, and
+    returns the throughput and latency percentiles in milliseconds.
+    """
+    latencies = []
+    errors = 0
+
+    def client(body):
+        start = time.perf_counter()
+        status = send(url, body)
+        return status, 1000 * (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as clients:
+        for status, latency in clients.map(client, bodies):
+            latencies.append(latency)
+            errors += status != 200
+    seconds = time.perf_counter() - start
+
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {
+        'requests': len(bodies),
+        'errors': errors,
+        'seconds': seconds,
+        'requestsPerSecond': len(bodies) / seconds,
+        'p50': p50,
+        'p90': p90,
+        'p99': p99,
+        'max': max(latencies),
+    }
+
+
+@contextmanager
+def local_server(workers):
+    """
+    Serves server.py's app on a free local port, with `workers` R(t)
+    worker processes, and yields its calculate_rt URL.
+    """
+    rt_pool = server.start_pool(workers, server.warm_up_rt_worker)
+    httpd = make_server('127.0.0.1', 0, server.create_app(rt_pool), threaded=True)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{httpd.server_port}/calculate_rt'
+    finally:
+        httpd.shutdown()
+        rt_pool.shutdown()
+
+
+def print_results(results):
+    print(f"{results['requests']} requests ({results['errors']} errors) "
+          f"in {results['seconds']:.2f}s: {results['requestsPerSecond']:.1f} requests/s")
+    print(f"latency p50 {results['p50']:.1f}ms, p90 {results['p90']:.1f}ms, "
+          f"p99 {results['p99']:.1f}ms, max {results['max']:.1f}ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Load test calculate_rt on the local server")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/calculate_rt")
+    parser.add_argument("--local-workers", type=int,
+                        help="start a server with this many R(t) workers instead of using --url")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--distinct", type=int, default=None,
+                        help="number of different requests (all different by default)")
+    parser.add_argument("--days", type=int, default=120)
+    parser.add_argument("--json", help="also write the results to this file")
+
+    args = parser.parse_args()
+
+    bodies = generate_bodies(args.requests, args.distinct or args.requests, args.days)
+    if args.local_workers:
+        with local_server(args.local_workers) as url:
+            results = run_load_test(url, bodies, args.concurrency)
+    else:
+        results = run_load_test(args.url, bodies, args.concurrency)
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -1,12 +1,46 @@
+import asyncio
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import copy
 from datetime import datetime, timezone
+import functools
+import gzip
+import hashlib
+from google.api_core import exceptions as api_exceptions
 from google.cloud import firestore
 from google.cloud import storage
+import itertools
 import json
 import logging
+import os
+import pandas as pd
+import random
 import re
+import tempfile
+import threading
+import time
+import traceback
+
+from realtime_rt import compute_r_t_batch
+import timing
 
 REFERENCE_FACILITIES_COLLECTION_ID = 'reference_facilities'
+# one doc per facility holding content hashes of its saved covidCases days
+# (`hashes`) and rt days (`rtHashes`)
+CASE_DATA_MANIFESTS_COLLECTION_ID = 'covid_case_manifests'
+# subcollection of each reference facility with its covidCases days
+# compacted into one doc per month; see pack_case_series
+CASE_SERIES_COLLECTION_ID = 'covidCaseSeries'
+# bumped whenever the covidCaseSeries format changes, so that every
+# facility's series docs are rebuilt by its next ingest
+CASE_SERIES_VERSION = 1
+
+# Cloud Storage bucket for snapshots of all reference facility data; must
+# not be one that triggers an ingest function
+SNAPSHOT_BUCKET_NAME = os.environ.get('SNAPSHOT_BUCKET_NAME', 'c19-backend-reference-snapshots')
+# part of every snapshot's name; bumped whenever the snapshot format changes
+SNAPSHOT_VERSION = 1
 
 log = logging.getLogger("cloudLogger")
 
@@ -16,9 +50,57 @@ FACILITY_TYPE_MAPPING = {
     "State Prisons": "State Prison",
 }
 
-fs_client = firestore.Client()
-facilities_collection = fs_client.collection(
-    REFERENCE_FACILITIES_COLLECTION_ID)
+
+# clients are created on first use rather than at import, and then reused
+# for the lifetime of the instance
+@functools.lru_cache(maxsize=None)
+def get_firestore_client():
+    return firestore.Client()
+
+
+@functools.lru_cache(maxsize=None)
+def get_storage_client():
+    return storage.Client()
+
+
+def get_facilities_collection():
+    return get_firestore_client().collection(REFERENCE_FACILITIES_COLLECTION_ID)
+
+
+def get_manifests_collection():
+    return get_firestore_client().collection(CASE_DATA_MANIFESTS_COLLECTION_ID)
+
+
+# case data file columns => covidCases fields
+CASE_COUNT_COLUMNS = {
+    'pop_deaths': 'popDeaths',
+    'pop_tested': 'popTested',
+    'pop_tested_negative': 'popTestedNegative',
+    'pop_tested_positive': 'popTestedPositive',
+    'staff_deaths': 'staffDeaths',
+    'staff_tested': 'staffTested',
+    'staff_tested_negative': 'staffTestedNegative',
+    'staff_tested_positive': 'staffTestedPositive',
+}
+
+# file types that are always read with the columnar ingest path
+TABULAR_FILE_EXTENSIONS = ('.csv', '.parquet')
+
+# number of documents fetched per get_all call
+GET_ALL_CHUNK_SIZE = 500
+
+# concurrent batch commits when saving case data
+COMMIT_WORKERS = 8
+
+# streaming ingestion: size of each ranged read from Cloud Storage, and
+# number of facilities parsed before their writes are queued
+STREAM_CHUNK_BYTES = 1 << 20
+STREAM_CHUNK_FACILITIES = 100
+# lines parsed at a time by the synchronous streaming path
+STREAM_PARSE_LINES = 1000
+# asyncio ingest pipeline: the most downloaded chunks, and the most parsed
+# chunks of facilities, waiting for the next stage
+ASYNC_QUEUE_SIZE = 4
 
 
 class FirestoreBatch():
@@ -29,16 +111,48 @@ class FirestoreBatch():
         Takes a Firestore Client instance, exposes methods and properties
         that would result in batch "operations". Automatically flushes the
         batch when it's full to prevent overflows.
+
+        With `max_workers`, full batches are committed in the background on
+        a thread pool while the next one is filled, with at most
+        `max_in_flight` (default: 2 * max_workers) batches queued or
+        committing at once. commit() then waits for all of them and raises
+        the error of the earliest failed batch, if any. Finished commits
+        aren't kept, so memory use doesn't grow with the number of batches.
+
+        Commits that fail with a transient error are retried with
+        exponential backoff.
     """
     # this limit is imposed by firestore
     MAX_BATCH_SIZE = 500
 
-    def __init__(self, client):
+    # errors worth retrying a commit for; setting the same documents again
+    # is harmless if a failed commit did go through
+    TRANSIENT_ERRORS = (
+        api_exceptions.Aborted,
+        api_exceptions.DeadlineExceeded,
+        api_exceptions.InternalServerError,
+        api_exceptions.ServiceUnavailable,
+        api_exceptions.TooManyRequests,
+    )
+    MAX_COMMIT_ATTEMPTS = 5
+    INITIAL_BACKOFF_SECONDS = .5
+    MAX_BACKOFF_SECONDS = 16
+
+    def __init__(self, client, max_workers=None, max_in_flight=None):
         # a single "write" can trigger additional operations (in effect,
         # incrementing the batch size by >1); track them here to anticipate
         # and prevent overflows
         self.pending_ops_count = 0
         self.client = client
+        self.max_workers = max_workers
+        self.max_in_flight = max_in_flight or 2 * (max_workers or 1)
+        self._executor = None
+        self._in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        # number of batches submitted since the last commit(), and the
+        # (index, error) of the earliest of them that failed
+        self._num_submitted = 0
+        self._first_error = None
+        self._errors_lock = threading.Lock()
         self._start_batch()
 
     def _track_write(self):
@@ -52,9 +166,49 @@ class FirestoreBatch():
 
     def _prevent_overflow(self):
         if self.batch_size + self.pending_ops_count >= self.MAX_BATCH_SIZE:
-            self.commit()
+            self._flush()
             self._start_batch()
 
+    def _commit_with_retry(self, batch):
+        backoff = self.INITIAL_BACKOFF_SECONDS
+        for attempt in range(1, self.MAX_COMMIT_ATTEMPTS + 1):
+            try:
+                return batch.commit()
+            except self.TRANSIENT_ERRORS as e:
+                if attempt == self.MAX_COMMIT_ATTEMPTS:
+                    raise
+                log.warning(f'Retrying batch commit after attempt {attempt} failed: {e}')
+                # jittered so that concurrent commits don't retry in lockstep
+                time.sleep(backoff * random.uniform(.5, 1))
+                backoff = min(2 * backoff, self.MAX_BACKOFF_SECONDS)
+
+    def _flush(self):
+        if self.max_workers is None:
+            with timing.phase('commit'):
+                result = self._commit_with_retry(self.batch)
+            timing.add('batchesCommitted')
+            return result
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        # blocks while max_in_flight batches are waiting on Firestore
+        self._in_flight.acquire()
+        future = self._executor.submit(self._commit_with_retry, self.batch)
+        future.add_done_callback(functools.partial(self._commit_done, self._num_submitted))
+        self._num_submitted += 1
+
+    def _commit_done(self, index, future):
+        self._in_flight.release()
+        error = future.exception()
+        if error is None:
+            return
+
+        log.error(f'Batch {index + 1} failed to commit: {error}')
+        with self._errors_lock:
+            if self._first_error is None or index < self._first_error[0]:
+                self._first_error = (index, error)
+
     # NOTE: can also mirror other server transform operations as needed
     @property
     def SERVER_TIMESTAMP(self):
@@ -62,7 +216,25 @@ class FirestoreBatch():
         return firestore.SERVER_TIMESTAMP
 
     def commit(self):
-        return self.batch.commit()
+        if self.max_workers is None:
+            return self._flush()
+
+        if self.batch_size:
+            self._flush()
+            self._start_batch()
+
+        if self._executor is not None:
+            # commits run in the background; this is only the time spent waiting on them
+            with timing.phase('commit'):
+                self._executor.shutdown(wait=True)
+            self._executor = None
+
+        num_submitted, self._num_submitted = self._num_submitted, 0
+        first_error, self._first_error = self._first_error, None
+        if first_error is not None:
+            raise first_error[1]
+
+        timing.add('batchesCommitted', num_submitted)
 
     # NOTE: can also mirror create, delete, update methods on batch as needed
     def set(self, *args, **kwargs):
@@ -71,46 +243,90 @@ class FirestoreBatch():
         self._track_write()
 
 
-def create_or_update_facilities(file_location):
-    batch = FirestoreBatch(fs_client)
+def chunked(iterable, chunk_size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
 
+def read_json_lines(file_location):
     with open(file_location, newline='') as f:
         for line in f:
-            row = json.loads(line)
+            timing.add('rowsParsed')
+            yield json.loads(line)
+
 
-            id = row['facility_id']
+@timing.timed('read_existing')
+def get_snapshots_by_id(doc_refs):
+    """
+    Fetches the snapshots of many documents in a single round trip,
+    keyed by document id. Missing documents have `exists` set to False.
+    """
+    return {snapshot.id: snapshot for snapshot in get_firestore_client().get_all(doc_refs)}
+
+
+def build_facility_update(row):
+    """
+    Returns the facility id, metadata fields and latest population record
+    (or None) from one row of a facility metadata file.
+    """
+    facility_metadata = {
+        "canonicalName": row['facility_name'],
+        "stateName": row['state'],
+        "facilityType": FACILITY_TYPE_MAPPING.get(row['facility_type'],
+                                                  row['facility_type']),
+    }
+
+    if row.get('capacity'):
+        facility_metadata["capacity"] = int(row["capacity"])
+
+    if row.get('county') and row['county'] != 'Not found':
+        facility_metadata["county"] = re.sub(
+            r' County$',  '', row['county'])
 
-            facility_doc_ref = facilities_collection.document(id)
+    latest_population = None
+    if row.get('population_year_updated') and row.get('population'):
+        latest_population = {
+            "date": datetime(int(row["population_year_updated"]), 1, 1, tzinfo=timezone.utc),
+            "value": int(row["population"]),
+        }
+
+    return row['facility_id'], facility_metadata, latest_population
+
+
+def save_facility_updates(facility_updates):
+    """
+    Merges (facility id, metadata fields, latest population) updates, as
+    returned by build_facility_update, into the reference facility docs.
+    """
+    batch = FirestoreBatch(get_firestore_client())
+
+    # existing facility docs are fetched a chunk at a time rather than
+    # with one blocking read per facility
+    for updates in chunked(facility_updates, GET_ALL_CHUNK_SIZE):
+        snapshots = get_snapshots_by_id(
+            {get_facilities_collection().document(id) for id, _, _ in updates})
+
+        for id, metadata_fields, latest_population in updates:
+            facility_doc_ref = get_facilities_collection().document(id)
             facility_metadata = {}
 
             # are we updating or creating?
-            fdoc_snapshot = facility_doc_ref.get()
-            if fdoc_snapshot.exists:
-                facility_metadata.update(fdoc_snapshot.to_dict())
+            fdoc_snapshot = snapshots[id]
+            existing_metadata = fdoc_snapshot.to_dict() if fdoc_snapshot.exists else None
+            if existing_metadata is not None:
+                facility_metadata.update(copy.deepcopy(existing_metadata))
             else:
                 facility_metadata.update({
                     "createdAt": batch.SERVER_TIMESTAMP,
                 })
 
-            facility_metadata.update({
-                "canonicalName": row['facility_name'],
-                "stateName": row['state'],
-                "facilityType": FACILITY_TYPE_MAPPING.get(row['facility_type'],
-                                                          row['facility_type']),
-            })
-
-            if row.get('capacity'):
-                facility_metadata["capacity"] = int(row["capacity"])
-
-            if row.get('county') and row['county'] != 'Not found':
-                facility_metadata["county"] = re.sub(
-                    r' County$',  '', row['county'])
-
-            if row.get('population_year_updated') and row.get('population'):
-                latest_population = {
-                    "date": datetime(int(row["population_year_updated"]), 1, 1, tzinfo=timezone.utc),
-                    "value": int(row["population"]),
-                }
+            facility_metadata.update(metadata_fields)
+
+            if latest_population is not None:
                 # we have to be a bit careful not to obliterate existing data in the population array;
                 # generally this means looking for the item that corresponds to our input
                 # and leaving any other items untouched
@@ -130,31 +346,34 @@ def create_or_update_facilities(file_location):
                 else:
                     facility_metadata['population'] = [latest_population]
 
+            # rewriting an unchanged doc would only cost a write
+            if facility_metadata == existing_metadata:
+                continue
+
             batch.set(facility_doc_ref, facility_metadata)
 
     # one final commit for the last partially full batch
     batch.commit()
 
 
+def create_or_update_facilities(file_location):
+    save_facility_updates(
+        build_facility_update(row) for row in read_json_lines(file_location))
+
+
 def build_covid_case_counts(row):
     # none of these fields is guaranteed to exist; default values will be dropped
     covid_case_counts = {
-        'popDeaths': row.get('pop_deaths'),
-        'popTested': row.get('pop_tested'),
-        'popTestedNegative': row.get('pop_tested_negative'),
-        'popTestedPositive': row.get('pop_tested_positive'),
-        'staffDeaths': row.get('staff_deaths'),
-        'staffTested': row.get('staff_tested'),
-        'staffTestedNegative': row.get('staff_tested_negative'),
-        'staffTestedPositive': row.get('staff_tested_positive'),
+        field: row.get(column) for column, field in CASE_COUNT_COLUMNS.items()
     }
 
     # Remove missing values and convert remaining values to integers
     return {k: int(v) for k, v in covid_case_counts.items() if v is not None}
 
 
+@timing.timed('download')
 def download_from_cloud_storage(bucket_name, file_name):
-    storage_client = storage.Client()
+    storage_client = get_storage_client()
     blob = storage_client.get_bucket(bucket_name).get_blob(file_name)
 
     download_location = f'/tmp/{file_name}'
@@ -164,6 +383,30 @@ def download_from_cloud_storage(bucket_name, file_name):
     return download_location
 
 
+def stream_from_cloud_storage(bucket_name, file_name, chunk_bytes=None):
+    """
+    Yields the lines of a Cloud Storage file, fetched with ranged reads of
+    `chunk_bytes` (default: STREAM_CHUNK_BYTES) so that only one chunk is
+    held in memory at a time.
+    """
+    chunk_bytes = chunk_bytes or STREAM_CHUNK_BYTES
+    storage_client = get_storage_client()
+    blob = storage_client.get_bucket(bucket_name).get_blob(file_name)
+
+    remainder = b''
+    for start in range(0, blob.size, chunk_bytes):
+        # the end of the range is inclusive
+        end = min(start + chunk_bytes, blob.size) - 1
+        with timing.phase('download'):
+            data = blob.download_as_string(start=start, end=end)
+        *lines, remainder = (remainder + data).split(b'\n')
+        yield from lines
+
+    if remainder:
+        yield remainder
+
+
+@timing.timed('parse')
 def reshape_facilities_data(file_location):
     """
     This function reshapes the daily Covid case data provided in JSON Lines format into a
@@ -203,39 +446,861 @@ def reshape_facilities_data(file_location):
     """
     cases_by_facility = defaultdict(dict)
 
+    num_rows = 0
     with open(file_location, newline="") as f:
         for line in f:
             row = json.loads(line)
             key = row['facility_id']
             date = row['date']
             cases_by_facility[key][date] = build_covid_case_counts(row)
+            num_rows += 1
 
+    timing.add('rowsParsed', num_rows)
     return cases_by_facility
 
 
-def save_case_data(facilities):
-    for facility_id, covid_cases in facilities.items():
-        batch = FirestoreBatch(fs_client)
+class CaseDataChunker():
+    """
+    Streaming counterpart of reshape_facilities_data: parses JSON Lines case
+    data fed to it a few lines at a time, and collects complete facilities
+    into dicts of up to `chunk_size` facilities, shaped like the output of
+    reshape_facilities_data.
+
+    The input is expected to be ordered by facility. Ids of facilities whose
+    rows turn out not to be consecutive are added to `split_facility_ids`.
+    """
+
+    def __init__(self, chunk_size, split_facility_ids):
+        self.chunk_size = chunk_size
+        self.split_facility_ids = split_facility_ids
+        self._seen_facility_ids = set()
+        self._facility_id = None
+        self._chunk = {}
+
+    def feed(self, lines):
+        """ Parses some lines and returns any chunks that are now complete """
+        chunks = []
+        num_rows = 0
+        with timing.phase('parse'):
+            for line in lines:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                num_rows += 1
+
+                facility_id = row['facility_id']
+                if facility_id != self._facility_id:
+                    # the previous facility's rows are complete
+                    if len(self._chunk) == self.chunk_size:
+                        chunks.append(self._chunk)
+                        self._chunk = {}
+                    if facility_id in self._seen_facility_ids:
+                        self.split_facility_ids.add(facility_id)
+                    self._seen_facility_ids.add(facility_id)
+                    self._facility_id = facility_id
 
-        facility_ref = facilities_collection.document(facility_id)
-        if not facility_ref.get().exists:
-            facility_metadata = {'createdAt': batch.SERVER_TIMESTAMP}
-            batch.set(facility_ref, facility_metadata)
+                # a facility can show up more than once if its rows aren't consecutive
+                self._chunk.setdefault(facility_id, {})[row['date']] = build_covid_case_counts(row)
 
+        timing.add('rowsParsed', num_rows)
+        return chunks
+
+    def close(self):
+        """ Returns the last, partial chunk, if any """
+        chunk, self._chunk = self._chunk, {}
+        return [chunk] if chunk else []
+
+
+def read_case_data(facility_id):
+    """
+    Reads all of a facility's saved case data back from Firestore, shaped
+    like one facility's entry in the output of reshape_facilities_data.
+    """
+    cases_collection = get_facilities_collection().document(facility_id).collection('covidCases')
+    return {snapshot.id: snapshot.to_dict() for snapshot in cases_collection.stream()}
+
+
+def hash_case_counts(cases):
+    # also used for rt days; truncated, since these only need to tell
+    # versions of one day apart
+    return hashlib.sha1(json.dumps(cases, sort_keys=True).encode()).hexdigest()[:16]
+
+
+@timing.timed('save_manifests')
+def save_case_manifests(manifest_updates):
+    """
+    Merges {facility id: {date: hash}} into the facilities' manifests, and
+    marks their covidCaseSeries docs as up to date.
+    """
+    batch = FirestoreBatch(get_firestore_client(), max_workers=COMMIT_WORKERS)
+
+    for facility_id, hashes in manifest_updates.items():
+        # merging updates only the given dates in the hashes map, but an
+        # empty map would replace it
+        manifest = {'seriesVersion': CASE_SERIES_VERSION}
+        if hashes:
+            manifest['hashes'] = hashes
+        batch.set(get_manifests_collection().document(facility_id), manifest, merge=True)
+
+    batch.commit()
+
+
+def pack_case_series(covid_cases):
+    """
+    Packs {date: case counts} into a covidCaseSeries doc: a sorted `dates`
+    array plus one array per field, lined up with the dates, e.g.:
+
+    {
+      "dates": ["2020-04-30", "2020-05-04"],
+      "popDeaths": [0, 1],
+      "popTestedPositive": [7, null],
+    }
+
+    Missing values are null. A month of days is a few KB at most, far below
+    Firestore's 1 MiB document limit.
+    """
+    dates = sorted(covid_cases)
+    fields = sorted({field for cases in covid_cases.values() for field in cases})
+
+    series = {'dates': dates}
+    for field in fields:
+        series[field] = [covid_cases[date].get(field) for date in dates]
+    return series
+
+
+def unpack_case_series(series):
+    """ Inverse of pack_case_series """
+    dates = series.get('dates', [])
+    covid_cases = {date: {} for date in dates}
+    for field, values in series.items():
+        if field == 'dates':
+            continue
+        for date, value in zip(dates, values):
+            if value is not None:
+                covid_cases[date][field] = value
+    return covid_cases
+
+
+@timing.timed('save_case_series')
+def save_case_series(series_updates):
+    """
+    Merges {facility id: {date: case counts}} into the facilities'
+    covidCaseSeries docs, which are keyed by month (e.g. `2020-04`). Only
+    the months with updated days are read and rewritten.
+    """
+    # (facility id, month) => {date: case counts}
+    month_updates = defaultdict(dict)
+    for facility_id, covid_cases in series_updates.items():
         for date, cases in covid_cases.items():
-            covidCasesOnDateRef = facility_ref.collection(
-                'covidCases').document(date)
-            batch.set(covidCasesOnDateRef, cases)
+            month_updates[(facility_id, date[:7])][date] = cases
+
+    batch = FirestoreBatch(get_firestore_client(), max_workers=COMMIT_WORKERS)
+    for chunk in chunked(month_updates, GET_ALL_CHUNK_SIZE):
+        month_refs = [
+            get_facilities_collection().document(facility_id)
+            .collection(CASE_SERIES_COLLECTION_ID).document(month)
+            for facility_id, month in chunk
+        ]
+        with timing.phase('read_existing'):
+            snapshots = {snapshot.reference.path: snapshot
+                         for snapshot in get_firestore_client().get_all(month_refs)}
+
+        for key, ref in zip(chunk, month_refs):
+            snapshot = snapshots[ref.path]
+            covid_cases = unpack_case_series(snapshot.to_dict()) if snapshot.exists else {}
+            covid_cases.update(month_updates[key])
+            batch.set(ref, pack_case_series(covid_cases))
+
+    batch.commit()
+
+
+@timing.timed('parse')
+def read_table(file_location):
+    """
+    Loads a JSON Lines, CSV or Parquet file (by extension; JSON Lines by
+    default) into a DataFrame. Text formats are read without type inference,
+    so values come through as they appear in the file.
+    """
+    if file_location.endswith('.csv'):
+        table = pd.read_csv(file_location, dtype=str)
+    elif file_location.endswith('.parquet'):
+        # requires pyarrow
+        table = pd.read_parquet(file_location)
+    else:
+        table = pd.read_json(file_location, lines=True, dtype=False, convert_dates=False)
+
+    timing.add('rowsParsed', len(table))
+    return table
+
+
+def is_present(column):
+    # vectorized equivalent of the `if row.get(column)` checks on file rows
+    return column.notna() & ~column.isin(['', 0])
+
+
+def as_text(column):
+    # ids and dates as strings, whatever type the file stored them as
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return column.dt.strftime('%Y-%m-%d')
+    return column.astype(str)
+
+
+def get_column(table, column):
+    # optional columns may be left out of a file entirely
+    return table[column] if column in table else pd.Series(None, index=table.index, dtype=object)
+
+
+@timing.timed('parse')
+def reshape_case_data_table(table):
+    """
+    Columnar counterpart of reshape_facilities_data: reshapes a case data
+    DataFrame into the same {facility id: {date: case counts}} structure.
+    Renaming, dropping missing values and casting to integers are done on
+    whole columns; only building the final dicts is per value.
+    """
+    table = table.assign(facility_id=as_text(table['facility_id']),
+                         date=as_text(table['date']))
+    # like reshape_facilities_data, the last row for a facility and date wins
+    table = table.drop_duplicates(['facility_id', 'date'], keep='last')
+
+    counts = (table.reindex(columns=list(CASE_COUNT_COLUMNS))
+              .rename(columns=CASE_COUNT_COLUMNS)
+              .apply(pd.to_numeric))
+    counts.index = pd.MultiIndex.from_arrays([table['facility_id'], table['date']])
+    counts = counts.stack().dropna().astype('int64')
+
+    cases_by_facility = defaultdict(dict)
+    # every row gets a doc, even if none of its counts are present
+    for facility_id, date in zip(table['facility_id'].tolist(), table['date'].tolist()):
+        cases_by_facility[facility_id][date] = {}
+    for (facility_id, date, field), value in zip(counts.index.tolist(), counts.tolist()):
+        cases_by_facility[facility_id][date][field] = value
+
+    return cases_by_facility
+
+
+@timing.timed('parse')
+def build_facility_updates_from_table(table):
+    """
+    Columnar counterpart of build_facility_update: returns the same
+    (facility id, metadata fields, latest population) updates for every row
+    of a facility metadata DataFrame.
+    """
+    facility_type = table['facility_type'].replace(FACILITY_TYPE_MAPPING)
+
+    capacity = get_column(table, 'capacity')
+    capacity = pd.to_numeric(capacity.where(is_present(capacity)))
+
+    county = get_column(table, 'county')
+    county = (county.where(is_present(county) & (county != 'Not found'))
+              .str.replace(r' County$', '', regex=True))
+
+    population_year = get_column(table, 'population_year_updated')
+    population = get_column(table, 'population')
+    has_population = is_present(population_year) & is_present(population)
+    population_year = pd.to_numeric(population_year.where(has_population))
+    population = pd.to_numeric(population.where(has_population))
+
+    updates = []
+    for row in zip(as_text(table['facility_id']).tolist(),
+                   table['facility_name'].tolist(),
+                   table['state'].tolist(),
+                   facility_type.tolist(),
+                   capacity.tolist(),
+                   county.tolist(),
+                   population_year.tolist(),
+                   population.tolist()):
+        (facility_id, name, state, facility_type, capacity, county,
+         population_year, population) = row
+
+        facility_metadata = {
+            "canonicalName": name,
+            "stateName": state,
+            "facilityType": facility_type,
+        }
+        if pd.notna(capacity):
+            facility_metadata["capacity"] = int(capacity)
+        if pd.notna(county):
+            facility_metadata["county"] = county
+
+        latest_population = None
+        if pd.notna(population_year):
+            latest_population = {
+                "date": datetime(int(population_year), 1, 1, tzinfo=timezone.utc),
+                "value": int(population),
+            }
+
+        updates.append((facility_id, facility_metadata, latest_population))
+
+    return updates
+
+
+def is_tabular_file(file_name):
+    return file_name.endswith(TABULAR_FILE_EXTENSIONS)
 
+
+@timing.timed('save_case_data')
+def save_case_data(facilities, batch=None, manifest_updates=None, series_updates=None):
+    """
+    Saves each facility's covidCases days, skipping the ones whose content
+    hash matches the facility's manifest (the daily files repeat the whole
+    history, so nearly all days are unchanged). Returns the number of days
+    written and skipped.
+
+    Written days are also merged into the facility's covidCaseSeries docs.
+    All of a facility's days are, if its manifest doesn't have the current
+    CASE_SERIES_VERSION, so that its series docs are (re)built in full.
+
+    Writes for all facilities are packed into full batches and committed
+    concurrently. A caller that passes in its own batch commits it, then
+    passes `series_updates` (filled in with the days to merge) to
+    save_case_series and `manifest_updates` (filled in with the hashes of
+    written days) to save_case_manifests, so a failed commit can't mark
+    days as saved.
+    """
+    should_commit = batch is None
+    if batch is None:
+        batch = FirestoreBatch(get_firestore_client(), max_workers=COMMIT_WORKERS)
+        manifest_updates = {}
+        series_updates = {}
+
+    written = 0
+    skipped = 0
+
+    facility_ids = list(facilities)
+    for start in range(0, len(facility_ids), GET_ALL_CHUNK_SIZE):
+        chunk = facility_ids[start:start + GET_ALL_CHUNK_SIZE]
+        snapshots = get_snapshots_by_id(
+            [get_facilities_collection().document(facility_id) for facility_id in chunk])
+        manifests = get_snapshots_by_id(
+            [get_manifests_collection().document(facility_id) for facility_id in chunk])
+
+        for facility_id in chunk:
+            facility_ref = get_facilities_collection().document(facility_id)
+            if not snapshots[facility_id].exists:
+                facility_metadata = {'createdAt': batch.SERVER_TIMESTAMP}
+                batch.set(facility_ref, facility_metadata)
+
+            saved_hashes = {}
+            series_version = None
+            if manifests[facility_id].exists:
+                manifest = manifests[facility_id].to_dict()
+                saved_hashes = manifest.get('hashes', {})
+                series_version = manifest.get('seriesVersion')
+
+            if series_version != CASE_SERIES_VERSION:
+                series_updates.setdefault(facility_id, {}).update(facilities[facility_id])
+                manifest_updates.setdefault(facility_id, {})
+
+            for date, cases in facilities[facility_id].items():
+                cases_hash = hash_case_counts(cases)
+                if saved_hashes.get(date) == cases_hash:
+                    skipped += 1
+                    continue
+
+                covidCasesOnDateRef = facility_ref.collection(
+                    'covidCases').document(date)
+                batch.set(covidCasesOnDateRef, cases)
+                manifest_updates.setdefault(facility_id, {})[date] = cases_hash
+                series_updates.setdefault(facility_id, {})[date] = cases
+                written += 1
+
+    if should_commit:
+        batch.commit()
+        save_case_series(series_updates)
+        save_case_manifests(manifest_updates)
+
+    timing.add('daysWritten', written)
+    timing.add('daysSkipped', skipped)
+    return written, skipped
+
+
+def build_rt_case_counts(covid_cases):
+    """
+    Derives the cumulative {dates, cases} series that calculate_rt expects
+    from a facility's reshaped case data. Total cases for a day are
+    incarcerated plus staff positive tests, matching what the dashboard
+    sends for reference data; days with neither count are left out.
+    """
+    dates = []
+    cases = []
+    for date in sorted(covid_cases):
+        day = covid_cases[date]
+        if 'popTestedPositive' not in day and 'staffTestedPositive' not in day:
+            continue
+        dates.append(date)
+        cases.append(day.get('popTestedPositive', 0) + day.get('staffTestedPositive', 0))
+
+    return {'dates': dates, 'cases': cases}
+
+
+@timing.timed('compute_rt')
+def compute_rt_data(facilities):
+    """
+    Runs the R(t) computation for every facility in the reshaped case data.
+    Returns the results nested by facility id and date, e.g.:
+
+    {
+      510: {
+        "2020-05-04": {"Rt": 1.12, "low90": 0.61, "high90": 1.58},
+        ...
+      },
+      ...
+    }
+
+    Facilities whose data can't produce an R(t) (too few days, non-cumulative
+    counts, etc.) are logged and left out.
+    """
+    case_counts_by_facility = {
+        facility_id: build_rt_case_counts(covid_cases)
+        for facility_id, covid_cases in facilities.items()
+    }
+
+    rt_by_facility = {}
+    for facility_id, result in compute_r_t_batch(case_counts_by_facility).items():
+        if isinstance(result, Exception):
+            log.info(f'Skipping R(t) for facility {facility_id}: {result}')
+            continue
+
+        rt_by_facility[facility_id] = {
+            day.strftime('%Y-%m-%d'): {
+                'Rt': float(row['ML']),
+                'low90': float(row['Low_90']),
+                'high90': float(row['High_90']),
+            }
+            for day, row in result.iterrows()
+        }
+
+    return rt_by_facility
+
+
+@timing.timed('save_manifests')
+def save_rt_manifests(manifest_updates):
+    """ Merges {facility id: {date: hash}} into the rtHashes of the facilities' manifests """
+    batch = FirestoreBatch(get_firestore_client(), max_workers=COMMIT_WORKERS)
+
+    for facility_id, hashes in manifest_updates.items():
+        if hashes:
+            batch.set(get_manifests_collection().document(facility_id),
+                      {'rtHashes': hashes}, merge=True)
+
+    batch.commit()
+
+
+@timing.timed('save_rt_data')
+def save_rt_data(rt_by_facility, batch=None, manifest_updates=None):
+    """
+    Saves each facility's rt days, skipping the ones whose content hash
+    matches the rtHashes in the facility's manifest. The values are rounded,
+    and each day only depends on the days around it, so only the last few
+    days of a facility usually change from one ingest to the next. Returns
+    the number of days written and skipped.
+
+    Like save_case_data, a caller that passes in its own batch commits it,
+    then passes `manifest_updates` to save_rt_manifests.
+    """
+    should_commit = batch is None
+    if batch is None:
+        batch = FirestoreBatch(get_firestore_client(), max_workers=COMMIT_WORKERS)
+        manifest_updates = {}
+
+    written = 0
+    skipped = 0
+
+    facility_ids = list(rt_by_facility)
+    for start in range(0, len(facility_ids), GET_ALL_CHUNK_SIZE):
+        chunk = facility_ids[start:start + GET_ALL_CHUNK_SIZE]
+        manifests = get_snapshots_by_id(
+            [get_manifests_collection().document(facility_id) for facility_id in chunk])
+
+        for facility_id in chunk:
+            saved_hashes = {}
+            if manifests[facility_id].exists:
+                saved_hashes = manifests[facility_id].to_dict().get('rtHashes', {})
+
+            facility_ref = get_facilities_collection().document(facility_id)
+            for date, values in rt_by_facility[facility_id].items():
+                values_hash = hash_case_counts(values)
+                if saved_hashes.get(date) == values_hash:
+                    skipped += 1
+                    continue
+
+                rtOnDateRef = facility_ref.collection('rt').document(date)
+                batch.set(rtOnDateRef, values)
+                manifest_updates.setdefault(facility_id, {})[date] = values_hash
+                written += 1
+
+    if should_commit:
         batch.commit()
+        save_rt_manifests(manifest_updates)
+
+    timing.add('rtDaysWritten', written)
+    timing.add('rtDaysSkipped', skipped)
+    return written, skipped
+
+
+class CaseDataWriter():
+    """
+    Saves case data and R(t) a few facilities at a time, for the streaming
+    ingest paths. The writes of each chunk are committed concurrently, then
+    its series docs and manifests are saved, so that nothing is held from
+    one chunk to the next and memory use doesn't grow with the size of the
+    input.
+
+    Case data and R(t) go to separate batches, so that save_cases and
+    save_rt can be called from different threads at once.
+
+    A facility's R(t) needs its whole case history; for any facility in
+    `split_facility_ids` (see CaseDataChunker), it is recomputed from the
+    case data in Firestore once everything else has been saved, and is not
+    written before then. Only a facility whose rows turn up again after its
+    R(t) was written gets it written twice.
+    """
+
+    def __init__(self, split_facility_ids):
+        self.split_facility_ids = split_facility_ids
+        self.batch = FirestoreBatch(get_firestore_client(), max_workers=COMMIT_WORKERS)
+        self.rt_batch = FirestoreBatch(get_firestore_client(), max_workers=COMMIT_WORKERS)
+        self.manifest_updates = {}
+        self.rt_manifest_updates = {}
+        self.series_updates = {}
+        self.written = 0
+        self.skipped = 0
+
+    def save_cases(self, facilities):
+        written, skipped = save_case_data(
+            facilities, self.batch, self.manifest_updates, self.series_updates)
+        self.written += written
+        self.skipped += skipped
+
+        # the chunk's days are merged into the series docs and marked as
+        # saved once they are committed, rather than held until the end of
+        # the input
+        self.batch.commit()
+        save_case_series(self.series_updates)
+        save_case_manifests(self.manifest_updates)
+        self.series_updates.clear()
+        self.manifest_updates.clear()
+
+    def save_rt(self, facilities):
+        rt_by_facility = compute_rt_data({
+            facility_id: covid_cases for facility_id, covid_cases in facilities.items()
+            if facility_id not in self.split_facility_ids
+        })
+        # more of the input may have been parsed in the meantime
+        save_rt_data({
+            facility_id: rt_values for facility_id, rt_values in rt_by_facility.items()
+            if facility_id not in self.split_facility_ids
+        }, self.rt_batch, self.rt_manifest_updates)
+
+        self.rt_batch.commit()
+        save_rt_manifests(self.rt_manifest_updates)
+        self.rt_manifest_updates.clear()
+
+    def save(self, facilities):
+        self.save_cases(facilities)
+        self.save_rt(facilities)
+
+    def finish(self):
+        log.info(f'Saved {self.written} days of case data; '
+                 f'skipped {self.skipped} unchanged days')
+
+        for facility_id in self.split_facility_ids:
+            log.warning(f'Rows for facility {facility_id} are not consecutive; '
+                        'recomputing R(t) from saved case data')
+            save_rt_data(compute_rt_data({facility_id: read_case_data(facility_id)}))
+
+
+def ingest_case_data_stream(lines):
+    """
+    Saves case data and R(t) from a stream of JSON Lines a few facilities at
+    a time, so memory use doesn't grow with the size of the input.
+    """
+    split_facility_ids = set()
+    chunker = CaseDataChunker(STREAM_CHUNK_FACILITIES, split_facility_ids)
+    writer = CaseDataWriter(split_facility_ids)
+
+    for some_lines in chunked(lines, STREAM_PARSE_LINES):
+        for facilities in chunker.feed(some_lines):
+            writer.save(facilities)
+    for facilities in chunker.close():
+        writer.save(facilities)
+
+    writer.finish()
+
+
+def run_in_thread(executor, f, *args):
+    """
+    Runs f(*args) on the executor from a coroutine, carrying over the timing
+    context, which run_in_executor doesn't on Python 3.7.
+    """
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(
+        executor, functools.partial(context.run, f, *args))
+
+
+async def ingest_case_data_async(bucket_name, file_name):
+    """
+    Asynchronous pipeline version of ingesting a case data file with
+    stream_from_cloud_storage and ingest_case_data_stream. It has four
+    stages connected by bounded queues:
+
+    - download fetches ranged reads of the file,
+    - parse splits them into lines and collects facility chunks,
+    - save_cases writes each chunk's case data to Firestore,
+    - save_rt computes and writes each chunk's R(t).
+
+    The stages run concurrently, each on its own worker thread, so that
+    downloads and Firestore round trips overlap parsing and the R(t)
+    computation, and the wall time approaches that of the slowest stage. A
+    stage waits when its output queue is full, which caps memory use at
+    ASYNC_QUEUE_SIZE items per queue. If any stage fails, the others are
+    cancelled and the error is raised.
+    """
+    # one thread per stage; blocking calls run there, not on the event loop
+    executor = ThreadPoolExecutor(max_workers=4)
+    byte_chunks = asyncio.Queue(maxsize=ASYNC_QUEUE_SIZE)
+    facility_chunks = asyncio.Queue(maxsize=ASYNC_QUEUE_SIZE)
+    saved_chunks = asyncio.Queue(maxsize=ASYNC_QUEUE_SIZE)
+    split_facility_ids = set()
+
+    async def download():
+        blob = await run_in_thread(
+            executor, lambda: get_storage_client().get_bucket(bucket_name).get_blob(file_name))
+        for start in range(0, blob.size, STREAM_CHUNK_BYTES):
+            # the end of the range is inclusive
+            end = min(start + STREAM_CHUNK_BYTES, blob.size) - 1
+            with timing.phase('download'):
+                data = await run_in_thread(
+                    executor, functools.partial(blob.download_as_string, start=start, end=end))
+            await byte_chunks.put(data)
+        await byte_chunks.put(None)
+
+    async def parse():
+        chunker = CaseDataChunker(STREAM_CHUNK_FACILITIES, split_facility_ids)
+        remainder = b''
+        while True:
+            data = await byte_chunks.get()
+            if data is None:
+                lines = [remainder]
+            else:
+                *lines, remainder = (remainder + data).split(b'\n')
+
+            chunks = await run_in_thread(executor, chunker.feed, lines)
+            if data is None:
+                chunks += chunker.close()
+            for facilities in chunks:
+                await facility_chunks.put(facilities)
+
+            if data is None:
+                await facility_chunks.put(None)
+                return
+
+    async def save_cases():
+        while True:
+            facilities = await facility_chunks.get()
+            if facilities is not None:
+                await run_in_thread(executor, writer.save_cases, facilities)
+            await saved_chunks.put(facilities)
+            if facilities is None:
+                return
+
+    async def save_rt():
+        while True:
+            facilities = await saved_chunks.get()
+            if facilities is None:
+                return
+            await run_in_thread(executor, writer.save_rt, facilities)
+
+    writer = await run_in_thread(executor, CaseDataWriter, split_facility_ids)
+    stages = [asyncio.ensure_future(stage()) for stage in [download, parse, save_cases, save_rt]]
+    try:
+        await asyncio.gather(*stages)
+        await run_in_thread(executor, writer.finish)
+    except Exception:
+        for stage in stages:
+            stage.cancel()
+        raise
+    finally:
+        # waits for a cancelled stage's current call to finish
+        executor.shutdown(wait=True)
+
+
+def stream_reference_case_series():
+    """
+    Yields (facility id, covidCaseSeries doc) for every reference facility,
+    with one query, in order of facility id.
+    """
+    # collection group queries are ordered by document path
+    for snapshot in get_firestore_client().collection_group(CASE_SERIES_COLLECTION_ID).stream():
+        # e.g. reference_facilities/510/covidCaseSeries/2020-04
+        collection_id, facility_id, *_ = snapshot.reference.path.split('/')
+        if collection_id == REFERENCE_FACILITIES_COLLECTION_ID:
+            yield facility_id, snapshot.to_dict()
+
+
+def stream_reference_snapshot_facilities():
+    """
+    Yields (facility id, facility) for every reference facility, in order of
+    id, with its metadata and a covidCases field holding its whole history
+    in the format of pack_case_series. Metadata and series docs are read
+    with one query each, and held one facility at a time.
+    """
+    case_series = stream_reference_case_series()
+    next_series = next(case_series, None)
+
+    # facilities are streamed in order of id too, so the two can be merged
+    for snapshot in get_facilities_collection().stream():
+        covid_cases = {}
+        while next_series is not None and next_series[0] <= snapshot.id:
+            facility_id, series = next_series
+            if facility_id == snapshot.id:
+                covid_cases.update(unpack_case_series(series))
+            next_series = next(case_series, None)
+
+        facility = snapshot.to_dict()
+        facility['covidCases'] = pack_case_series(covid_cases)
+        yield snapshot.id, facility
+
+
+def to_snapshot_json(value):
+    # Firestore timestamps, e.g. createdAt and population dates
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def dumps_snapshot_json(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), default=to_snapshot_json)
+
+
+def write_reference_snapshot(f):
+    """
+    Writes a snapshot of all reference facility data to the binary file
+    `f` as compact JSON with sorted keys, one facility at a time, e.g.:
+
+    {
+      "facilities": {
+        "510": {
+          "canonicalName": "Example Jail",
+          ...
+          "covidCases": {"dates": [...], "popTestedPositive": [...], ...},
+        },
+        ...
+      },
+      "version": 1,
+    }
+
+    Returns the sha256 hash of what was written.
+    """
+    content_hash = hashlib.sha256()
+
+    def write(text):
+        data = text.encode()
+        content_hash.update(data)
+        f.write(data)
+
+    write('{"facilities":{')
+    for i, (facility_id, facility) in enumerate(stream_reference_snapshot_facilities()):
+        write(f'{"," if i else ""}{json.dumps(facility_id)}:{dumps_snapshot_json(facility)}')
+    write(f'}},"version":{SNAPSHOT_VERSION}}}')
+    return content_hash
+
+
+@timing.timed('export_snapshot')
+def export_reference_snapshot(bucket=None):
+    """
+    Writes a gzipped JSON snapshot of all reference facility data (see
+    write_reference_snapshot) to `reference_facilities/v{version}/{hash}.json.gz`
+    in the snapshot bucket, named by a hash of its contents so it can be
+    cached indefinitely, then points `reference_facilities/latest.json` at it.
+    An unchanged snapshot is not uploaded again. Returns the snapshot's name.
+
+    The snapshot is compressed into a temporary file as it is written, so
+    only one facility's data is held in memory at a time.
+    """
+    if bucket is None:
+        bucket = get_storage_client().get_bucket(SNAPSHOT_BUCKET_NAME)
+
+    with tempfile.TemporaryFile() as compressed:
+        # a fixed mtime keeps the compressed bytes the same for the same contents
+        with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as f:
+            content_hash = write_reference_snapshot(f).hexdigest()[:16]
+            snapshot_bytes = f.tell()
+        snapshot_name = f'reference_facilities/v{SNAPSHOT_VERSION}/{content_hash}.json.gz'
+
+        if bucket.get_blob(snapshot_name) is None:
+            blob = bucket.blob(snapshot_name)
+            blob.content_encoding = 'gzip'
+            blob.cache_control = 'public, max-age=31536000, immutable'
+            blob.upload_from_file(compressed, rewind=True, content_type='application/json')
+            timing.record(snapshotBytes=snapshot_bytes)
+            log.info(f'Exported reference snapshot {snapshot_name}')
+        else:
+            log.info(f'Reference snapshot {snapshot_name} is unchanged')
+
+    latest = bucket.blob('reference_facilities/latest.json')
+    latest.cache_control = 'no-cache'
+    latest.upload_from_string(json.dumps({'name': snapshot_name, 'hash': content_hash}),
+                              content_type='application/json')
+    return snapshot_name
+
+
+def export_reference_snapshot_after_ingest():
+    """
+    Runs export_reference_snapshot once an ingest has saved its data. The
+    snapshot only mirrors what is already in Firestore, and the next ingest
+    exports it again, so a failure (e.g. a missing or unwritable snapshot
+    bucket) is logged and recorded rather than failing the ingest.
+    """
+    try:
+        export_reference_snapshot()
+    except Exception:
+        log.error(f'Failed to export the reference snapshot: {traceback.format_exc()}')
+        timing.record(snapshotExported=False)
+
+
+def ingest_daily_covid_case_data(bucket_name, file_name, streaming=False, columnar=False,
+                                 asynchronous=False):
+    """
+    Saves the case data and R(t) in a case data file. JSON Lines files are
+    read whole by default, or a chunk at a time with `streaming`, or by the
+    asyncio pipeline with `asynchronous` (see ingest_case_data_async).
+    """
+    with timing.invocation('ingest_daily_covid_case_data', log) as timer:
+        # CSV and Parquet files can only be read by the columnar path
+        columnar = columnar or is_tabular_file(file_name)
+        asynchronous = asynchronous and not columnar
+        streaming = streaming and not columnar and not asynchronous
+        timer.record(file=f'{bucket_name}/{file_name}', streaming=streaming,
+                     asynchronous=asynchronous, columnar=columnar)
+
+        if asynchronous:
+            asyncio.run(ingest_case_data_async(bucket_name, file_name))
+        elif streaming:
+            ingest_case_data_stream(stream_from_cloud_storage(bucket_name, file_name))
+        else:
+            file_location = download_from_cloud_storage(bucket_name, file_name)
+            if columnar:
+                facilities = reshape_case_data_table(read_table(file_location))
+            else:
+                facilities = reshape_facilities_data(file_location)
+            written, skipped = save_case_data(facilities)
+            log.info(f'Saved {written} days of case data; skipped {skipped} unchanged days')
+            save_rt_data(compute_rt_data(facilities))
+
+        export_reference_snapshot_after_ingest()
 
 
-def ingest_daily_covid_case_data(bucket_name, file_name):
-    file_location = download_from_cloud_storage(bucket_name, file_name)
-    facilities = reshape_facilities_data(file_location)
-    save_case_data(facilities)
+def ingest_facility_metadata_file(bucket_name, file_name, columnar=False):
+    with timing.invocation('ingest_facility_metadata_file', log) as timer:
+        columnar = columnar or is_tabular_file(file_name)
+        timer.record(file=f'{bucket_name}/{file_name}', columnar=columnar)
 
+        file_location = download_from_cloud_storage(bucket_name, file_name)
+        if columnar:
+            save_facility_updates(build_facility_updates_from_table(read_table(file_location)))
+        else:
+            create_or_update_facilities(file_location)
 
-def ingest_facility_metadata_file(bucket_name, file_name):
-    file_location = download_from_cloud_storage(bucket_name, file_name)
-    create_or_update_facilities(file_location)
+        export_reference_snapshot_after_ingest()
@@ -1,24 +1,77 @@
 # adapted from https://codereview.stackexchange.com/questions/217303/decorate-a-python-function-to-work-as-a-google-cloud-function
+from collections import OrderedDict
+from concurrent.futures import Future
 import functools
-from flask import json
+import json
 import jsonschema
 import logging
+import numpy as np
+import reprlib
+import threading
+import time
+import timing
 import traceback
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 log = logging.getLogger("cloudLogger")
 
+# request and response bodies longer than this are truncated in the logs
+MAX_LOGGED_BODY_CHARS = 2000
+
+# bounds the work of formatting a request for the log, since only the start
+# of it is kept
+body_repr = reprlib.Repr()
+body_repr.maxlevel = 4
+body_repr.maxdict = 10
+body_repr.maxlist = 10
+body_repr.maxstring = 100
+
+
+def to_json_serializable(value):
+    # NumPy scalars and arrays, e.g. values read from a DataFrame
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps_json(value):
+    """ Serializes a response with orjson if it is installed, otherwise the standard library """
+    if orjson is not None:
+        return orjson.dumps(value, default=to_json_serializable,
+                            option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    return json.dumps(value, default=to_json_serializable, separators=(',', ':'))
+
+
+def truncate_for_log(text):
+    if len(text) <= MAX_LOGGED_BODY_CHARS:
+        return text
+    return f"{text[:MAX_LOGGED_BODY_CHARS]}... ({len(text)} chars)"
+
 
-def cloudfunction(in_schema=None, out_schema=None):
+def cloudfunction(in_schema=None, out_schema=None, trusted_output=False):
     """
     :param in_schema: the schema for the input, or a falsy value if there is no input
     :param out_schema: the schema for the output, or a falsy value if there is no output
+    :param trusted_output: skip validating the output of each call against out_schema,
+        for functions whose tests already check that their output matches it
     :return: the cloudfunction wrapped function
     """
     # Both schemas must be valid according to jsonschema draft 7, if they are provided.
+    # The validators are built once here rather than for every request.
+    in_validator = out_validator = None
     if in_schema:
         jsonschema.Draft7Validator.check_schema(in_schema)
+        in_validator = jsonschema.Draft7Validator(in_schema)
     if out_schema:
         jsonschema.Draft7Validator.check_schema(out_schema)
+        if not trusted_output:
+            out_validator = jsonschema.Draft7Validator(out_schema)
 
     def cloudfunction_decorator(f):
         """ Wraps a function with one argument, a json object that it expects to be sent with the request.
@@ -34,30 +87,45 @@ def cloudfunction(in_schema=None, out_schema=None):
                 return cors_options()
 
             # If it's not a CORS OPTIONS request, still include the base header.
-            headers = {'Access-Control-Allow-Origin': '*'}
+            # Timing-Allow-Origin lets browsers read the Server-Timing header.
+            headers = {'Access-Control-Allow-Origin': '*', 'Timing-Allow-Origin': '*'}
 
             request_id = request.headers.get("Function-Execution-Id")
 
-            try:
-                if in_schema:
-                    request_json = request.get_json()
-                    log.info("Request JSON (ID %s): %s", request_id, request_json)
-                    jsonschema.validate(request_json, in_schema)
-                    function_output = f(request_json)
-                else:
-                    function_output = f()
-
-                if out_schema:
-                    jsonschema.validate(function_output, out_schema)
-
-                response_json = json.dumps(function_output)
-                log.info("Response JSON (ID %s): %s", request_id, response_json)
-                return (response_json, 200, headers)
-            except Exception as e:
-                log.error("Error in cloud function (ID %s): %s", request_id, traceback.format_exc())
-                response_json = json.dumps({'error': str(e)})
-                log.info("Response JSON (ID %s): %s", request_id, response_json)
-                return (response_json, 500, headers)
+            with timing.invocation(f.__name__, log, request_id) as timer:
+                status = 200
+                try:
+                    if in_validator is not None:
+                        request_json = request.get_json()
+                        with timer.phase('log'):
+                            if log.isEnabledFor(logging.INFO):
+                                log.info("Request JSON (ID %s): %s", request_id,
+                                         truncate_for_log(body_repr.repr(request_json)))
+                        with timer.phase('validate_input'):
+                            in_validator.validate(request_json)
+                        with timer.phase('handler'):
+                            function_output = f(request_json)
+                    else:
+                        with timer.phase('handler'):
+                            function_output = f()
+
+                    if out_validator is not None:
+                        with timer.phase('validate_output'):
+                            out_validator.validate(function_output)
+
+                    with timer.phase('encode'):
+                        response_json = dumps_json(function_output)
+                except Exception as e:
+                    log.error("Error in cloud function (ID %s): %s", request_id, traceback.format_exc())
+                    response_json = dumps_json({'error': str(e)})
+                    status = 500
+                    timer.record(status='error')
+
+                with timer.phase('log'):
+                    log.info("Response JSON (ID %s): %s", request_id, truncate_for_log(response_json))
+                headers['Server-Timing'] = timer.server_timing()
+
+            return (response_json, status, headers)
 
         return wrapped
 
@@ -75,3 +143,126 @@ def cors_options():
     }
 
     return ('', 204, headers)
+
+
+# metric name suffix for each outcome of a ResultCache lookup
+METRIC_OUTCOMES = {'hit': 'Hits', 'miss': 'Misses', 'shared': 'Shared'}
+
+
+class ResultCache():
+    """
+        Bounded in-process LRU cache whose entries expire after a TTL.
+
+        Lives for as long as the function instance does, so warm invocations
+        can reuse results computed for earlier requests. Concurrent lookups of
+        a key that is still being computed wait for that computation instead
+        of starting their own. To help size the cache, each lookup's outcome
+        is counted towards the current invocation's metrics (see timing.py),
+        which are logged once per invocation, e.g. rtCacheHits and
+        rtCacheMisses for a cache named "Rt".
+    """
+
+    def __init__(self, name, max_size, ttl_seconds):
+        self.name = name
+        self._metric_prefix = name[:1].lower() + name[1:] + 'Cache'
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+        # key => (expiry time, value), least recently used first
+        self._entries = OrderedDict()
+        # key => Future for computations in progress
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        # must be called while holding the lock
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return False, None
+
+        self._entries.move_to_end(key)
+        return True, value
+
+    def _store(self, key, value):
+        # must be called while holding the lock
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _record_size(self):
+        timing.record(**{self._metric_prefix + 'Size': len(self._entries),
+                         self._metric_prefix + 'Evictions': self.evictions})
+
+    def _report(self, outcome):
+        timing.add(self._metric_prefix + METRIC_OUTCOMES[outcome])
+        self._record_size()
+        log.debug("%s cache %s (hits=%d misses=%d shared=%d evictions=%d size=%d)",
+                  self.name, outcome, self.hits, self.misses, self.shared,
+                  self.evictions, len(self._entries))
+
+    def get(self, key):
+        """ Returns (True, value) for a live entry, otherwise (False, None) """
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self._report("hit" if found else "miss")
+        return found, value
+
+    def put(self, key, value):
+        with self._lock:
+            self._store(key, value)
+        self._record_size()
+
+    def get_or_compute(self, key, compute):
+        """
+            Returns the cached value for key, or calls compute() to produce and
+            cache it. Exceptions from compute() propagate to every caller
+            waiting on it and are not cached.
+        """
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                self.hits += 1
+                outcome = "hit"
+            elif key in self._in_flight:
+                self.shared += 1
+                outcome = "shared"
+                future = self._in_flight[key]
+            else:
+                self.misses += 1
+                outcome = "miss"
+                future = self._in_flight[key] = Future()
+        self._report(outcome)
+
+        if outcome == "hit":
+            return value
+        if outcome == "shared":
+            return future.result()
+
+        try:
+            value = compute()
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._store(key, value)
+            del self._in_flight[key]
+        future.set_result(value)
+        self._record_size()
+        return value
@@ -1,9 +1,41 @@
-from collections import defaultdict
+import hashlib
+import json
+import logging
 
-from helpers import cloudfunction
+from helpers import cloudfunction, ResultCache
 from schemas import rt_input, rt_output
-from realtime_rt import compute_r_t
-from data_ingest import ingest_daily_covid_case_data, ingest_facility_metadata_file
+from realtime_rt import compute_r_t, compute_r_t_batch, compute_r_t_incremental
+import timing
+
+# NOTE: data_ingest (and with it the Cloud Firestore and Storage libraries)
+# is imported by the ingest functions only, so that it doesn't add to the
+# cold start time of calculate_rt
+
+log = logging.getLogger("cloudLogger")
+
+# the same facility histories are requested over and over; keep recent
+# responses for the lifetime of the instance. Case data is updated daily.
+rt_cache = ResultCache("Rt", max_size=1024, ttl_seconds=60 * 60)
+
+
+def get_rt_cache_key(historical_case_counts, **options):
+    """
+        Hash of an Rt input's (date, cases) pairs, sorted by date and with
+        whole-number cases normalized to ints, plus any computation options.
+        Returns None for inputs that can't be normalized; they are not cached.
+    """
+    try:
+        dates = [str(date) for date in historical_case_counts['dates']]
+        cases = [int(c) if float(c).is_integer() else float(c)
+                 for c in historical_case_counts['cases']]
+    except (KeyError, TypeError, ValueError):
+        return None
+    if len(dates) != len(cases):
+        return None
+
+    canonical = json.dumps([sorted(zip(dates, cases)), options], sort_keys=True)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
 
 @cloudfunction(
     in_schema=rt_input,
@@ -14,18 +46,126 @@ def calculate_rt(request_json):
         accepts an object deserialized from JSON.
         returns an object that can be serialized to JSON.
         see schemas in @cloudfunction decorator for details.
+
+        If the input has a `facilities` key mapping ids to {dates, cases},
+        all of them are computed in one batch and the response is keyed by
+        the same ids; a facility that can't be computed gets an `error`
+        instead of failing the whole request.
+
+        With `adaptiveGrid` set, R(t) is computed with the adaptive
+        coarse-to-fine grid and the response describes the `grid` used.
+
+        With `estimateSigma` set, the most likely sigma (the day-to-day
+        variability of R(t)) is estimated for each series instead of using a
+        fixed value, and is returned as `sigma`.
+
+        Responses for each series are cached in rt_cache.
+
+        With `includeCheckpoint` set, the response also has a `checkpoint`
+        that can be sent back later along with only the newer days of data
+        to skip recomputing the days it covers; `checkpointStatus` says
+        whether a given checkpoint was used.
+
+        With `responseFormat` set to 'columns', each series is returned as
+        one `dates` array plus parallel `Rt`, `low90` and `high90` value
+        arrays instead of {date, value} records.
     """
-    resp = defaultdict(list)
+    estimate_sigma = request_json.get('estimateSigma', False)
+    response_format = request_json.get('responseFormat', 'records')
+
+    if 'facilities' in request_json:
+        timing.record(facilities=len(request_json['facilities']),
+                      seriesLength=sum(len(case_counts.get('dates', []))
+                                       for case_counts in request_json['facilities'].values()))
+        return {'facilities': calculate_rt_batch(request_json['facilities'],
+                                                 estimate_sigma=estimate_sigma,
+                                                 response_format=response_format)}
 
-    result_df = compute_r_t(request_json)
+    timing.record(seriesLength=len(request_json.get('dates', [])))
 
-    for day in result_df.index:
-        date_str = day.strftime("%Y-%m-%d")
-        resp['Rt'].append({'date': date_str, 'value': result_df.loc[day, 'ML']})
-        resp['low90'].append({'date': date_str, 'value': result_df.loc[day, 'Low_90']})
-        resp['high90'].append({'date': date_str, 'value': result_df.loc[day, 'High_90']})
+    if 'checkpoint' in request_json or request_json.get('includeCheckpoint'):
+        if request_json.get('adaptiveGrid'):
+            raise ValueError('Checkpoints are not supported with the adaptive grid')
+        if estimate_sigma:
+            raise ValueError('Checkpoints are not supported with sigma estimation')
 
-    return resp
+        result_df, checkpoint = compute_r_t_incremental(
+            request_json, checkpoint=request_json.get('checkpoint'))
+
+        resp = build_rt_response(result_df, response_format)
+        resp['checkpoint'] = checkpoint
+        resp['checkpointStatus'] = result_df.attrs['checkpoint']
+        return resp
+
+    adaptive_grid = request_json.get('adaptiveGrid', False)
+    cache_key = get_rt_cache_key(request_json, adaptiveGrid=adaptive_grid,
+                                 estimateSigma=estimate_sigma, responseFormat=response_format)
+
+    def compute():
+        result_df = compute_r_t(request_json, adaptive_grid=adaptive_grid,
+                                estimate_sigma=estimate_sigma)
+
+        resp = build_rt_response(result_df, response_format)
+        if adaptive_grid:
+            resp['grid'] = result_df.attrs['grid']
+        if estimate_sigma:
+            resp['sigma'] = result_df.attrs['sigma']
+        return resp
+
+    if cache_key is None:
+        return compute()
+    return rt_cache.get_or_compute(cache_key, compute)
+
+def calculate_rt_batch(case_counts_by_id, estimate_sigma=False, response_format='records'):
+    resp = {}
+    cache_keys = {}
+    uncached = {}
+    for facility_id, historical_case_counts in case_counts_by_id.items():
+        cache_key = get_rt_cache_key(historical_case_counts, adaptiveGrid=False,
+                                     estimateSigma=estimate_sigma,
+                                     responseFormat=response_format)
+        found, cached_resp = (False, None) if cache_key is None else rt_cache.get(cache_key)
+        if found:
+            resp[facility_id] = cached_resp
+        else:
+            cache_keys[facility_id] = cache_key
+            uncached[facility_id] = historical_case_counts
+
+    for facility_id, result in compute_r_t_batch(uncached, estimate_sigma=estimate_sigma).items():
+        if isinstance(result, Exception):
+            log.warning("Unable to compute Rt for facility %s: %s", facility_id, result)
+            resp[facility_id] = {'error': str(result)}
+        else:
+            resp[facility_id] = build_rt_response(result, response_format)
+            if estimate_sigma:
+                resp[facility_id]['sigma'] = result.attrs['sigma']
+            if cache_keys[facility_id] is not None:
+                rt_cache.put(cache_keys[facility_id], resp[facility_id])
+
+    # preserve the input order
+    return {facility_id: resp[facility_id] for facility_id in case_counts_by_id}
+
+@timing.timed('build_response')
+def build_rt_response(result_df, response_format='records'):
+    """
+        Builds the Rt, low90 and high90 series of a response from the
+        columns of a compute_r_t result, either as {date, value} records or,
+        for the 'columns' format, as value arrays alongside one `dates` array.
+    """
+    dates = result_df.index.strftime("%Y-%m-%d").tolist()
+    values = {
+        'Rt': result_df['ML'].tolist(),
+        'low90': result_df['Low_90'].tolist(),
+        'high90': result_df['High_90'].tolist(),
+    }
+
+    if response_format == 'columns':
+        return {'dates': dates, **values}
+
+    return {
+        metric: [{'date': date, 'value': value} for date, value in zip(dates, metric_values)]
+        for metric, metric_values in values.items()
+    }
 
 def ingest_covid_case_data(event, _context):
     """
@@ -33,7 +173,9 @@ def ingest_covid_case_data(event, _context):
         CSV file containing daily Covid case data is placed into the
         c19-backend-covid-case-data bucket.
     """
-    ingest_daily_covid_case_data(event['bucket'], event['name'])
+    from data_ingest import ingest_daily_covid_case_data
+
+    ingest_daily_covid_case_data(event['bucket'], event['name'], streaming=True)
 
 
 def ingest_facility_metadata(event, _context):
@@ -42,4 +184,6 @@ def ingest_facility_metadata(event, _context):
         CSV file containing facility metadata is placed into the
         c19-backend-facility-metadata bucket.
     """
+    from data_ingest import ingest_facility_metadata_file
+
     ingest_facility_metadata_file(event['bucket'], event['name'])
@@ -1,11 +1,64 @@
 # Adapted from https://github.com/k-sys/covid-19/blob/master/Realtime%20R0.ipynb
 
 # Libraries required for the web version
+import base64
+import functools
+import io
+import math
 import pandas as pd
 import numpy as np
-from scipy import stats as sps
-from scipy.interpolate import interp1d
 
+import timing
+
+# We create an array for every possible value of Rt
+R_T_MAX = 12
+r_t_range = np.linspace(0, R_T_MAX, R_T_MAX*100+1)
+
+# Gamma is 1/serial interval
+# https://wwwnc.cdc.gov/eid/article/26/7/20-0282_article
+# https://www.nejm.org/doi/full/10.1056/NEJMoa2001316
+GAMMA = 1/7
+
+# candidate values of sigma (the standard deviation of the day-to-day change
+# in R(t)) when estimating it by maximum likelihood
+SIGMA_CANDIDATES = np.linspace(1/20, 1, 20)
+
+# upper bound on the number of posterior values (days x grid points x series)
+# held in memory at once by a batch computation or sigma estimation; larger
+# ones are chunked. 2M float64 cells is 16MB, which with the temporaries of
+# each day's update stays well inside a 256MB function instance
+BATCH_MAX_CELLS = 2_000_000
+
+# relative size below which the tails of the Gaussian prior step are dropped
+PROCESS_KERNEL_TOLERANCE = np.finfo(float).eps
+
+# adaptive grid mode: the coarse pass uses every 10th grid point, then the
+# full resolution grid is used around the region holding all but a tiny
+# fraction of each day's posterior mass, widened on each side
+ADAPTIVE_GRID_COARSE_STRIDE = 10
+ADAPTIVE_GRID_MASS_TOLERANCE = 1e-6
+ADAPTIVE_GRID_PADDING = .3
+# the fine pass falls back to the full grid if the mass dropped outside the
+# windows could account for more than this share of a day's P(k)
+ADAPTIVE_GRID_MAX_DROPPED_SHARE = 1e-2
+
+# a day's smoothed case count depends on the 3 days after it, so posteriors
+# only become final once 3 more days of data have been observed
+SMOOTHING_HALF_WINDOW = 3
+
+# bumped whenever the checkpoint contents or the computation they
+# depend on change, invalidating existing checkpoints
+CHECKPOINT_VERSION = 1
+
+def build_log_factorial_table(size):
+    # math.lgamma rather than scipy.special.gammaln, to keep scipy out of the
+    # import time of calculate_rt
+    return np.array([math.lgamma(k + 1) for k in range(size)])
+
+# lgamma(k + 1) for k = 0, 1, 2...; extended as larger counts come in
+log_factorial_table = build_log_factorial_table(1024)
+
+@timing.timed('prepare_cases')
 def prepare_cases(cases):
     new_cases = cases.diff()
 
@@ -22,98 +75,337 @@ def prepare_cases(cases):
 
     return original, smoothed
 
-def get_posteriors(sr, sigma=0.15):
+@functools.lru_cache(maxsize=None)
+def get_process_matrix(sigma):
+    """
+    Gaussian transition matrix for the prior step, cached per sigma so that
+    warm invocations skip rebuilding it. The returned array is read-only.
+    """
+    # only the dense reference path needs scipy; see get_process_kernel
+    from scipy import stats as sps
 
-    # We create an array for every possible value of Rt
-    R_T_MAX = 12
-    r_t_range = np.linspace(0, R_T_MAX, R_T_MAX*100+1)
-
-    # Gamma is 1/serial interval
-    # https://wwwnc.cdc.gov/eid/article/26/7/20-0282_article
-    # https://www.nejm.org/doi/full/10.1056/NEJMoa2001316
-    GAMMA = 1/7
-
-    # (1) Calculate Lambda
-    lam = sr[:-1].values * np.exp(GAMMA * (r_t_range[:, None] - 1))
-
-
-    # (2) Calculate each day's likelihood
-    likelihoods = pd.DataFrame(
-        data = sps.poisson.pmf(sr[1:].values, lam),
-        index = r_t_range,
-        columns = sr.index[1:])
-
-    # (3) Create the Gaussian Matrix
     process_matrix = sps.norm(loc=r_t_range,
                               scale=sigma
                              ).pdf(r_t_range[:, None])
 
-    # (3a) Normalize all rows to sum to 1
+    # Normalize all rows to sum to 1
     process_matrix /= process_matrix.sum(axis=0)
+    process_matrix.flags.writeable = False
+
+    return process_matrix
+
+def get_grid_step(grid):
+    # rounded so that equally spaced grids share cached kernels
+    return round(float(grid[1] - grid[0]), 10)
+
+def convolve_same(values, kernel):
+    """
+    Convolution of `values` with an odd-length kernel, centered and cropped to
+    the length of `values`. Unlike np.convolve's 'same' mode, this holds for
+    kernels longer than `values` too.
+    """
+    half_width = len(kernel) // 2
+    return np.convolve(values, kernel)[half_width:half_width + len(values)]
+
+@functools.lru_cache(maxsize=128)
+def get_process_kernel(sigma, grid_step, grid_size):
+    """
+    Banded equivalent of get_process_matrix for an evenly spaced grid.
+
+    Every column of the process matrix is the same Gaussian shifted along
+    the grid and divided by its sum, so the prior step is a 1-D convolution
+    of the posterior (scaled by those column normalizers) with one kernel.
+    The kernel is truncated where it falls below PROCESS_KERNEL_TOLERANCE of
+    its peak, and the normalizers are computed from the truncated kernel, so
+    columns clipped by the grid edges are renormalized exactly as in the
+    dense matrix.
+
+    Cached per (sigma, grid); returns read-only (kernel, column_scale) arrays.
+    """
+    half_width = int(np.ceil(
+        sigma * np.sqrt(-2 * np.log(PROCESS_KERNEL_TOLERANCE)) / grid_step))
+    # offsets beyond the grid never contribute
+    half_width = min(half_width, grid_size - 1)
+
+    kernel = np.exp(-.5 * (np.arange(-half_width, half_width + 1) * grid_step / sigma) ** 2)
+    column_scale = 1 / convolve_same(np.ones(grid_size), kernel)
+
+    kernel.flags.writeable = False
+    column_scale.flags.writeable = False
+    return kernel, column_scale
+
+def apply_process_kernel(posterior, kernel, column_scale):
+    """
+    Computes the prior step from the previous day's posterior, shaped
+    (grid,), using a kernel from get_process_kernel. Stacks of posteriors
+    use apply_process_kernels instead.
+    """
+    return convolve_same(posterior * column_scale, kernel)
+
+def apply_process_kernels(posteriors, kernels):
+    """
+    Prior step for a stack of posteriors, shaped (series, grid), each with
+    its own (kernel, column_scale) from get_process_kernel in `kernels`.
+
+    Each row is convolved on its own, exactly as apply_process_kernel does
+    for a single series, so a stack gets the same priors as separate runs.
+    Batching the rows with FFTs would be faster, but its round-off leaves a
+    floor near 1e-17 of each row's peak, and a large enough case count
+    pulls the log-space Bayes update into it wherever the prior is smaller.
+    """
+    prior = np.empty_like(posteriors)
+    for i, (kernel, column_scale) in enumerate(kernels):
+        prior[i] = apply_process_kernel(posteriors[i], kernel, column_scale)
+    return prior
+
+def get_log_factorials(counts):
+    """
+    Returns lgamma(k + 1) for an array of integer counts k, looked up in
+    log_factorial_table, which is extended to cover the largest count.
+    """
+    global log_factorial_table
+    counts = counts.astype(int)
+
+    max_count = counts.max(initial=0)
+    if max_count >= len(log_factorial_table):
+        log_factorial_table = build_log_factorial_table(
+            max(2 * len(log_factorial_table), max_count + 1))
+
+    return log_factorial_table[counts]
+
+def log_poisson_likelihoods(counts, grid):
+    """
+    Log likelihood of each day's smoothed count given the previous day's
+    count, for every R(t) value in `grid` (one grid per day if 2-D):
+
+        lambda = k[t-1] * exp(GAMMA * (R(t) - 1))
+        log P(k[t] | R(t)) = k[t] * log(lambda) - lambda - lgamma(k[t] + 1)
+
+    log(lambda) is log(k[t-1]) plus a term computed once per grid point, and
+    lgamma comes from a cached table, so the per-cell work is a few
+    multiply-adds. Staying in log space means large counts never underflow.
+
+    `counts` is shaped (days,) or (days, series); the result is shaped
+    (days - 1,) + counts.shape[1:] + (grid,).
+    """
+    log_growth = GAMMA * (grid - 1)
+    previous = counts[:-1, ..., None]
+    current = counts[1:, ..., None]
+
+    return (current * (np.log(previous) + log_growth)
+            - previous * np.exp(log_growth)
+            - get_log_factorials(current))
+
+def apply_bayes_rule(log_likelihoods, prior):
+    """
+    Bayes' rule for one day over the last axis, given log likelihoods
+    log P(k|R_t) and the prior P(R_t). The numerator is formed in log space
+    and normalized with log-sum-exp, so it can't underflow to all zeros.
+
+    Returns the posterior P(R_t|k) and log P(k).
+    """
+    with np.errstate(divide='ignore'):
+        log_numerator = log_likelihoods + np.log(prior)
+
+    peak = log_numerator.max(axis=-1, keepdims=True)
+    numerator = np.exp(log_numerator - peak)
+    denominator = numerator.sum(axis=-1, keepdims=True)
+
+    return numerator/denominator, (peak + np.log(denominator))[..., 0]
+
+@timing.timed('posteriors')
+def compute_posteriors(counts, sigma=0.15, num_observed=None, banded=True, grid=None,
+                       initial_posterior=None):
+    """
+    Pure-NumPy core of get_posteriors: runs the Bayesian update on raw arrays
+    that are preallocated up front, without any pandas objects.
+
+    `counts` holds smoothed daily case counts, either one series of shape
+    (days,) or a stack of series of shape (days, series). In a stack, the days
+    of each series past its entry in `num_observed` are padding and are masked
+    out of the update and the log likelihood.
+
+    By default the prior step uses the banded kernel from get_process_kernel;
+    with `banded=False` it multiplies by the dense process matrix instead.
+    `grid` is an evenly spaced subset of r_t_range to compute the posteriors
+    over instead of the full range (banded mode only).
+    `initial_posterior` replaces the uniform prior as the first day's
+    posterior, to resume a computation where an earlier one left off.
+
+    `sigma` may also be an array of values (banded mode only), which adds a
+    series axis to a single series to evaluate it under each sigma, or gives
+    the sigma of each series in a stack. The prior step of each series in a
+    stack then uses the kernel of its own sigma (see apply_process_kernels).
+
+    Returns the posteriors, shaped (days, grid) or (days, series, grid), and
+    the log likelihood (a float, or an array with one value per series).
+    """
+    if grid is None:
+        grid = r_t_range
+    elif not banded:
+        raise ValueError('The dense process matrix is only available for the full grid')
+
+    sigmas = np.asarray(sigma, dtype=float)
+    if sigmas.ndim > 0 and not banded:
+        raise ValueError('The dense process matrix is only available for a single sigma')
+
+    counts = np.asarray(counts, dtype=float)
+    series_shape = np.broadcast(np.empty(counts.shape[1:]), sigmas).shape
+    stacked = banded and len(series_shape) > 0
+    num_days = counts.shape[0]
+    # (1) & (2) Calculate Lambda and each day's log likelihood
+    log_likelihoods = log_poisson_likelihoods(counts, grid)
+    if num_observed is not None:
+        is_observed = np.arange(1, num_days)[:, None] < np.asarray(num_observed)
+        log_likelihoods[~is_observed] = 0
+
+    # (3) Create the Gaussian Matrix, normalized so all rows sum to 1
+    if stacked:
+        kernels = [get_process_kernel(series_sigma, get_grid_step(grid), len(grid))
+                   for series_sigma in np.broadcast_to(sigmas, series_shape).ravel()]
+    elif banded:
+        kernel, column_scale = get_process_kernel(
+            sigma, get_grid_step(grid), len(grid))
+    else:
+        process_matrix = get_process_matrix(sigma)
 
     # (4) Calculate the initial prior
-    prior0 = np.ones_like(r_t_range)/len(r_t_range)
+    prior0 = np.ones_like(grid)/len(grid)
     prior0 /= prior0.sum()
 
-    # Create a DataFrame that will hold our posteriors for each day
+    # Preallocate the posteriors for each day, one contiguous block per day.
     # Insert our prior as the first posterior.
-    posteriors = pd.DataFrame(
-        index=r_t_range,
-        columns=sr.index,
-        data={sr.index[0]: prior0}
-    )
+    posteriors = np.empty((num_days,) + series_shape + (len(grid),))
+    posteriors[0] = prior0 if initial_posterior is None else initial_posterior
 
     # We said we'd keep track of the sum of the log of the probability
     # of the data for maximum likelihood calculation.
-    log_likelihood = 0.0
+    log_likelihood = np.zeros(series_shape)
 
     # (5) Iteratively apply Bayes' rule
-    for previous_day, current_day in zip(sr.index[:-1], sr.index[1:]):
+    for day in range(1, num_days):
 
         #(5a) Calculate the new prior
-        current_prior = process_matrix @ posteriors[previous_day]
-
-        #(5b) Calculate the numerator of Bayes' Rule: P(k|R_t)P(R_t)
-        numerator = likelihoods[current_day] * current_prior
-
-        #(5c) Calculate the denominator of Bayes' Rule P(k)
-        denominator = np.sum(numerator)
-
-        # Execute full Bayes' Rule
-        posteriors[current_day] = numerator/denominator
+        if stacked:
+            previous = posteriors[day - 1]
+            current_prior = apply_process_kernels(
+                previous.reshape(-1, len(grid)), kernels).reshape(previous.shape)
+        elif banded:
+            current_prior = apply_process_kernel(posteriors[day - 1], kernel, column_scale)
+        else:
+            current_prior = (process_matrix @ posteriors[day - 1].T).T
+
+        #(5b) - (5c) Execute full Bayes' Rule
+        posteriors[day], log_denominator = apply_bayes_rule(
+            log_likelihoods[day - 1], current_prior)
 
         # Add to the running sum of log likelihoods
-        log_likelihood += np.log(denominator)
+        if num_observed is None:
+            log_likelihood += log_denominator
+        else:
+            log_likelihood += np.where(is_observed[day - 1], log_denominator, 0)
+
+    if not series_shape:
+        log_likelihood = float(log_likelihood)
 
     return posteriors, log_likelihood
 
+def get_posteriors(sr, sigma=0.15, banded=True):
+    """
+    Returns the daily posteriors for a smoothed case series as a DataFrame
+    (one column per day, indexed by Rt value) and the log likelihood.
+    """
+    posteriors, log_likelihood = compute_posteriors(sr.values, sigma=sigma, banded=banded)
+
+    return pd.DataFrame(posteriors.T, index=r_t_range, columns=sr.index), log_likelihood
+
+def stack_case_series(smoothed_series):
+    """
+    Stacks smoothed case series of different lengths into one (days, series)
+    array, padded at the end. Returns the array and each series' length.
+    """
+    lengths = [len(sr) for sr in smoothed_series]
+
+    # pad with the smallest accepted smoothed value so lambda stays finite
+    counts = np.ones((max(lengths), len(smoothed_series)))
+    for i, sr in enumerate(smoothed_series):
+        counts[:len(sr), i] = sr.values
+
+    return counts, lengths
+
+def highest_density_intervals(posteriors, p=.9):
+    """
+    Finds the narrowest interval holding more than `p` of the probability
+    mass for every day at once. `posteriors` has shape (days, grid).
+
+    For each day and each candidate low bound, the first high bound whose
+    enclosed mass exceeds p is found with one np.searchsorted over the
+    cumulative sums of all days, laid end to end with each day offset past
+    the previous one. The offsets cost a little precision, so each high bound
+    is then nudged until the enclosed mass, computed exactly as
+    cumsum[high] - cumsum[low] as in the original quadratic search, is the
+    first to exceed p. Ties resolve to the lowest bound.
+
+    Returns arrays of grid indices (lows, highs), one per day, which are
+    empty if there are no days. Raises ValueError if a day has no such
+    interval (e.g. a degenerate posterior).
+    """
+    cumsum = np.cumsum(posteriors, axis=1)
+    num_days, grid_size = cumsum.shape
+    if not np.isfinite(cumsum).all():
+        raise ValueError('Posteriors must be finite')
+    if num_days == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+    # every value of a day is below every value of the next day plus p, so
+    # a search past the end of a day lands on the first index of the next
+    row_span = cumsum[:, -1].max() + p + 1
+    flat = (cumsum + row_span * np.arange(num_days)[:, None]).ravel()
+    highs = (np.searchsorted(flat, flat + p, side='right').reshape(cumsum.shape)
+             - grid_size * np.arange(num_days)[:, None])
+    lows = np.broadcast_to(np.arange(grid_size), cumsum.shape)
+
+    def encloses(highs):
+        # whether [lows, highs] holds more than p; False past the grid
+        in_grid = highs < grid_size
+        mass = np.take_along_axis(cumsum, np.minimum(highs, grid_size - 1), axis=1) - cumsum
+        return in_grid & (mass > p)
+
+    while True:
+        too_high = (highs - 1 > lows) & encloses(highs - 1)
+        too_low = (highs < grid_size) & ~encloses(highs)
+        if not (too_high.any() or too_low.any()):
+            break
+        highs = highs - too_high + too_low
+
+    widths = np.where(highs < grid_size, highs - lows, grid_size)
+    best = widths.argmin(axis=1)
+    day_indices = np.arange(num_days)
+    if (widths[day_indices, best] == grid_size).any():
+        raise ValueError(f'No interval holds more than {p} of the probability mass')
+
+    return best, highs[day_indices, best]
+
 def highest_density_interval(pmf, p=.9, debug=False):
-    # If we pass a DataFrame, just call this recursively on the columns
+    """
+    Returns the Low/High bounds of the highest density interval of a pmf
+    Series, or one row of bounds per column of a DataFrame of pmfs.
+    """
+    labels = [f'Low_{p*100:.0f}', f'High_{p*100:.0f}']
+
     if(isinstance(pmf, pd.DataFrame)):
-        return pd.DataFrame([highest_density_interval(pmf[col], p=p) for col in pmf],
+        lows, highs = highest_density_intervals(pmf.values.T, p=p)
+        return pd.DataFrame({labels[0]: pmf.index[lows], labels[1]: pmf.index[highs]},
                             index=pmf.columns)
 
-    cumsum = np.cumsum(pmf.values)
-
-    # N x N matrix of total probability mass for each low, high
-    total_p = cumsum - cumsum[:, None]
-
-    # Return all indices with total_p > p
-    lows, highs = (total_p > p).nonzero()
-
-    # Find the smallest range (highest density)
-    best = (highs - lows).argmin()
-
-    low = pmf.index[lows[best]]
-    high = pmf.index[highs[best]]
-
-    return pd.Series([low, high],
-                     index=[f'Low_{p*100:.0f}',
-                            f'High_{p*100:.0f}'])
-
-# High level method for computing the rate of spread over time
-def compute_r_t(historical_case_counts):
+    lows, highs = highest_density_intervals(pmf.values[None, :], p=p)
+    return pd.Series([pmf.index[lows[0]], pmf.index[highs[0]]], index=labels)
 
+def parse_case_counts(historical_case_counts):
+    """
+    Validates a {dates, cases} input and returns its cumulative case counts
+    as a Series indexed by date. Raises ValueError for unusable input.
+    """
     # Check required columns are included in the provided input
     for required_column in ['cases', 'dates']:
         if required_column not in historical_case_counts:
@@ -131,7 +423,14 @@ def compute_r_t(historical_case_counts):
         raise ValueError(
             'Case counts must be cumulative and monotonically increasing')
 
-    _, smoothed = prepare_cases(case_df)
+    return case_df
+
+def prepare_case_series(historical_case_counts):
+    """
+    Validates a {dates, cases} input and returns its smoothed daily new cases.
+    Raises ValueError if the input cannot be used to compute R(t).
+    """
+    _, smoothed = prepare_cases(parse_case_counts(historical_case_counts))
 
     # Raise an error if there are not enough valid cases to use
     # we need at least two days to represent change over time
@@ -139,19 +438,469 @@ def compute_r_t(historical_case_counts):
         raise ValueError('Not enough data to compute R(t);'
             ' at least two days of data are required')
 
-    # Note that we're fixing sigma to a value just for the example
-    posteriors, _ = get_posteriors(smoothed, sigma=.25)
+    return smoothed
+
+@timing.timed('hdi')
+def posterior_statistics(posteriors, offsets=0):
+    """
+    Returns the indices into r_t_range of the most likely value and the 90%
+    highest density interval bounds of daily posteriors shaped (days, grid),
+    as a (days, 3) array of (ML, Low_90, High_90).
 
-    # Note that this takes a while to execute - it's not the most efficient algorithm
+    For windowed posteriors (see compute_windowed_posteriors), `offsets` holds
+    the index into r_t_range of each day's first column.
+    """
     try:
-        hdis = highest_density_interval(posteriors, p=.9)
+        lows, highs = highest_density_intervals(posteriors, p=.9)
     except:
         raise ValueError('Unable to compute R(t) with the provided data')
 
-    most_likely = posteriors.idxmax().rename('ML')
-    # the first day is not a valid value because it has no priors; exclude it
-    result = pd.concat([most_likely, hdis], axis=1).iloc[1:]
+    return np.reshape(offsets, (-1, 1)) + np.stack([posteriors.argmax(axis=1), lows, highs], axis=1)
+
+@timing.timed('smoothing')
+def smooth_statistics(statistics, dates):
+    """
+    Builds the result DataFrame of ML, Low_90 and High_90 values for the
+    given dates from posterior_statistics output.
+    """
+    result = pd.DataFrame({
+        'ML': r_t_range[statistics[:, 0]],
+        'Low_90': r_t_range[statistics[:, 1]],
+        'High_90': r_t_range[statistics[:, 2]],
+    }, index=dates)
     # smooth the final result to reduce noise from infrequent testing
     result = result.rolling(7, win_type='gaussian',
                             min_periods=1, center=True).mean(std=2).round(2)
+    # record which grid resolution the values were computed with
+    result.attrs['grid'] = {
+        'min': float(r_t_range[0]),
+        'max': float(r_t_range[-1]),
+        'step': get_grid_step(r_t_range),
+        'points': len(r_t_range),
+    }
+    return result
+
+def summarize_posteriors(posteriors, dates, offsets=None):
+    """
+    Reduces daily posteriors, shaped (days, grid), to the smoothed most likely
+    value (ML) and 90% highest density interval (Low_90, High_90) for each of
+    the given dates.
+
+    For windowed posteriors (see compute_windowed_posteriors), `offsets` holds
+    the index into r_t_range of each day's first column.
+    """
+    # the first day is not a valid value because it has no priors; exclude it
+    statistics = posterior_statistics(posteriors[1:], 0 if offsets is None else offsets[1:])
+
+    return smooth_statistics(statistics, dates[1:])
+
+@timing.timed('posteriors')
+def find_adaptive_windows(counts, sigma):
+    """
+    Coarse pass of the adaptive grid mode: computes the posteriors over every
+    ADAPTIVE_GRID_COARSE_STRIDE-th point of r_t_range, then finds for each day
+    the region holding all but ADAPTIVE_GRID_MASS_TOLERANCE of the posterior
+    mass, widened by ADAPTIVE_GRID_PADDING on each side.
+
+    Returns the first and last index into r_t_range of each day's window.
+    Days with degenerate coarse posteriors, and the first day (the uniform
+    prior), span the whole grid.
+    """
+    coarse_posteriors, _ = compute_posteriors(
+        counts, sigma=sigma, grid=r_t_range[::ADAPTIVE_GRID_COARSE_STRIDE])
+    cumsum = np.cumsum(coarse_posteriors, axis=-1)
+
+    # cumsum is non-decreasing, so counting points below a threshold
+    # gives the index of the first point at or above it
+    lows = (cumsum < ADAPTIVE_GRID_MASS_TOLERANCE / 2).sum(axis=-1)
+    highs = (cumsum < 1 - ADAPTIVE_GRID_MASS_TOLERANCE / 2).sum(axis=-1)
+
+    padding = int(np.ceil(ADAPTIVE_GRID_PADDING / get_grid_step(r_t_range)))
+    lows = np.maximum(lows * ADAPTIVE_GRID_COARSE_STRIDE - padding, 0)
+    highs = np.minimum(highs * ADAPTIVE_GRID_COARSE_STRIDE + padding, len(r_t_range) - 1)
+
+    full_grid = ~np.isfinite(cumsum).all(axis=-1)
+    full_grid[0] = True
+    lows[full_grid] = 0
+    highs[full_grid] = len(r_t_range) - 1
+
+    return lows, highs
+
+@timing.timed('posteriors')
+def compute_windowed_posteriors(counts, sigma, lows, highs):
+    """
+    Fine pass of the adaptive grid mode: runs the Bayesian update for one
+    series at full resolution, but only over each day's window of r_t_range
+    (from find_adaptive_windows). The posterior outside the window is
+    treated as zero, so the likelihood and prior steps scale with the
+    window width rather than the whole grid.
+
+    Returns the posteriors as a (days, widest window) array, zero past the
+    end of each day's window, along with each day's offset into r_t_range
+    and the log likelihood. The first day is represented by the uniform
+    prior restricted to the second day's window.
+
+    Returns None instead if the windows can't be trusted to hold the
+    posteriors: a day's posterior is degenerate or has mass at the edge of
+    its window, or the mass dropped outside the previous day's window could
+    matter. Up to ADAPTIVE_GRID_MASS_TOLERANCE of it is dropped, which
+    counts for little unless a day's likelihood is far higher somewhere on
+    the grid than where the posterior was, as after a sudden spike in cases.
+    """
+    counts = np.asarray(counts, dtype=float)
+    widths = highs - lows + 1
+    max_width = widths[1:].max()
+    kernel, column_scale = get_process_kernel(
+        sigma, get_grid_step(r_t_range), len(r_t_range))
+    half_width = len(kernel) // 2
+
+    # (1) & (2) Calculate Lambda and each day's log likelihood over its window
+    window_indices = np.minimum(lows[1:, None] + np.arange(max_width), len(r_t_range) - 1)
+    log_likelihoods = log_poisson_likelihoods(counts, r_t_range[window_indices])
+    # the likelihood peaks where lambda equals the day's count
+    peaks = np.clip(1 + np.log(counts[1:] / counts[:-1]) / GAMMA, 0, R_T_MAX)
+    max_log_likelihoods = log_poisson_likelihoods(counts, peaks[:, None])[:, 0]
+
+    # (4) Calculate the initial prior
+    prior0 = np.ones_like(r_t_range)/len(r_t_range)
+    prior0 /= prior0.sum()
+
+    posteriors = np.zeros((len(counts), max_width))
+    posteriors[0, :widths[1]] = 1 / widths[1]
+    offsets = lows.copy()
+    offsets[0] = lows[1]
+    log_likelihood = 0.0
+
+    # (5) Iteratively apply Bayes' rule
+    previous, previous_low = prior0, 0
+    for day in range(1, len(counts)):
+        low, width = lows[day], widths[day]
+
+        #(5a) Calculate the new prior over today's window; the full
+        # convolution of yesterday's window starts half a kernel before it
+        spread = np.convolve(
+            previous * column_scale[previous_low:previous_low + len(previous)], kernel)
+        start = low - (previous_low - half_width)
+        current_prior = np.zeros(width)
+        overlap = slice(max(start, 0), min(start + width, len(spread)))
+        if overlap.start < overlap.stop:
+            current_prior[overlap.start - start:overlap.stop - start] = spread[overlap]
+
+        #(5b) - (5c) Bayes' Rule
+        previous, log_denominator = apply_bayes_rule(
+            log_likelihoods[day - 1, :width], current_prior)
+        previous_low = low
+
+        # the dropped mass adds at most its share times the peak likelihood to P(k)
+        max_dropped_share = np.exp(np.log(ADAPTIVE_GRID_MASS_TOLERANCE)
+                                   + max_log_likelihoods[day - 1] - log_denominator)
+        edges = previous[[0, -1]][[low > 0, highs[day] < len(r_t_range) - 1]]
+        if not np.isfinite(log_denominator) \
+                or (edges > ADAPTIVE_GRID_MASS_TOLERANCE).any() \
+                or max_dropped_share > ADAPTIVE_GRID_MAX_DROPPED_SHARE:
+            return None
+
+        posteriors[day, :width] = previous
+        log_likelihood += float(log_denominator)
+
+    return posteriors, offsets, log_likelihood
+
+def select_sigma(log_likelihoods):
+    """
+    Returns the index into SIGMA_CANDIDATES of the maximum likelihood sigma,
+    given the log likelihood of a series under each candidate (last axis).
+    Raises ValueError if none of the candidates produced a usable posterior.
+    """
+    log_likelihoods = np.where(np.isnan(log_likelihoods), -np.inf, log_likelihoods)
+    best = log_likelihoods.argmax(axis=-1)
+
+    if np.isneginf(np.take_along_axis(log_likelihoods, np.expand_dims(best, -1), -1)).any():
+        raise ValueError('Unable to compute R(t) with the provided data')
+
+    return best
+
+def compute_sigma_posteriors(counts, num_observed=None):
+    """
+    Runs compute_posteriors for a stack of series, shaped (days, series),
+    under every value in SIGMA_CANDIDATES. Only as many candidates are
+    computed at once as fit in BATCH_MAX_CELLS posterior values (at least
+    one), and only the posteriors of each series' most likely candidate so
+    far are kept between them, so memory doesn't grow with the number of
+    candidates.
+
+    Returns the posteriors under each series' maximum likelihood sigma,
+    shaped (days, series, grid), and the log likelihood of each series
+    under each candidate, shaped (series, candidates), for select_sigma.
+    """
+    num_days, num_series = counts.shape
+    num_sigmas = len(SIGMA_CANDIDATES)
+    sigmas_per_chunk = max(1, BATCH_MAX_CELLS // (num_days * num_series * len(r_t_range)))
+
+    log_likelihoods = np.empty((num_series, num_sigmas))
+    best_log_likelihoods = np.full(num_series, -np.inf)
+    best_posteriors = np.zeros((num_days, num_series, len(r_t_range)))
+    for start in range(0, num_sigmas, sigmas_per_chunk):
+        sigmas = SIGMA_CANDIDATES[start:start + sigmas_per_chunk]
+        # series i under candidate j is column i * len(sigmas) + j
+        posteriors, chunk_log_likelihoods = compute_posteriors(
+            np.repeat(counts, len(sigmas), axis=1),
+            sigma=np.tile(sigmas, num_series),
+            num_observed=None if num_observed is None else np.repeat(num_observed, len(sigmas)))
+        posteriors = posteriors.reshape((num_days, num_series, len(sigmas), len(r_t_range)))
+        chunk_log_likelihoods = chunk_log_likelihoods.reshape((num_series, len(sigmas)))
+        log_likelihoods[:, start:start + len(sigmas)] = chunk_log_likelihoods
+
+        # same choice as select_sigma: NaN is never the best, ties go to the first
+        chunk_log_likelihoods = np.where(
+            np.isnan(chunk_log_likelihoods), -np.inf, chunk_log_likelihoods)
+        chunk_best = chunk_log_likelihoods.argmax(axis=1)
+        chunk_best_log_likelihoods = chunk_log_likelihoods[np.arange(num_series), chunk_best]
+        improved = np.flatnonzero(chunk_best_log_likelihoods > best_log_likelihoods)
+        best_posteriors[:, improved] = posteriors[:, improved, chunk_best[improved]]
+        best_log_likelihoods[improved] = chunk_best_log_likelihoods[improved]
+
+    return best_posteriors, log_likelihoods
+
+# High level method for computing the rate of spread over time
+def compute_r_t(historical_case_counts, adaptive_grid=False, estimate_sigma=False):
+    """
+    Returns the smoothed daily ML, Low_90 and High_90 values of R(t) for a
+    {dates, cases} input, one row per date after the first. The grid the
+    values were computed over is described in the result's `attrs['grid']`.
+
+    With `adaptive_grid`, a coarse first pass finds where each day's posterior
+    mass lies and the full-resolution pass only covers those windows (see
+    find_adaptive_windows).
+
+    With `estimate_sigma`, the posteriors are computed under every value in
+    SIGMA_CANDIDATES (see compute_sigma_posteriors), and the values of the
+    maximum likelihood one are returned; it is recorded in the result's
+    `attrs['sigma']`.
+    """
+    smoothed = prepare_case_series(historical_case_counts)
+
+    if estimate_sigma:
+        if adaptive_grid:
+            raise ValueError('Sigma estimation is not supported with the adaptive grid')
+
+        posteriors, log_likelihoods = compute_sigma_posteriors(smoothed.values[:, None])
+        best = select_sigma(log_likelihoods[0])
+
+        result = summarize_posteriors(posteriors[:, 0], smoothed.index)
+        result.attrs['sigma'] = float(SIGMA_CANDIDATES[best])
+        return result
+
+    # Note that we're fixing sigma to a value just for the example
+    sigma = .25
+
+    if not adaptive_grid:
+        posteriors, _ = compute_posteriors(smoothed.values, sigma=sigma)
+        return summarize_posteriors(posteriors, smoothed.index)
+
+    lows, highs = find_adaptive_windows(smoothed.values, sigma)
+    windowed = compute_windowed_posteriors(smoothed.values, sigma, lows, highs)
+    if windowed is None:
+        # the windows missed some of the posterior mass; use the full grid
+        posteriors, _ = compute_posteriors(smoothed.values, sigma=sigma)
+        result = summarize_posteriors(posteriors, smoothed.index)
+        result.attrs['grid'] = {
+            'min': float(r_t_range[0]),
+            'max': float(r_t_range[-1]),
+            'step': get_grid_step(r_t_range),
+            'points': len(r_t_range),
+        }
+        return result
+
+    posteriors, offsets, _ = windowed
+    result = summarize_posteriors(posteriors, smoothed.index, offsets=offsets)
+    result.attrs['grid'] = {
+        'min': float(r_t_range[lows[1:].min()]),
+        'max': float(r_t_range[highs[1:].max()]),
+        'step': get_grid_step(r_t_range),
+        'points': int(posteriors.shape[1]),
+        'coarseStep': get_grid_step(r_t_range[::ADAPTIVE_GRID_COARSE_STRIDE]),
+    }
     return result
+
+def build_checkpoint(case_df, posterior, log_likelihood, statistics, sigma):
+    """
+    Serializes the state needed to resume compute_r_t_incremental into a
+    compact base64 blob: the cumulative case history (which includes the
+    tail the smoothing needs), the posterior and running log likelihood of
+    the last settled day, and the unsmoothed ML/HDI grid indices of every
+    day up to it.
+    """
+    buffer = io.BytesIO()
+    np.savez_compressed(
+        buffer,
+        version=CHECKPOINT_VERSION,
+        sigma=sigma,
+        grid_size=len(r_t_range),
+        dates=np.array(case_df.index.strftime('%Y-%m-%d'), dtype='U10'),
+        cases=case_df.values.astype(np.int64),
+        posterior=posterior,
+        log_likelihood=log_likelihood,
+        statistics=statistics.astype(np.uint16),
+    )
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+def load_checkpoint(checkpoint):
+    """
+    Deserializes a blob from build_checkpoint. Raises ValueError if it can't
+    be read or was built by an incompatible version of this computation.
+    """
+    try:
+        with np.load(io.BytesIO(base64.b64decode(checkpoint)), allow_pickle=False) as data:
+            saved = {key: data[key] for key in data.files}
+    except Exception:
+        raise ValueError('Unable to read R(t) checkpoint')
+
+    if (saved.get('version') != CHECKPOINT_VERSION
+            or saved.get('grid_size') != len(r_t_range)):
+        raise ValueError('R(t) checkpoint was created by an incompatible version')
+
+    return saved
+
+def compute_r_t_incremental(historical_case_counts, checkpoint=None):
+    """
+    Same as compute_r_t, but resumable: returns the result along with a
+    checkpoint blob, and when given a checkpoint from an earlier call, only
+    runs the posterior updates for the days after it. The input may then
+    contain just the new days, or the full history; the result is the same
+    as a full recomputation.
+
+    If the input changes or back-fills any day the checkpoint covers, the
+    checkpoint is invalid and everything is recomputed from the saved history
+    updated with the input. `result.attrs['checkpoint']` says whether the
+    checkpoint was 'resumed', 'invalidated', or not given ('created').
+    """
+    # Note that we're fixing sigma to a value just for the example
+    sigma = .25
+    case_df = parse_case_counts(historical_case_counts)
+
+    status = 'created'
+    saved = None
+    if checkpoint is not None:
+        saved = load_checkpoint(checkpoint)
+        saved_case_df = pd.Series(saved['cases'], index=pd.to_datetime(saved['dates']))
+        saved_case_df.index.name = 'date'
+
+        # the input takes precedence over the saved history
+        case_df = pd.concat([
+            saved_case_df[~saved_case_df.index.isin(case_df.index)],
+            case_df,
+        ]).sort_index()
+        if case_df.diff().min() < 0:
+            raise ValueError(
+                'Case counts must be cumulative and monotonically increasing')
+
+        if (saved['sigma'] == sigma
+                and case_df.index[:len(saved_case_df)].equals(saved_case_df.index)
+                and (case_df.values[:len(saved_case_df)] == saved_case_df.values).all()):
+            status = 'resumed'
+        else:
+            status = 'invalidated'
+            saved = None
+
+    # Raise an error if there are not enough valid cases to use
+    # we need at least two days to represent change over time
+    if len(case_df) < 2:
+        raise ValueError('Not enough data to compute R(t);'
+            ' at least two days of data are required')
+
+    # the last day whose posterior can't change as more days come in
+    settled_day = max(len(case_df) - 1 - SMOOTHING_HALF_WINDOW, 0)
+
+    if saved is None:
+        start_day, initial_posterior, log_likelihood = 0, None, 0.0
+        statistics = np.empty((0, 3), dtype=int)
+    else:
+        start_day = max(len(saved['cases']) - 1 - SMOOTHING_HALF_WINDOW, 0)
+        initial_posterior = saved['posterior']
+        log_likelihood = float(saved['log_likelihood'])
+        statistics = saved['statistics'].astype(int)
+
+    # smoothing the start day needs the SMOOTHING_HALF_WINDOW days of new
+    # cases before it, and so one more day of cumulative cases
+    tail_start = max(start_day - SMOOTHING_HALF_WINDOW - 1, 0)
+    _, smoothed = prepare_cases(case_df.iloc[tail_start:])
+    counts = smoothed.values[start_day - tail_start:]
+
+    # split the updates at the settled day to save its posterior
+    settled_posteriors, settled_log_likelihood = compute_posteriors(
+        counts[:settled_day - start_day + 1], sigma=sigma, initial_posterior=initial_posterior)
+    recent_posteriors, _ = compute_posteriors(
+        counts[settled_day - start_day:], sigma=sigma, initial_posterior=settled_posteriors[-1])
+
+    # the start day's statistics are either saved or, for the first day, excluded
+    statistics = np.concatenate([
+        statistics,
+        posterior_statistics(settled_posteriors[1:]),
+        posterior_statistics(recent_posteriors[1:]),
+    ])
+
+    result = smooth_statistics(statistics, case_df.index[1:])
+    result.attrs['checkpoint'] = status
+
+    new_checkpoint = build_checkpoint(
+        case_df, settled_posteriors[-1], log_likelihood + settled_log_likelihood,
+        statistics[:settled_day], sigma)
+
+    return result, new_checkpoint
+
+def compute_r_t_batch(case_counts_by_id, estimate_sigma=False):
+    """
+    Batch mode of compute_r_t: accepts a mapping of id to {dates, cases} and
+    runs the posterior updates for all valid series as stacked computations.
+    With `estimate_sigma`, each stack is run under every sigma candidate
+    (see compute_sigma_posteriors).
+
+    Returns a mapping of id to either the result DataFrame compute_r_t would
+    return for that series or the exception raised while computing it, so that
+    one bad series does not fail the whole batch.
+    """
+    results = {}
+    smoothed_by_id = {}
+    for series_id, historical_case_counts in case_counts_by_id.items():
+        try:
+            smoothed_by_id[series_id] = prepare_case_series(historical_case_counts)
+        except Exception as e:
+            results[series_id] = e
+
+    # group series of similar length together to minimize padding,
+    # and cap the size of each stacked computation
+    chunks = []
+    for series_id in sorted(smoothed_by_id, key=lambda i: len(smoothed_by_id[i])):
+        # series are sorted by length, so this one is the longest in its chunk
+        if chunks:
+            cells = len(smoothed_by_id[series_id]) * len(r_t_range) * (len(chunks[-1]) + 1)
+        if not chunks or cells > BATCH_MAX_CELLS:
+            chunks.append([series_id])
+        else:
+            chunks[-1].append(series_id)
+
+    for chunk in chunks:
+        smoothed_series = [smoothed_by_id[i] for i in chunk]
+        counts, lengths = stack_case_series(smoothed_series)
+        if estimate_sigma:
+            posteriors, log_likelihoods = compute_sigma_posteriors(counts, num_observed=lengths)
+        else:
+            # Note that we're fixing sigma to a value just for the example
+            posteriors, _ = compute_posteriors(counts, sigma=.25, num_observed=lengths)
+
+        for i, (series_id, smoothed) in enumerate(zip(chunk, smoothed_series)):
+            try:
+                if estimate_sigma:
+                    best = select_sigma(log_likelihoods[i])
+                    result = summarize_posteriors(
+                        posteriors[:len(smoothed), i], smoothed.index)
+                    result.attrs['sigma'] = float(SIGMA_CANDIDATES[best])
+                else:
+                    result = summarize_posteriors(
+                        posteriors[:len(smoothed), i], smoothed.index)
+                results[series_id] = result
+            except Exception as e:
+                results[series_id] = e
+
+    # preserve the input order
+    return {series_id: results[series_id] for series_id in case_counts_by_id}
@@ -5,7 +5,7 @@ number_array = {
     },
 }
 
-rt_input = {
+rt_series = {
     "type": "object",
     "properties": {
         "dates": {
@@ -19,6 +19,30 @@ rt_input = {
     },
 }
 
+rt_input = {
+    "type": "object",
+    "properties": {
+        **rt_series["properties"],
+        # compute over a coarse-to-fine grid instead of the full grid
+        "adaptiveGrid": {"type": "boolean"},
+        # estimate sigma by maximum likelihood instead of using a fixed value
+        "estimateSigma": {"type": "boolean"},
+        # resume from / return a checkpoint for incremental updates
+        "checkpoint": {"type": "string"},
+        "includeCheckpoint": {"type": "boolean"},
+        # batch mode: facility id => {dates, cases}
+        "facilities": {
+            "type": "object",
+            "additionalProperties": rt_series,
+        },
+        # {date, value} records (the default), or see rt_series_columns_output
+        "responseFormat": {
+            "type": "string",
+            "enum": ["records", "columns"],
+        },
+    },
+}
+
 rt_records = {
   "type": "array",
   "items": {
@@ -33,11 +57,74 @@ rt_records = {
   },
 }
 
-rt_output = {
+rt_series_output = {
     "type": "object",
     "properties": {
         "Rt": rt_records,
         "low90": rt_records,
         "high90": rt_records,
+        # only included for sigma estimation requests
+        "sigma": {"type": "number"},
+    },
+}
+
+# compact alternative to rt_series_output: each value array lines up with `dates`
+rt_series_columns_output = {
+    "type": "object",
+    "properties": {
+        "dates": rt_series["properties"]["dates"],
+        "Rt": number_array,
+        "low90": number_array,
+        "high90": number_array,
+        # only included for sigma estimation requests
+        "sigma": {"type": "number"},
     },
-}
\ No newline at end of file
+    "required": ["dates", "Rt", "low90", "high90"],
+}
+
+rt_error = {
+    "type": "object",
+    "properties": {
+        "error": {"type": "string"},
+    },
+    "required": ["error"],
+}
+
+rt_grid = {
+    "type": "object",
+    "properties": {
+        "min": {"type": "number"},
+        "max": {"type": "number"},
+        "step": {"type": "number"},
+        "points": {"type": "integer"},
+        "coarseStep": {"type": "number"},
+    },
+}
+
+rt_response_options = {
+    "type": "object",
+    "properties": {
+        # only included for adaptive grid requests
+        "grid": rt_grid,
+        # only included for checkpoint requests
+        "checkpoint": {"type": "string"},
+        "checkpointStatus": {
+            "type": "string",
+            "enum": ["created", "resumed", "invalidated"],
+        },
+        # batch mode: facility id => results or error
+        "facilities": {
+            "type": "object",
+            "additionalProperties": {
+                "anyOf": [rt_error, rt_series_output, rt_series_columns_output],
+            },
+        },
+    },
+}
+
+rt_output = {
+    "anyOf": [
+        {"allOf": [rt_series_output, rt_response_options]},
+        {"allOf": [rt_series_columns_output, rt_response_options]},
+    ],
+}
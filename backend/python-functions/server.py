@@ -0,0 +1,156 @@
+"""
+    Serves all of the functions in main.py from one long-running WSGI app,
+    for self-hosting the R(t) API under sustained load:
+
+        python server.py --port 8080 --workers 4
+
+    - POST /calculate_rt takes the same requests as the Cloud Function, and
+      runs them on a pool of worker processes, one per core by default.
+      Each worker imports and warms up the R(t) engine when it starts, so
+      no request pays for a cold start. Each worker has its own rt_cache.
+    - POST /ingest_covid_case_data and /ingest_facility_metadata take the
+      bucket and name of a Cloud Storage object, like the storage event
+      that triggers the Cloud Functions, and run one ingest at a time on a
+      separate worker process, so ingests don't hold up R(t) requests.
+
+    See bench_server.py to load test it.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import os
+import time
+import traceback
+
+import flask
+from werkzeug.test import EnvironBuilder
+
+from helpers import dumps_json
+import main
+
+log = logging.getLogger("cloudLogger")
+
+INGEST_FUNCTIONS = ['ingest_covid_case_data', 'ingest_facility_metadata']
+
+# request headers passed on to the functions
+FORWARDED_HEADERS = ['Content-Type', 'Function-Execution-Id']
+
+WARM_UP_REQUEST = {
+    'dates': [f'2020-04-{day:02d}' for day in range(1, 31)],
+    'cases': [10 * day for day in range(1, 31)],
+}
+
+
+def build_request(method, body, headers):
+    """ Flask request with the given method, body and headers, outside of the app """
+    return flask.Request(EnvironBuilder(method=method, data=body, headers=headers).get_environ())
+
+
+def warm_up_rt_worker():
+    """
+    Runs on each R(t) worker as it starts: calculate_rt requests with a
+    fixed and an estimated sigma build the R(t) engine's cached kernels and
+    finish the lazy imports of its libraries.
+    """
+    for options in [{}, {'estimateSigma': True}]:
+        body = dumps_json({**WARM_UP_REQUEST, **options})
+        main.calculate_rt(build_request('POST', body, {'Content-Type': 'application/json'}))
+
+
+def warm_up_ingest_worker():
+    import data_ingest  # noqa: F401
+
+
+def handle_calculate_rt(method, body, headers):
+    """ Runs on a worker; returns the (body, status, headers) of the response """
+    return main.calculate_rt(build_request(method, body, headers))
+
+
+def handle_ingest(function_name, event):
+    getattr(main, function_name)(event, None)
+
+
+def start_pool(max_workers, initializer):
+    """
+    Starts a process pool with all of its workers running, and waits until
+    each has run `initializer`.
+    """
+    pool = ProcessPoolExecutor(max_workers=max_workers, initializer=initializer)
+    # workers are otherwise started on demand; a worker is busy with
+    # `initializer` until it can run a task, so each of these starts one
+    for future in [pool.submit(os.getpid) for _ in range(max_workers)]:
+        future.result()
+    return pool
+
+
+def create_app(rt_pool=None, ingest_pool=None):
+    """
+    Flask app serving the functions. Requests run on the given process
+    pools, or in the server process if they are None.
+    """
+    app = flask.Flask(__name__)
+
+    def run(pool, f, *args):
+        if pool is None:
+            return f(*args)
+        return pool.submit(f, *args).result()
+
+    @app.route('/calculate_rt', methods=['POST', 'OPTIONS'])
+    def calculate_rt():
+        request = flask.request
+        if request.method == 'OPTIONS':
+            return main.calculate_rt(request)
+
+        start = time.perf_counter()
+        headers = [(name, request.headers[name])
+                   for name in FORWARDED_HEADERS if name in request.headers]
+        body, status, response_headers = run(
+            rt_pool, handle_calculate_rt, request.method, request.get_data(), headers)
+
+        # the function's own timing, plus the round trip to the worker
+        response_headers['Server-Timing'] += \
+            f', dispatch;dur={1000 * (time.perf_counter() - start):.1f}'
+        return body, status, response_headers
+
+    def ingest_view(function_name):
+        def ingest():
+            event = flask.request.get_json(silent=True)
+            if not isinstance(event, dict) or 'bucket' not in event or 'name' not in event:
+                return dumps_json({'error': 'Expected an object with a bucket and name'}), 400
+
+            try:
+                run(ingest_pool, handle_ingest, function_name,
+                    {'bucket': event['bucket'], 'name': event['name']})
+            except Exception as e:
+                log.error("Error in %s: %s", function_name, traceback.format_exc())
+                return dumps_json({'error': str(e)}), 500
+            return '', 204
+
+        return ingest
+
+    for function_name in INGEST_FUNCTIONS:
+        app.add_url_rule('/' + function_name, function_name, ingest_view(function_name),
+                         methods=['POST'])
+
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Serve calculate_rt and the ingest functions from one local server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of processes computing R(t)")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    rt_pool = start_pool(args.workers, warm_up_rt_worker)
+    ingest_pool = start_pool(1, warm_up_ingest_worker)
+    try:
+        # one thread per connection; each waits on the pools
+        create_app(rt_pool, ingest_pool).run(args.host, args.port, threaded=True)
+    finally:
+        rt_pool.shutdown()
+        ingest_pool.shutdown()
@@ -1,16 +1,159 @@
 import datetime
+from collections import defaultdict
 from flask import json
+import gzip
+import hashlib
+import jsonschema
 import logging
-from unittest import TestCase
-from unittest.mock import Mock
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import skipUnless, TestCase
+from unittest.mock import Mock, patch
+import numpy as np
+import pandas as pd
+from scipy import stats as sps
 
+import bench_ingest
+import bench_rt
+import bench_server
+import data_ingest
+import helpers
+from helpers import cloudfunction, ResultCache
+import main
 from main import calculate_rt
+import realtime_rt
+import schemas
+import server
+import timing
+from testing_fakes import FakeFirestoreClient, FakeStorageClient, LocalDirectoryBucket
 
 logging.disable(logging.CRITICAL)
 
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+def reference_get_posteriors(sr, sigma=0.15):
+    """
+    The original DataFrame-based implementation of get_posteriors, kept as
+    a reference for regression tests of the optimized engine.
+    """
+    R_T_MAX = 12
+    r_t_range = np.linspace(0, R_T_MAX, R_T_MAX*100+1)
+    GAMMA = 1/7
+
+    lam = sr[:-1].values * np.exp(GAMMA * (r_t_range[:, None] - 1))
+
+    likelihoods = pd.DataFrame(
+        data = sps.poisson.pmf(sr[1:].values, lam),
+        index = r_t_range,
+        columns = sr.index[1:])
+
+    process_matrix = sps.norm(loc=r_t_range,
+                              scale=sigma
+                             ).pdf(r_t_range[:, None])
+    process_matrix /= process_matrix.sum(axis=0)
+
+    prior0 = np.ones_like(r_t_range)/len(r_t_range)
+    prior0 /= prior0.sum()
+
+    posteriors = pd.DataFrame(
+        index=r_t_range,
+        columns=sr.index,
+        data={sr.index[0]: prior0}
+    )
+
+    log_likelihood = 0.0
+
+    for previous_day, current_day in zip(sr.index[:-1], sr.index[1:]):
+        current_prior = process_matrix @ posteriors[previous_day]
+        numerator = likelihoods[current_day] * current_prior
+        denominator = np.sum(numerator)
+        posteriors[current_day] = numerator/denominator
+        log_likelihood += np.log(denominator)
+
+    return posteriors, log_likelihood
+
+
+def reference_highest_density_interval(pmf, p=.9):
+    """
+    The original quadratic implementation of highest_density_interval,
+    kept as a reference for regression tests.
+    """
+    if(isinstance(pmf, pd.DataFrame)):
+        return pd.DataFrame([reference_highest_density_interval(pmf[col], p=p) for col in pmf],
+                            index=pmf.columns)
+
+    cumsum = np.cumsum(pmf.values)
+    total_p = cumsum - cumsum[:, None]
+    lows, highs = (total_p > p).nonzero()
+    best = (highs - lows).argmin()
+
+    low = pmf.index[lows[best]]
+    high = pmf.index[highs[best]]
+
+    return pd.Series([low, high],
+                     index=[f'Low_{p*100:.0f}',
+                            f'High_{p*100:.0f}'])
+
+
+def reference_compute_r_t(historical_case_counts):
+    """ The original compute_r_t pipeline built on the reference functions. """
+    smoothed = realtime_rt.prepare_case_series(historical_case_counts)
+    posteriors, _ = reference_get_posteriors(smoothed, sigma=.25)
+    hdis = reference_highest_density_interval(posteriors, p=.9)
+    most_likely = posteriors.idxmax().rename('ML')
+    result = pd.concat([most_likely, hdis], axis=1).iloc[1:]
+    return result.rolling(7, win_type='gaussian',
+                          min_periods=1, center=True).mean(std=2).round(2)
+
+
+def get_logged_metrics(log):
+    """ The structured records passed to a mocked logger by timing.invocation """
+    return [json.loads(call[0][1]) for call in log.info.call_args_list
+            if call[0][0] == "Invocation metrics: %s"]
+
+
+def build_case_counts(cases, start=datetime.datetime(2020, 4, 1)):
+    return {
+        'dates': [(start + datetime.timedelta(days=x)).strftime('%Y-%m-%d')
+                  for x in range(len(cases))],
+        'cases': list(cases),
+    }
+
+
+# a mix of short, long, flat, fast-growing and spiking cumulative series
+REGRESSION_CASE_COUNTS = [
+    {'dates': ['2020-04-15', '2020-04-16', '2020-04-18', '2020-04-19'],
+     'cases': [30, 50, 90, 150]},
+    {'dates': ['2020-04-15', '2020-04-16', '2020-04-18', '2020-04-19'],
+     'cases': [5, 6, 6, 12]},
+    build_case_counts([0] * 50 + [120] * 50),
+    build_case_counts(np.cumsum(np.random.RandomState(0).poisson(8, 60))),
+    build_case_counts(np.cumsum(np.random.RandomState(1).poisson(
+        np.linspace(1, 40, 200)))),
+    build_case_counts(np.cumsum(np.random.RandomState(2).poisson(
+        np.concatenate([np.linspace(2, 60, 40), np.linspace(60, 3, 80)])))),
+    # one large day between small ones, where the prior far from the
+    # posterior's peak decides the next days
+    build_case_counts(np.cumsum([2] * 20 + [800] + [3] * 20)),
+]
+
+# a sudden jump that makes every Poisson pmf underflow to 0 on the grid, so
+# the reference pipeline can't handle it (see test_large_counts)
+LARGE_JUMP_CASE_COUNTS = build_case_counts([1, 2, 3, 4, 5, 5000, 10000, 15000])
+
+
 class TestCalculateRt(TestCase):
     def setUp(self):
         self.req = Mock(get_json=Mock())
+        main.rt_cache = ResultCache("Rt", max_size=1024, ttl_seconds=60 * 60)
 
     def verify_response_data(self, response, expected_dates):
         for metric in ['Rt', 'low90', 'high90']:
@@ -126,3 +269,1463 @@ class TestCalculateRt(TestCase):
 
         # the earliest date should not be present in the response
         self.verify_response_data(resp, data['dates'][1:])
+
+    def test_batch(self):
+        data = {
+            'facilities': {
+                'a': {
+                    'dates': ['2020-04-15', '2020-04-16', '2020-04-18', '2020-04-19'],
+                    'cases': [30, 50, 90, 150]
+                },
+                'b': {
+                    'dates': ['2020-04-10', '2020-04-11', '2020-04-12', '2020-04-13',
+                              '2020-04-14', '2020-04-15'],
+                    'cases': [5, 6, 6, 12, 20, 31]
+                },
+                # not cumulative
+                'c': {
+                    'dates': ['2020-04-15', '2020-04-16', '2020-04-18', '2020-04-19'],
+                    'cases': [50, 66, 20, 129]
+                },
+                'd': {
+                    'dates': [],
+                    'cases': []
+                },
+            }
+        }
+        self.req.get_json.return_value = data
+
+        resp = self.get_response_json()
+        self.assertNotIn('error', resp)
+        facilities = resp['facilities']
+        self.assertEqual(set(facilities), set(data['facilities']))
+
+        self.verify_response_data(facilities['a'], data['facilities']['a']['dates'][1:])
+        self.verify_response_data(facilities['b'], data['facilities']['b']['dates'][1:])
+        self.assertIn('error', facilities['c'])
+        self.assertIn('error', facilities['d'])
+
+        # every series gets the same result it would get on its own
+        for facility_id in ['a', 'b']:
+            self.req.get_json.return_value = data['facilities'][facility_id]
+            single_resp = self.get_response_json()
+            for metric in ['Rt', 'low90', 'high90']:
+                self.assertEqual(facilities[facility_id][metric], single_resp[metric])
+
+    def test_batch_chunking(self):
+        facilities = {
+            str(i): build_case_counts([x * (i + 1) for x in range(10 + 7 * i)])
+            for i in range(5)
+        }
+
+        with patch.object(realtime_rt, 'BATCH_MAX_CELLS', 100000):
+            results = realtime_rt.compute_r_t_batch(facilities)
+
+        self.assertEqual(list(results), list(facilities))
+        for facility_id, case_counts in facilities.items():
+            pd.testing.assert_frame_equal(results[facility_id],
+                                          realtime_rt.compute_r_t(case_counts))
+
+
+    def test_batch_matches_single_series(self):
+        case_counts_by_id = {str(i): case_counts for i, case_counts
+                             in enumerate(REGRESSION_CASE_COUNTS + [LARGE_JUMP_CASE_COUNTS])}
+
+        results = realtime_rt.compute_r_t_batch(case_counts_by_id)
+        for series_id, case_counts in case_counts_by_id.items():
+            pd.testing.assert_frame_equal(results[series_id],
+                                          realtime_rt.compute_r_t(case_counts))
+
+    def test_responses_match_output_schema(self):
+        # calculate_rt trusts its own output, so check it here instead
+        a = build_case_counts([0] * 10 + list(range(5, 100, 5)))
+        bad = {'dates': ['2020-04-15', '2020-04-16'], 'cases': [5, 2]}
+        requests = [
+            a,
+            dict(a, adaptiveGrid=True),
+            dict(a, estimateSigma=True),
+            dict(a, includeCheckpoint=True),
+            {'facilities': {'a': a, 'bad': bad}},
+            {'facilities': {'a': a}, 'estimateSigma': True},
+            dict(a, responseFormat='columns'),
+            dict(a, responseFormat='columns', adaptiveGrid=True),
+            dict(a, responseFormat='columns', estimateSigma=True),
+            dict(a, responseFormat='columns', includeCheckpoint=True),
+            {'facilities': {'a': a, 'bad': bad}, 'responseFormat': 'columns'},
+        ]
+        validator = jsonschema.Draft7Validator(schemas.rt_output)
+        for data in requests:
+            self.req.get_json.return_value = data
+            resp = self.get_response_json()
+            self.assertNotIn('error', resp)
+            validator.validate(resp)
+
+        # value arrays without their dates
+        with self.assertRaises(jsonschema.ValidationError):
+            validator.validate({'Rt': [1.0], 'low90': [.5], 'high90': [1.5]})
+
+    def test_columns_format(self):
+        data = build_case_counts([0] * 10 + list(range(5, 100, 5)))
+        self.req.get_json.return_value = data
+        records = self.get_response_json()
+        self.req.get_json.return_value = dict(data, responseFormat='columns')
+        columns = self.get_response_json()
+
+        self.assertEqual(set(columns), {'dates', 'Rt', 'low90', 'high90'})
+        self.assertEqual(columns['dates'], data['dates'][1:])
+        for metric in ['Rt', 'low90', 'high90']:
+            self.assertEqual([record['date'] for record in records[metric]], columns['dates'])
+            self.assertEqual([record['value'] for record in records[metric]], columns[metric])
+
+        # the format is part of the cache key
+        self.req.get_json.return_value = data
+        self.assertEqual(self.get_response_json(), records)
+
+
+class TestRtCache(TestCase):
+    def setUp(self):
+        main.rt_cache = ResultCache("Rt", max_size=1024, ttl_seconds=60 * 60)
+
+    def calculate(self, data):
+        (response_body, _, _) = calculate_rt(Mock(get_json=Mock(return_value=data)))
+        return json.loads(response_body)
+
+    def test_equivalent_inputs_share_entries(self):
+        with patch.object(main, 'compute_r_t', wraps=realtime_rt.compute_r_t) as compute:
+            first = self.calculate({
+                'dates': ['2020-04-15', '2020-04-16', '2020-04-18', '2020-04-19'],
+                'cases': [30, 50, 90, 150],
+            })
+            # same series in a different order, with float case counts
+            second = self.calculate({
+                'dates': ['2020-04-18', '2020-04-15', '2020-04-19', '2020-04-16'],
+                'cases': [90.0, 30.0, 150.0, 50.0],
+            })
+            self.assertEqual(compute.call_count, 1)
+            self.assertEqual(first, second)
+
+            # the adaptive grid gives different results
+            self.calculate({
+                'dates': ['2020-04-15', '2020-04-16', '2020-04-18', '2020-04-19'],
+                'cases': [30, 50, 90, 150],
+                'adaptiveGrid': True,
+            })
+            self.assertEqual(compute.call_count, 2)
+
+        self.assertEqual((main.rt_cache.hits, main.rt_cache.misses), (1, 2))
+
+    def test_errors_are_not_cached(self):
+        data = {
+            'dates': ['2020-04-15', '2020-04-16', '2020-04-18', '2020-04-19'],
+            'cases': [50, 66, 20, 129]
+        }
+        self.assertIn('error', self.calculate(data))
+        self.assertIn('error', self.calculate(data))
+        self.assertEqual(main.rt_cache.hits, 0)
+
+    def test_batch_uses_cache(self):
+        a = {
+            'dates': ['2020-04-15', '2020-04-16', '2020-04-18', '2020-04-19'],
+            'cases': [30, 50, 90, 150],
+        }
+        b = build_case_counts([5, 6, 6, 12, 20, 31])
+        single = self.calculate(a)
+
+        with patch.object(main, 'compute_r_t_batch',
+                          wraps=realtime_rt.compute_r_t_batch) as compute_batch:
+            resp = self.calculate({'facilities': {'a': a, 'b': b}})
+            self.assertEqual(list(compute_batch.call_args[0][0]), ['b'])
+            self.assertEqual(resp['facilities']['a'], single)
+
+            self.calculate({'facilities': {'a': a, 'b': b}})
+            self.assertEqual(list(compute_batch.call_args[0][0]), [])
+
+    def test_lookups_are_reported_once_per_invocation(self):
+        facilities = {str(i): build_case_counts([5, 6, 6, 12, 20, 31 + i]) for i in range(3)}
+        self.calculate({'facilities': facilities})
+
+        with patch.object(helpers, 'log') as log:
+            self.calculate({'facilities': {**facilities, '3': build_case_counts([1, 2, 4, 8])}})
+
+        [metrics] = get_logged_metrics(log)
+        self.assertEqual((metrics['rtCacheHits'], metrics['rtCacheMisses']), (3, 1))
+        self.assertEqual(metrics['rtCacheSize'], 4)
+        # no log line per lookup
+        self.assertEqual(log.info.call_count, 3)
+
+
+class TestResultCache(TestCase):
+    def test_lru_eviction(self):
+        cache = ResultCache("test", max_size=2, ttl_seconds=60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+
+        self.assertEqual(cache.get('a'), (True, 1))
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('c'), (True, 3))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_ttl(self):
+        cache = ResultCache("test", max_size=2, ttl_seconds=60)
+        with patch('helpers.time.monotonic', return_value=1000):
+            cache.put('a', 1)
+        with patch('helpers.time.monotonic', return_value=1059):
+            self.assertEqual(cache.get('a'), (True, 1))
+        with patch('helpers.time.monotonic', return_value=1061):
+            self.assertEqual(cache.get('a'), (False, None))
+
+    def test_concurrent_computations_are_shared(self):
+        cache = ResultCache("test", max_size=2, ttl_seconds=60)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'value'
+
+        results = []
+        first = threading.Thread(target=lambda: results.append(cache.get_or_compute('a', compute)))
+        first.start()
+        started.wait(5)
+        second = threading.Thread(target=lambda: results.append(cache.get_or_compute('a', compute)))
+        second.start()
+        for _ in range(500):
+            if cache.shared:
+                break
+            time.sleep(.01)
+        release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(results, ['value', 'value'])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.get_or_compute('a', compute), 'value')
+        self.assertEqual(len(calls), 1)
+
+    def test_exceptions_propagate(self):
+        cache = ResultCache("test", max_size=2, ttl_seconds=60)
+
+        def compute():
+            raise ValueError('bad input')
+
+        with self.assertRaises(ValueError):
+            cache.get_or_compute('a', compute)
+        self.assertEqual(cache.get_or_compute('a', lambda: 'value'), 'value')
+
+
+class TestCloudFunction(TestCase):
+    def test_validators_are_built_once(self):
+        with patch.object(jsonschema, 'Draft7Validator', wraps=jsonschema.Draft7Validator) as validator:
+            f = cloudfunction(in_schema=schemas.rt_input, out_schema=schemas.rt_output)(
+                lambda request_json: {'Rt': []})
+            self.assertEqual(validator.call_count, 2)
+            for _ in range(3):
+                f(Mock(get_json=Mock(return_value={'dates': [], 'cases': []})))
+            self.assertEqual(validator.call_count, 2)
+
+    def test_output_validation(self):
+        def f(request_json):
+            return {'Rt': 'not a list'}
+
+        request = Mock(get_json=Mock(return_value={'dates': [], 'cases': []}))
+        (_, status, _) = cloudfunction(in_schema=schemas.rt_input, out_schema=schemas.rt_output)(f)(request)
+        self.assertEqual(status, 500)
+
+        (response_body, status, _) = cloudfunction(
+            in_schema=schemas.rt_input, out_schema=schemas.rt_output, trusted_output=True)(f)(request)
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(response_body), {'Rt': 'not a list'})
+
+    def test_numpy_values(self):
+        value = {'float': np.float64(1.25), 'int': np.int64(3), 'array': np.array([1.5, 2.0]),
+                 'nested': [{'value': np.float32(.5)}]}
+        expected = {'float': 1.25, 'int': 3, 'array': [1.5, 2.0], 'nested': [{'value': .5}]}
+        self.assertEqual(json.loads(helpers.dumps_json(value)), expected)
+
+        with patch.object(helpers, 'orjson', None):
+            self.assertEqual(json.loads(helpers.dumps_json(value)), expected)
+            with self.assertRaises(TypeError):
+                helpers.dumps_json({'value': object()})
+
+    def test_logged_bodies_are_truncated(self):
+        self.assertEqual(helpers.truncate_for_log('short'), 'short')
+
+        text = 'x' * (helpers.MAX_LOGGED_BODY_CHARS * 3)
+        logged = helpers.truncate_for_log(text)
+        self.assertLess(len(logged), helpers.MAX_LOGGED_BODY_CHARS + 50)
+        self.assertTrue(logged.endswith(f'... ({len(text)} chars)'))
+
+        # requests are abbreviated before they are formatted
+        request_json = {'dates': ['2020-04-15'] * 10000, 'cases': list(range(10000))}
+        self.assertLess(len(helpers.body_repr.repr(request_json)), 1000)
+
+
+class TestTiming(TestCase):
+    def test_phases(self):
+        timer = timing.PhaseTimer()
+        with timing.activate(timer):
+            with timing.phase('outer'):
+                # re-entering a phase doesn't count its time twice
+                with timing.phase('outer'):
+                    time.sleep(.01)
+                with timing.phase('inner'):
+                    pass
+            timing.add('rows', 2)
+            timing.add('rows', 3)
+            timing.record(seriesLength=7)
+
+        # no timer is current any more
+        with timing.phase('ignored'):
+            timing.add('rows')
+
+        self.assertEqual(list(timer.phases), ['outer', 'inner'])
+        self.assertGreaterEqual(timer.phases['outer'], .01)
+        self.assertLess(timer.phases['outer'], .5)
+        self.assertEqual(timer.metrics, {'rows': 5, 'seriesLength': 7})
+        self.assertRegex(timer.server_timing(),
+                         r'^outer;dur=[\d.]+, inner;dur=[\d.]+, total;dur=[\d.]+$')
+
+    def test_cloudfunction_metrics(self):
+        request = Mock(method='POST', headers={'Function-Execution-Id': 'abc'},
+                       get_json=Mock(return_value=build_case_counts([0] * 10 + list(range(5, 100, 5)))))
+        main.rt_cache = ResultCache("Rt", max_size=1024, ttl_seconds=60 * 60)
+
+        with patch.object(helpers, 'log') as log, patch.object(timing, '_cold_start', True):
+            (_, status, headers) = calculate_rt(request)
+            (_, _, cached_headers) = calculate_rt(request)
+            request.get_json.return_value = {'dates': ['2020-04-15'], 'cases': [1]}
+            (_, error_status, _) = calculate_rt(request)
+
+        self.assertEqual((status, error_status), (200, 500))
+        phases = [entry.split(';')[0] for entry in headers['Server-Timing'].split(', ')]
+        for name in ['validate_input', 'handler', 'prepare_cases', 'posteriors', 'hdi',
+                     'smoothing', 'build_response', 'validate_output', 'encode', 'log', 'total']:
+            self.assertIn(name, phases)
+        # cached responses skip the computation
+        self.assertNotIn('posteriors', cached_headers['Server-Timing'])
+
+        first, second, failed = get_logged_metrics(log)
+        self.assertEqual(first['function'], 'calculate_rt')
+        self.assertEqual(first['invocationId'], 'abc')
+        self.assertEqual(first['seriesLength'], 29)
+        self.assertEqual((first['coldStart'], second['coldStart']), (True, False))
+        self.assertEqual((first['status'], failed['status']), ('ok', 'error'))
+        self.assertIn('hdi', first['phasesMs'])
+
+
+class TestPosteriorEngine(TestCase):
+    def test_matches_reference_posteriors(self):
+        for case_counts in REGRESSION_CASE_COUNTS:
+            smoothed = realtime_rt.prepare_case_series(case_counts)
+
+            posteriors, log_likelihood = realtime_rt.get_posteriors(smoothed, sigma=.25,
+                                                                    banded=False)
+            expected, expected_log_likelihood = reference_get_posteriors(smoothed, sigma=.25)
+
+            # only rounding differences from computing the likelihood in log space
+            np.testing.assert_allclose(posteriors.values, expected.values.astype(float),
+                                       rtol=1e-9, atol=1e-15)
+            self.assertAlmostEqual(log_likelihood, expected_log_likelihood, places=9)
+
+    def test_banded_prior_matches_reference_posteriors(self):
+        for case_counts in REGRESSION_CASE_COUNTS:
+            smoothed = realtime_rt.prepare_case_series(case_counts)
+
+            posteriors, log_likelihood = realtime_rt.get_posteriors(smoothed, sigma=.25)
+            expected, expected_log_likelihood = reference_get_posteriors(smoothed, sigma=.25)
+
+            # the kernel's dropped tails (see PROCESS_KERNEL_TOLERANCE) show
+            # through at up to ~3e-11 on the days after a spike
+            np.testing.assert_allclose(posteriors.values, expected.values.astype(float),
+                                       rtol=0, atol=1e-10)
+            self.assertAlmostEqual(log_likelihood, expected_log_likelihood, places=8)
+
+    def test_process_kernel_matches_process_matrix(self):
+        process_matrix = realtime_rt.get_process_matrix(.25)
+        kernel, column_scale = realtime_rt.get_process_kernel(
+            .25, realtime_rt.r_t_range[1] - realtime_rt.r_t_range[0],
+            len(realtime_rt.r_t_range))
+
+        # the banded prior step of every basis vector is a column of the matrix
+        for column in [0, 1, 100, 600, 1199, 1200]:
+            basis = np.zeros(len(realtime_rt.r_t_range))
+            basis[column] = 1
+            np.testing.assert_allclose(
+                realtime_rt.apply_process_kernel(basis, kernel, column_scale),
+                process_matrix[:, column], rtol=0, atol=1e-15)
+
+        # warm calls reuse the cached kernel
+        self.assertIs(realtime_rt.get_process_kernel(
+            .25, realtime_rt.r_t_range[1] - realtime_rt.r_t_range[0],
+            len(realtime_rt.r_t_range))[0], kernel)
+
+    def test_log_poisson_likelihoods(self):
+        counts = np.array([1., 3., 40., 38., 2500., 2600.])
+        grid = realtime_rt.r_t_range
+
+        lam = counts[:-1, None] * np.exp(realtime_rt.GAMMA * (grid - 1))
+        np.testing.assert_allclose(realtime_rt.log_poisson_likelihoods(counts, grid),
+                                   sps.poisson.logpmf(counts[1:, None], lam),
+                                   rtol=1e-9)
+
+    def test_large_counts(self):
+        with self.assertRaises(ValueError):
+            reference_compute_r_t(LARGE_JUMP_CASE_COUNTS)
+
+        result = realtime_rt.compute_r_t(LARGE_JUMP_CASE_COUNTS)
+        self.assertFalse(result.isna().any().any())
+
+    def test_matches_reference_output(self):
+        for case_counts in REGRESSION_CASE_COUNTS:
+            pd.testing.assert_frame_equal(realtime_rt.compute_r_t(case_counts),
+                                          reference_compute_r_t(case_counts),
+                                          check_exact=True)
+
+
+class TestAdaptiveGrid(TestCase):
+    def test_matches_full_grid(self):
+        # includes large counts, where the windows are much narrower
+        case_counts_list = REGRESSION_CASE_COUNTS + [
+            build_case_counts(np.cumsum(np.random.RandomState(3).poisson(
+                np.concatenate([np.linspace(100, 900, 60), np.linspace(900, 50, 90)])))),
+        ]
+        for case_counts in case_counts_list:
+            full = realtime_rt.compute_r_t(case_counts)
+            adaptive = realtime_rt.compute_r_t(case_counts, adaptive_grid=True)
+
+            pd.testing.assert_frame_equal(adaptive, full, check_exact=False,
+                                          rtol=0, atol=.011)
+
+        grid = adaptive.attrs['grid']
+        self.assertEqual(grid['step'], .01)
+        self.assertEqual(grid['coarseStep'], .1)
+        self.assertLess(grid['points'], len(realtime_rt.r_t_range))
+
+    def test_falls_back_to_full_grid(self):
+        # a spike pulls the posterior into mass the windows dropped, and a
+        # sudden jump leaves no prior mass in them at all
+        for cases in [np.cumsum([2] * 20 + [800] + [3] * 20), [1, 2, 3, 4, 5, 5000, 10000, 15000]]:
+            case_counts = build_case_counts(cases)
+            adaptive = realtime_rt.compute_r_t(case_counts, adaptive_grid=True)
+
+            pd.testing.assert_frame_equal(adaptive, realtime_rt.compute_r_t(case_counts))
+            self.assertEqual(adaptive.attrs['grid']['points'], len(realtime_rt.r_t_range))
+            self.assertNotIn('coarseStep', adaptive.attrs['grid'])
+
+    def test_response_grid(self):
+        req = Mock(get_json=Mock(return_value={
+            'dates': ['2020-04-15', '2020-04-16', '2020-04-18', '2020-04-19'],
+            'cases': [30, 50, 90, 150],
+            'adaptiveGrid': True,
+        }))
+        (response_body, status, _) = calculate_rt(req)
+        resp = json.loads(response_body)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(len(resp['Rt']), 3)
+        self.assertEqual(resp['grid']['step'], .01)
+
+
+class TestSigmaEstimation(TestCase):
+    def test_stacked_sigmas_match_separate_runs(self):
+        # including large counts, where the likelihood reaches far into the
+        # tails of each prior
+        for case_counts in REGRESSION_CASE_COUNTS + [LARGE_JUMP_CASE_COUNTS]:
+            smoothed = realtime_rt.prepare_case_series(case_counts)
+            posteriors, log_likelihoods = realtime_rt.compute_posteriors(
+                smoothed.values, sigma=realtime_rt.SIGMA_CANDIDATES)
+
+            for i, sigma in enumerate(realtime_rt.SIGMA_CANDIDATES):
+                expected_posteriors, expected_log_likelihood = realtime_rt.compute_posteriors(
+                    smoothed.values, sigma=sigma)
+                np.testing.assert_allclose(posteriors[:, i], expected_posteriors,
+                                           rtol=0, atol=1e-12)
+                self.assertAlmostEqual(log_likelihoods[i], expected_log_likelihood, places=9)
+
+    def test_selects_maximum_likelihood_sigma(self):
+        for case_counts in REGRESSION_CASE_COUNTS:
+            smoothed = realtime_rt.prepare_case_series(case_counts)
+            log_likelihoods = [realtime_rt.compute_posteriors(smoothed.values, sigma=sigma)[1]
+                               for sigma in realtime_rt.SIGMA_CANDIDATES]
+            best_sigma = realtime_rt.SIGMA_CANDIDATES[np.argmax(log_likelihoods)]
+
+            result = realtime_rt.compute_r_t(case_counts, estimate_sigma=True)
+            self.assertEqual(result.attrs['sigma'], best_sigma)
+
+            posteriors, _ = realtime_rt.compute_posteriors(smoothed.values, sigma=best_sigma)
+            expected = realtime_rt.summarize_posteriors(posteriors, smoothed.index)
+            pd.testing.assert_frame_equal(result, expected)
+
+    def test_batch(self):
+        case_counts_by_id = {str(i): case_counts
+                             for i, case_counts in enumerate(REGRESSION_CASE_COUNTS)}
+        case_counts_by_id['invalid'] = {'dates': ['2020-04-15'], 'cases': [3]}
+
+        results = realtime_rt.compute_r_t_batch(case_counts_by_id, estimate_sigma=True)
+        self.assertIsInstance(results.pop('invalid'), ValueError)
+        for series_id, result in results.items():
+            expected = realtime_rt.compute_r_t(case_counts_by_id[series_id], estimate_sigma=True)
+            self.assertEqual(result.attrs['sigma'], expected.attrs['sigma'])
+            pd.testing.assert_frame_equal(result, expected, check_exact=False, rtol=0, atol=1e-9)
+
+    def test_candidates_are_chunked(self):
+        case_counts_by_id = {str(i): case_counts
+                             for i, case_counts in enumerate(REGRESSION_CASE_COUNTS)}
+        expected = realtime_rt.compute_r_t_batch(case_counts_by_id, estimate_sigma=True)
+
+        # room for one candidate of one series at a time
+        with patch.object(realtime_rt, 'BATCH_MAX_CELLS', 1), \
+                patch.object(realtime_rt, 'compute_posteriors',
+                             wraps=realtime_rt.compute_posteriors) as compute_posteriors:
+            results = realtime_rt.compute_r_t_batch(case_counts_by_id, estimate_sigma=True)
+            single = realtime_rt.compute_r_t(REGRESSION_CASE_COUNTS[0], estimate_sigma=True)
+
+        num_candidates = len(realtime_rt.SIGMA_CANDIDATES)
+        self.assertEqual(compute_posteriors.call_count, (len(case_counts_by_id) + 1) * num_candidates)
+        for series_id, result in results.items():
+            self.assertEqual(result.attrs['sigma'], expected[series_id].attrs['sigma'])
+            pd.testing.assert_frame_equal(result, expected[series_id])
+        pd.testing.assert_frame_equal(single, expected['0'], check_exact=False, rtol=0, atol=1e-9)
+
+    def test_response_sigma(self):
+        req = Mock(get_json=Mock(return_value={
+            'dates': ['2020-04-15', '2020-04-16', '2020-04-18', '2020-04-19'],
+            'cases': [30, 50, 90, 150],
+            'estimateSigma': True,
+        }))
+        (response_body, status, _) = calculate_rt(req)
+        resp = json.loads(response_body)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(len(resp['Rt']), 3)
+        self.assertIn(resp['sigma'], realtime_rt.SIGMA_CANDIDATES)
+
+
+class TestIncrementalRt(TestCase):
+    def setUp(self):
+        self.case_counts = build_case_counts(np.cumsum(np.random.RandomState(4).poisson(
+            np.concatenate([np.linspace(2, 50, 40), np.linspace(50, 5, 40)]))))
+
+    def slice_case_counts(self, start, end):
+        return {key: values[start:end] for key, values in self.case_counts.items()}
+
+    def test_resume_with_new_days(self):
+        result, checkpoint = realtime_rt.compute_r_t_incremental(self.slice_case_counts(0, 20))
+        self.assertEqual(result.attrs['checkpoint'], 'created')
+        pd.testing.assert_frame_equal(result, realtime_rt.compute_r_t(self.slice_case_counts(0, 20)),
+                                      check_exact=True)
+
+        # one day at a time, then several at once
+        for start, end in [(20, 21), (21, 22), (22, 30), (30, 31), (31, 80)]:
+            result, checkpoint = realtime_rt.compute_r_t_incremental(
+                self.slice_case_counts(start, end), checkpoint=checkpoint)
+
+            self.assertEqual(result.attrs['checkpoint'], 'resumed')
+            pd.testing.assert_frame_equal(result,
+                                          realtime_rt.compute_r_t(self.slice_case_counts(0, end)),
+                                          check_exact=True)
+
+        # checkpoints stay compact
+        self.assertLess(len(checkpoint), 16 * 1024)
+
+    def test_resume_with_full_history(self):
+        _, checkpoint = realtime_rt.compute_r_t_incremental(self.slice_case_counts(0, 40))
+        result, _ = realtime_rt.compute_r_t_incremental(self.slice_case_counts(0, 45),
+                                                        checkpoint=checkpoint)
+
+        self.assertEqual(result.attrs['checkpoint'], 'resumed')
+        pd.testing.assert_frame_equal(result, realtime_rt.compute_r_t(self.slice_case_counts(0, 45)),
+                                      check_exact=True)
+
+    def test_resume_without_new_days(self):
+        _, checkpoint = realtime_rt.compute_r_t_incremental(self.slice_case_counts(0, 40))
+
+        # e.g. the dashboard sending the same series again with its checkpoint
+        for start in [0, 39]:
+            result, _ = realtime_rt.compute_r_t_incremental(self.slice_case_counts(start, 40),
+                                                            checkpoint=checkpoint)
+            self.assertEqual(result.attrs['checkpoint'], 'resumed')
+            pd.testing.assert_frame_equal(result,
+                                          realtime_rt.compute_r_t(self.slice_case_counts(0, 40)),
+                                          check_exact=True)
+
+    def test_short_history(self):
+        # histories too short for any posterior to be settled
+        for end in [2, 3, 4]:
+            result, checkpoint = realtime_rt.compute_r_t_incremental(self.slice_case_counts(0, end))
+            pd.testing.assert_frame_equal(result,
+                                          realtime_rt.compute_r_t(self.slice_case_counts(0, end)),
+                                          check_exact=True)
+
+            result, _ = realtime_rt.compute_r_t_incremental(self.slice_case_counts(end, 10),
+                                                            checkpoint=checkpoint)
+            self.assertEqual(result.attrs['checkpoint'], 'resumed')
+            pd.testing.assert_frame_equal(result,
+                                          realtime_rt.compute_r_t(self.slice_case_counts(0, 10)),
+                                          check_exact=True)
+
+    def test_backfill_invalidates_checkpoint(self):
+        _, checkpoint = realtime_rt.compute_r_t_incremental(self.slice_case_counts(0, 40))
+
+        # a correction to a day the checkpoint has already seen
+        new_days = self.slice_case_counts(38, 45)
+        new_days['cases'][0] -= 1
+        result, checkpoint = realtime_rt.compute_r_t_incremental(new_days, checkpoint=checkpoint)
+
+        self.assertEqual(result.attrs['checkpoint'], 'invalidated')
+        expected_case_counts = self.slice_case_counts(0, 45)
+        expected_case_counts['cases'][38] -= 1
+        pd.testing.assert_frame_equal(result, realtime_rt.compute_r_t(expected_case_counts),
+                                      check_exact=True)
+
+        # the returned checkpoint covers the corrected history
+        result, _ = realtime_rt.compute_r_t_incremental(self.slice_case_counts(45, 46),
+                                                        checkpoint=checkpoint)
+        self.assertEqual(result.attrs['checkpoint'], 'resumed')
+
+    def test_response_checkpoint(self):
+        def calculate(data):
+            (response_body, _, _) = calculate_rt(Mock(get_json=Mock(return_value=data)))
+            return json.loads(response_body)
+
+        first = calculate(dict(self.slice_case_counts(0, 30), includeCheckpoint=True))
+        self.assertEqual(first['checkpointStatus'], 'created')
+
+        second = calculate(dict(self.slice_case_counts(30, 35), checkpoint=first['checkpoint']))
+        self.assertEqual(second['checkpointStatus'], 'resumed')
+        self.assertEqual([record['date'] for record in second['Rt']],
+                         self.case_counts['dates'][1:35])
+
+        short = calculate(dict(self.slice_case_counts(0, 3), includeCheckpoint=True))
+        self.assertEqual(short['checkpointStatus'], 'created')
+        self.assertEqual(len(short['Rt']), 2)
+
+    def test_invalid_checkpoint(self):
+        with self.assertRaises(ValueError):
+            realtime_rt.compute_r_t_incremental(self.slice_case_counts(0, 10),
+                                                checkpoint='not a checkpoint')
+
+
+class TestHighestDensityInterval(TestCase):
+    def test_matches_reference(self):
+        for case_counts in REGRESSION_CASE_COUNTS:
+            smoothed = realtime_rt.prepare_case_series(case_counts)
+            posteriors, _ = reference_get_posteriors(smoothed, sigma=.25)
+            posteriors = posteriors.astype(float)
+
+            pd.testing.assert_frame_equal(
+                realtime_rt.highest_density_interval(posteriors, p=.9),
+                reference_highest_density_interval(posteriors, p=.9),
+                check_exact=True)
+
+            day = posteriors.columns[-1]
+            pd.testing.assert_series_equal(
+                realtime_rt.highest_density_interval(posteriors[day], p=.5),
+                reference_highest_density_interval(posteriors[day], p=.5),
+                check_exact=True)
+
+    def test_matches_reference_on_sharp_posteriors(self):
+        # peaked posteriors put many cumulative sums within rounding of each other
+        rng = np.random.RandomState(0)
+        for _ in range(5):
+            pmf = rng.gamma(.2, size=(len(realtime_rt.r_t_range), 4)) ** 4
+            posteriors = pd.DataFrame(pmf / pmf.sum(axis=0), index=realtime_rt.r_t_range)
+
+            pd.testing.assert_frame_equal(
+                realtime_rt.highest_density_interval(posteriors, p=.9),
+                reference_highest_density_interval(posteriors, p=.9),
+                check_exact=True)
+
+    def test_degenerate_posteriors(self):
+        pmf = np.ones((3, 10)) / 10
+        # all of the mass in the first bin: no interval encloses more than p
+        pmf[1] = 0
+        pmf[1, 0] = 1
+        with self.assertRaises(ValueError):
+            realtime_rt.highest_density_intervals(pmf, p=.9)
+
+        pmf[1] = np.nan
+        with self.assertRaises(ValueError):
+            realtime_rt.highest_density_intervals(pmf, p=.9)
+
+
+class FakeFirestoreTestCase(TestCase):
+    """
+        Points data_ingest at an in-memory Firestore for each test.
+    """
+    def setUp(self):
+        self.fs_client = FakeFirestoreClient()
+        self.storage_client = FakeStorageClient()
+        patchers = [
+            patch.object(data_ingest, 'get_firestore_client', return_value=self.fs_client),
+            patch.object(data_ingest, 'get_storage_client', return_value=self.storage_client),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write_json_lines_file(self, rows):
+        fd, file_location = tempfile.mkstemp(suffix='.jsonl')
+        with os.fdopen(fd, 'w') as f:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+        self.addCleanup(os.remove, file_location)
+        return file_location
+
+
+class TestFacilityMetadataIngest(FakeFirestoreTestCase):
+    def test_create_or_update_facilities(self):
+        existing_metadata = {
+            'createdAt': datetime.datetime(2020, 5, 1, tzinfo=datetime.timezone.utc),
+            'canonicalName': 'Example Jail',
+            'stateName': 'Alabama',
+            'facilityType': 'County Jail',
+            'capacity': 100,
+            'population': [{'date': datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc),
+                            'value': 90}],
+        }
+        self.fs_client.documents['reference_facilities/1'] = dict(existing_metadata)
+        self.fs_client.documents['reference_facilities/2'] = dict(existing_metadata)
+
+        row = {'facility_name': 'Example Jail', 'state': 'Alabama',
+               'facility_type': 'County Jails', 'capacity': '100',
+               'population_year_updated': '2019', 'population': '90'}
+        file_location = self.write_json_lines_file([
+            dict(row, facility_id='1'),
+            dict(row, facility_id='2', population_year_updated='2020', population='80'),
+            dict(row, facility_id='3'),
+        ])
+
+        with patch.object(data_ingest, 'GET_ALL_CHUNK_SIZE', 2):
+            data_ingest.create_or_update_facilities(file_location)
+
+        # one read per chunk; the unchanged facility is not rewritten
+        self.assertEqual(self.fs_client.reads, 2)
+        self.assertEqual(self.fs_client.commits, [2])
+
+        self.assertEqual(self.fs_client.documents['reference_facilities/1'], existing_metadata)
+        self.assertEqual(self.fs_client.documents['reference_facilities/2']['population'], [
+            {'date': datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc), 'value': 90},
+            {'date': datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc), 'value': 80},
+        ])
+        self.assertIsInstance(self.fs_client.documents['reference_facilities/3']['createdAt'],
+                              datetime.datetime)
+
+
+class TestFirestoreBatch(FakeFirestoreTestCase):
+    def build_client(self, commit_side_effects):
+        batches = [Mock(commit=Mock(side_effect=side_effect)) for side_effect in commit_side_effects]
+        # plus an empty batch to start after the final commit
+        return Mock(batch=Mock(side_effect=batches + [Mock()])), batches
+
+    def test_save_case_data_packs_batches(self):
+        self.fs_client.documents['reference_facilities/1'] = {'capacity': 10}
+        start = datetime.datetime(2020, 4, 1)
+        facilities = {
+            facility_id: {(start + datetime.timedelta(days=x)).strftime('%Y-%m-%d'):
+                          {'popTestedPositive': x} for x in range(200)}
+            for facility_id in ['1', '2', '3']
+        }
+        data_ingest.save_case_data(facilities)
+
+        # facility docs, manifests and series docs
+        self.assertEqual(self.fs_client.reads, 3)
+        # 600 case docs plus 2 new facility docs, packed into full batches,
+        # then 7 months of series docs for each facility, then the 3 manifests
+        self.assertEqual(len(self.fs_client.commits), 4)
+        self.assertEqual(sum(self.fs_client.commits[:2]), 602)
+        self.assertEqual(self.fs_client.commits[2:], [21, 3])
+        self.assertEqual(self.fs_client.documents['reference_facilities/1'], {'capacity': 10})
+        self.assertEqual(
+            self.fs_client.documents['reference_facilities/3/covidCases/2020-04-10'],
+            {'popTestedPositive': 9})
+
+    def test_retries_transient_errors(self):
+        unavailable = data_ingest.api_exceptions.ServiceUnavailable('unavailable')
+        client, batches = self.build_client([[unavailable, unavailable, ['result']]])
+
+        with patch.object(data_ingest.time, 'sleep') as sleep:
+            batch = data_ingest.FirestoreBatch(client, max_workers=2)
+            batch.set('ref', {})
+            batch.commit()
+
+        self.assertEqual(batches[0].commit.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_reports_first_failed_batch(self):
+        client, batches = self.build_client([
+            [['result']],
+            [ValueError('batch 2')],
+            [ValueError('batch 3')],
+            [['result']],
+        ])
+        with patch.object(data_ingest.FirestoreBatch, 'MAX_BATCH_SIZE', 2):
+            batch = data_ingest.FirestoreBatch(client, max_workers=4, max_in_flight=1)
+            for _ in range(5):
+                batch.set('ref', {})
+            with self.assertRaisesRegex(ValueError, 'batch 2'):
+                batch.commit()
+
+        for mock_batch in batches[:3]:
+            mock_batch.commit.assert_called_once()
+
+
+class TestRtIngest(FakeFirestoreTestCase):
+    def test_build_rt_case_counts(self):
+        case_counts = data_ingest.build_rt_case_counts({
+            '2020-04-02': {'popTestedPositive': 3, 'staffTestedPositive': 2},
+            '2020-04-01': {'popTestedPositive': 1},
+            '2020-04-03': {'popDeaths': 1},
+            '2020-04-04': {'staffTestedPositive': 7},
+        })
+        self.assertEqual(case_counts, {
+            'dates': ['2020-04-01', '2020-04-02', '2020-04-04'],
+            'cases': [1, 5, 7],
+        })
+
+    def test_ingest_writes_rt(self):
+        pop_cases = np.cumsum(np.random.RandomState(0).poisson(6, 40))
+        staff_cases = np.cumsum(np.random.RandomState(1).poisson(2, 40))
+        rows = []
+        for x in range(40):
+            date = (datetime.datetime(2020, 4, 1) + datetime.timedelta(days=x)).strftime('%Y-%m-%d')
+            rows.append({'facility_id': '510', 'date': date,
+                         'pop_tested_positive': str(pop_cases[x]),
+                         'staff_tested_positive': str(staff_cases[x])})
+        # too little data to compute R(t) for this one
+        rows.append({'facility_id': '516', 'date': '2020-04-01', 'pop_tested_positive': '1'})
+
+        file_location = self.write_json_lines_file(rows)
+        with patch.object(data_ingest, 'download_from_cloud_storage',
+                          return_value=file_location):
+            data_ingest.ingest_daily_covid_case_data('bucket', 'cases.jsonl')
+
+        expected = realtime_rt.compute_r_t(
+            build_case_counts(pop_cases + staff_cases))
+        rt_docs = {path.split('/')[-1]: doc for path, doc in self.fs_client.documents.items()
+                   if path.startswith('reference_facilities/510/rt/')}
+        self.assertEqual(sorted(rt_docs), [day.strftime('%Y-%m-%d') for day in expected.index])
+        for day, row in expected.iterrows():
+            self.assertEqual(rt_docs[day.strftime('%Y-%m-%d')], {
+                'Rt': row['ML'], 'low90': row['Low_90'], 'high90': row['High_90']})
+
+        self.assertIn('reference_facilities/516/covidCases/2020-04-01', self.fs_client.documents)
+        self.assertFalse(any(path.startswith('reference_facilities/516/rt/')
+                             for path in self.fs_client.documents))
+
+    def test_skips_unchanged_rt_days(self):
+        cases = np.cumsum(np.random.RandomState(0).poisson(6, 60))
+        rt_by_facility = data_ingest.compute_rt_data({'510': {
+            (datetime.datetime(2020, 4, 1) + datetime.timedelta(days=x)).strftime('%Y-%m-%d'):
+                {'popTestedPositive': int(cases[x])}
+            for x in range(60)
+        }})
+        self.assertEqual(data_ingest.save_rt_data(rt_by_facility), (59, 0))
+        self.assertEqual(len(self.fs_client.documents['covid_case_manifests/510']['rtHashes']), 59)
+
+        # a new day only changes the smoothed values of the last few
+        cases = np.append(cases, cases[-1] + 40)
+        rt_by_facility = data_ingest.compute_rt_data({'510': {
+            (datetime.datetime(2020, 4, 1) + datetime.timedelta(days=x)).strftime('%Y-%m-%d'):
+                {'popTestedPositive': int(cases[x])}
+            for x in range(61)
+        }})
+        written, skipped = data_ingest.save_rt_data(rt_by_facility)
+        self.assertEqual(written + skipped, 60)
+        self.assertLess(written, 10)
+        self.assertEqual(self.fs_client.documents['reference_facilities/510/rt/2020-05-30'],
+                         rt_by_facility['510']['2020-05-30'])
+
+        self.assertEqual(data_ingest.save_rt_data(rt_by_facility), (0, 60))
+
+
+def build_streaming_case_rows():
+    rows = []
+    for i, facility_id in enumerate(['1', '2', '3', '4', '5']):
+        cases = np.cumsum(np.random.RandomState(i).poisson(5, 30))
+        for x in range(30):
+            date = (datetime.datetime(2020, 4, 1) + datetime.timedelta(days=x)).strftime('%Y-%m-%d')
+            rows.append({'facility_id': facility_id, 'date': date,
+                         'pop_tested_positive': str(cases[x]), 'pop_deaths': '0'})
+    # move the last few days of one facility to the end of the file
+    rows.extend([rows.pop(50), rows.pop(50)])
+    return rows
+
+
+class TestStreamingIngest(FakeFirestoreTestCase):
+    def test_matches_full_download(self):
+        rows = build_streaming_case_rows()
+        blob = self.storage_client.get_bucket('bucket').blob('cases.jsonl')
+        blob.upload_from_string(''.join(json.dumps(row) + '\n' for row in rows))
+        self.fs_client.clock = lambda: datetime.datetime(2020, 5, 1, tzinfo=datetime.timezone.utc)
+
+        data_ingest.ingest_daily_covid_case_data('bucket', 'cases.jsonl')
+        expected_documents = self.fs_client.documents
+        self.fs_client.documents = {}
+
+        with patch.object(data_ingest, 'STREAM_CHUNK_BYTES', 1000), \
+                patch.object(data_ingest, 'STREAM_CHUNK_FACILITIES', 2):
+            data_ingest.ingest_daily_covid_case_data('bucket', 'cases.jsonl', streaming=True)
+
+        self.assertGreater(blob.range_reads, 10)
+        self.assertEqual(self.fs_client.documents, expected_documents)
+
+    def test_stream_lines(self):
+        blob = self.storage_client.get_bucket('bucket').blob('lines.jsonl')
+        blob.upload_from_string('first\nsecond line\n\nlast')
+
+        for chunk_bytes in [1, 3, 100]:
+            self.assertEqual(
+                list(data_ingest.stream_from_cloud_storage('bucket', 'lines.jsonl', chunk_bytes)),
+                [b'first', b'second line', b'', b'last'])
+
+
+class TestAsyncIngest(FakeFirestoreTestCase):
+    def upload_rows(self, rows):
+        blob = self.storage_client.get_bucket('bucket').blob('cases.jsonl')
+        blob.upload_from_string(''.join(json.dumps(row) + '\n' for row in rows))
+        return blob
+
+    def test_matches_full_download(self):
+        blob = self.upload_rows(build_streaming_case_rows())
+        self.fs_client.clock = lambda: datetime.datetime(2020, 5, 1, tzinfo=datetime.timezone.utc)
+
+        data_ingest.ingest_daily_covid_case_data('bucket', 'cases.jsonl')
+        expected_documents = self.fs_client.documents
+        self.fs_client.documents = {}
+
+        with patch.object(data_ingest, 'STREAM_CHUNK_BYTES', 1000), \
+                patch.object(data_ingest, 'STREAM_CHUNK_FACILITIES', 2):
+            data_ingest.ingest_daily_covid_case_data('bucket', 'cases.jsonl', asynchronous=True)
+
+        self.assertGreater(blob.range_reads, 10)
+        self.assertEqual(self.fs_client.documents, expected_documents)
+
+    def test_queues_are_bounded(self):
+        self.upload_rows(bench_ingest.generate_case_rows(20, 10))
+        parsed = []
+        saved = []
+        ahead = []
+        feed = data_ingest.CaseDataChunker.feed
+        save_rt = data_ingest.CaseDataWriter.save_rt
+
+        def counting_feed(chunker, lines):
+            chunks = feed(chunker, lines)
+            parsed.extend(chunks)
+            ahead.append(len(parsed) - len(saved))
+            return chunks
+
+        def counting_save_rt(writer, facilities):
+            save_rt(writer, facilities)
+            saved.append(facilities)
+
+        with patch.object(data_ingest, 'STREAM_CHUNK_BYTES', 100), \
+                patch.object(data_ingest, 'STREAM_CHUNK_FACILITIES', 1), \
+                patch.object(data_ingest, 'ASYNC_QUEUE_SIZE', 1), \
+                patch.object(data_ingest.CaseDataChunker, 'feed', counting_feed), \
+                patch.object(data_ingest.CaseDataWriter, 'save_rt', counting_save_rt):
+            data_ingest.ingest_daily_covid_case_data('bucket', 'cases.jsonl', asynchronous=True)
+
+        self.assertEqual(len(saved), 20)
+        # one chunk in each queue, one being saved and one being parsed
+        self.assertLessEqual(max(ahead), 5)
+
+    def test_stage_failure(self):
+        self.upload_rows(build_streaming_case_rows())
+
+        with patch.object(data_ingest, 'STREAM_CHUNK_BYTES', 1000), \
+                patch.object(data_ingest, 'STREAM_CHUNK_FACILITIES', 1), \
+                patch.object(data_ingest, 'compute_rt_data', side_effect=ValueError('bad series')):
+            with self.assertRaisesRegex(ValueError, 'bad series'):
+                data_ingest.ingest_daily_covid_case_data('bucket', 'cases.jsonl', asynchronous=True)
+
+
+class TestDeltaIngest(FakeFirestoreTestCase):
+    def test_skips_unchanged_days(self):
+        facilities = {
+            '1': {'2020-04-01': {'popTestedPositive': 1}, '2020-04-02': {'popTestedPositive': 2}},
+            '2': {'2020-04-01': {'popTestedPositive': 3, 'popDeaths': 0}},
+        }
+        self.assertEqual(data_ingest.save_case_data(facilities), (3, 0))
+        self.assertEqual(set(self.fs_client.documents['covid_case_manifests/1']['hashes']),
+                         {'2020-04-01', '2020-04-02'})
+
+        # same history plus a new day, and a revised day
+        facilities['1']['2020-04-03'] = {'popTestedPositive': 4}
+        facilities['2']['2020-04-01'] = {'popDeaths': 0, 'popTestedPositive': 5}
+        self.fs_client.commits = []
+        self.assertEqual(data_ingest.save_case_data(facilities), (2, 2))
+        # case docs, series docs and manifests
+        self.assertEqual(self.fs_client.commits, [2, 2, 2])
+
+        self.assertEqual(self.fs_client.documents['reference_facilities/1/covidCases/2020-04-03'],
+                         {'popTestedPositive': 4})
+        self.assertEqual(self.fs_client.documents['reference_facilities/2/covidCases/2020-04-01'],
+                         {'popDeaths': 0, 'popTestedPositive': 5})
+        self.assertEqual(set(self.fs_client.documents['covid_case_manifests/1']['hashes']),
+                         {'2020-04-01', '2020-04-02', '2020-04-03'})
+
+        self.assertEqual(data_ingest.save_case_data(facilities), (0, 4))
+
+    def test_failed_commit_leaves_manifest(self):
+        facilities = {'1': {'2020-04-01': {'popTestedPositive': 1}}}
+        with patch.object(data_ingest.FirestoreBatch, 'commit', side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                data_ingest.save_case_data(facilities)
+
+        self.assertNotIn('covid_case_manifests/1', self.fs_client.documents)
+        self.assertEqual(data_ingest.save_case_data(facilities), (1, 0))
+
+
+class TestCaseSeries(FakeFirestoreTestCase):
+    def get_series(self, facility_id):
+        prefix = f'reference_facilities/{facility_id}/covidCaseSeries/'
+        return {path[len(prefix):]: doc for path, doc in self.fs_client.documents.items()
+                if path.startswith(prefix)}
+
+    def test_pack_case_series(self):
+        covid_cases = {
+            '2020-05-04': {'popDeaths': 1},
+            '2020-04-30': {'popDeaths': 0, 'popTestedPositive': 7},
+            '2020-05-05': {},
+        }
+        series = data_ingest.pack_case_series(covid_cases)
+        self.assertEqual(series, {
+            'dates': ['2020-04-30', '2020-05-04', '2020-05-05'],
+            'popDeaths': [0, 1, None],
+            'popTestedPositive': [7, None, None],
+        })
+        self.assertEqual(data_ingest.unpack_case_series(series), covid_cases)
+
+    def test_incremental_updates(self):
+        facilities = {'1': {
+            '2020-04-29': {'popTestedPositive': 1},
+            '2020-04-30': {'popTestedPositive': 2, 'popDeaths': 0},
+            '2020-05-01': {'popTestedPositive': 3},
+        }}
+        data_ingest.save_case_data(facilities)
+        self.assertEqual(self.get_series('1'), {
+            '2020-04': {'dates': ['2020-04-29', '2020-04-30'],
+                        'popDeaths': [None, 0], 'popTestedPositive': [1, 2]},
+            '2020-05': {'dates': ['2020-05-01'], 'popTestedPositive': [3]},
+        })
+
+        # only the month with a new day is rewritten
+        facilities['1']['2020-05-02'] = {'popTestedPositive': 5}
+        april = self.get_series('1')['2020-04']
+        self.fs_client.documents['reference_facilities/1/covidCaseSeries/2020-04'] = 'untouched'
+        data_ingest.save_case_data(facilities)
+
+        series = self.get_series('1')
+        self.assertEqual(series['2020-04'], 'untouched')
+        self.assertEqual(series['2020-05'], {'dates': ['2020-05-01', '2020-05-02'],
+                                             'popTestedPositive': [3, 5]})
+        self.fs_client.documents['reference_facilities/1/covidCaseSeries/2020-04'] = april
+
+        # every facility is rebuilt once when the series format changes
+        with patch.object(data_ingest, 'CASE_SERIES_VERSION', 2):
+            self.fs_client.documents = {
+                path: doc for path, doc in self.fs_client.documents.items()
+                if '/covidCaseSeries/' not in path or path.endswith('2020-05')}
+            self.assertEqual(data_ingest.save_case_data(facilities), (0, 4))
+            self.assertEqual(self.get_series('1')['2020-04'], april)
+            self.assertEqual(len(self.fs_client.documents['covid_case_manifests/1']['hashes']), 4)
+
+            self.fs_client.commits = []
+            data_ingest.save_case_data(facilities)
+            self.assertEqual(self.fs_client.commits, [])
+
+    def test_streaming_matches_full_download(self):
+        rows = [{'facility_id': facility_id, 'date': f'2020-{month:02}-{day:02}',
+                 'pop_tested_positive': str(10 * month + day)}
+                for facility_id in ['1', '2', '3'] for month in [4, 5] for day in range(1, 29)]
+        # the rows of facility 2 aren't consecutive
+        rows.append(rows.pop(60))
+        blob = self.storage_client.get_bucket('bucket').blob('cases.jsonl')
+        blob.upload_from_string(''.join(json.dumps(row) + '\n' for row in rows))
+
+        data_ingest.ingest_daily_covid_case_data('bucket', 'cases.jsonl')
+        expected = {facility_id: self.get_series(facility_id) for facility_id in ['1', '2', '3']}
+        self.assertEqual(len(expected['2']['2020-04']['dates']), 28)
+        self.fs_client.documents = {}
+
+        saved_facility_ids = defaultdict(list)
+
+        def recording(name):
+            save = getattr(data_ingest, name)
+
+            def recording_save(updates):
+                saved_facility_ids[name].append(list(updates))
+                save(updates)
+            return patch.object(data_ingest, name, recording_save)
+
+        with patch.object(data_ingest, 'STREAM_CHUNK_BYTES', 1000), \
+                patch.object(data_ingest, 'STREAM_CHUNK_FACILITIES', 1), \
+                recording('save_case_series'), recording('save_case_manifests'):
+            data_ingest.ingest_daily_covid_case_data('bucket', 'cases.jsonl', streaming=True)
+
+        for facility_id in ['1', '2', '3']:
+            self.assertEqual(self.get_series(facility_id), expected[facility_id])
+        # saved a chunk at a time, including the second chunk of facility 2
+        self.assertEqual(saved_facility_ids['save_case_series'], [['1'], ['2'], ['3'], ['2']])
+        self.assertEqual(saved_facility_ids['save_case_manifests'], [['1'], ['2'], ['3'], ['2']])
+        self.assertEqual(len(self.fs_client.documents['covid_case_manifests/2']['hashes']), 56)
+
+
+class TestReferenceSnapshot(FakeFirestoreTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.bucket = LocalDirectoryBucket(directory.name)
+
+        self.fs_client.documents['reference_facilities/1'] = {
+            'canonicalName': 'Example Jail',
+            'population': [{'date': datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc),
+                            'value': 90}],
+        }
+        self.fs_client.documents['reference_facilities/2'] = {'canonicalName': 'Example Prison'}
+        data_ingest.save_case_data({'1': {
+            '2020-04-30': {'popTestedPositive': 7},
+            '2020-05-01': {'popTestedPositive': 8, 'popDeaths': 1},
+        }})
+
+    def read_snapshot(self, name):
+        return json.loads(gzip.decompress(self.bucket.get_blob(name).download_as_string()))
+
+    def test_export(self):
+        name = data_ingest.export_reference_snapshot(self.bucket)
+
+        self.assertRegex(name, r'^reference_facilities/v1/[0-9a-f]{16}\.json\.gz$')
+        self.assertEqual(json.loads(self.bucket.get_blob('reference_facilities/latest.json')
+                                    .download_as_string())['name'], name)
+        self.assertEqual(self.read_snapshot(name), {
+            'version': 1,
+            'facilities': {
+                '1': {
+                    'canonicalName': 'Example Jail',
+                    'population': [{'date': '2019-01-01T00:00:00+00:00', 'value': 90}],
+                    # both months in one series
+                    'covidCases': {'dates': ['2020-04-30', '2020-05-01'],
+                                   'popDeaths': [None, 1], 'popTestedPositive': [7, 8]},
+                },
+                '2': {'canonicalName': 'Example Prison', 'covidCases': {'dates': []}},
+            },
+        })
+
+    def test_named_by_contents(self):
+        name = data_ingest.export_reference_snapshot(self.bucket)
+        with patch('testing_fakes.LocalFileBlob.upload_from_string') as upload:
+            self.assertEqual(data_ingest.export_reference_snapshot(self.bucket), name)
+        # only latest.json is rewritten
+        self.assertEqual(upload.call_count, 1)
+
+        data_ingest.save_case_data({'1': {'2020-05-02': {'popTestedPositive': 9}}})
+        new_name = data_ingest.export_reference_snapshot(self.bucket)
+        self.assertNotEqual(new_name, name)
+        self.assertEqual(self.read_snapshot(new_name)['facilities']['1']['covidCases']['dates'],
+                         ['2020-04-30', '2020-05-01', '2020-05-02'])
+        # earlier snapshots stay readable by clients that have cached their name
+        self.assertIsNotNone(self.bucket.get_blob(name))
+
+    def test_merges_case_series_in_order_of_facility_id(self):
+        data_ingest.save_case_data({'10': {'2020-04-01': {'popTestedPositive': 3}}})
+        # series docs of a facility without metadata are left out
+        self.fs_client.documents['reference_facilities/15/covidCaseSeries/2020-04'] = \
+            self.fs_client.documents['reference_facilities/10/covidCaseSeries/2020-04']
+
+        name = data_ingest.export_reference_snapshot(self.bucket)
+        snapshot = self.read_snapshot(name)
+        self.assertEqual(list(snapshot['facilities']), ['1', '10', '2'])
+        self.assertEqual(
+            {facility_id: facility['covidCases']['dates']
+             for facility_id, facility in snapshot['facilities'].items()},
+            {'1': ['2020-04-30', '2020-05-01'], '10': ['2020-04-01'], '2': []})
+        # the same as serializing the whole snapshot at once
+        contents = json.dumps(snapshot, sort_keys=True, separators=(',', ':')).encode()
+        self.assertIn(hashlib.sha256(contents).hexdigest()[:16], name)
+
+    def test_exported_after_ingest(self):
+        self.storage_client.get_bucket('bucket').blob('facilities.jsonl').upload_from_string(
+            json.dumps({'facility_id': '3', 'facility_name': 'New Jail', 'state': 'Alabama',
+                        'facility_type': 'County Jails'}) + '\n')
+        data_ingest.ingest_facility_metadata_file('bucket', 'facilities.jsonl')
+
+        snapshots = self.storage_client.get_bucket(data_ingest.SNAPSHOT_BUCKET_NAME)
+        latest = json.loads(snapshots.get_blob('reference_facilities/latest.json')
+                            .download_as_string())
+        blob = snapshots.get_blob(latest['name'])
+        self.assertEqual(blob.content_encoding, 'gzip')
+        self.assertEqual(set(json.loads(gzip.decompress(blob.download_as_string()))['facilities']),
+                         {'1', '2', '3'})
+
+    def test_export_failure_does_not_fail_ingest(self):
+        self.storage_client.get_bucket('bucket').blob('facilities.jsonl').upload_from_string(
+            json.dumps({'facility_id': '3', 'facility_name': 'New Jail', 'state': 'Alabama',
+                        'facility_type': 'County Jails'}) + '\n')
+        get_bucket = self.storage_client.get_bucket
+
+        def get_bucket_without_snapshots(bucket_name):
+            if bucket_name == data_ingest.SNAPSHOT_BUCKET_NAME:
+                raise data_ingest.api_exceptions.NotFound('no such bucket')
+            return get_bucket(bucket_name)
+
+        with patch.object(self.storage_client, 'get_bucket', get_bucket_without_snapshots), \
+                patch.object(data_ingest, 'log') as log:
+            data_ingest.ingest_facility_metadata_file('bucket', 'facilities.jsonl')
+
+        self.assertEqual(self.fs_client.documents['reference_facilities/3']['canonicalName'],
+                         'New Jail')
+        self.assertIn('no such bucket', log.error.call_args[0][0])
+        self.assertFalse(get_logged_metrics(log)[0]['snapshotExported'])
+
+
+class TestColumnarIngest(FakeFirestoreTestCase):
+    case_rows = [
+        {'facility_id': '510', 'date': '2020-04-30', 'pop_deaths': '0',
+         'pop_tested_positive': '7', 'staff_tested_positive': '0'},
+        {'facility_id': '510', 'date': '2020-05-04', 'pop_deaths': '1',
+         'pop_tested_positive': '8', 'staff_deaths': '0'},
+        {'facility_id': '516', 'date': '2020-04-07', 'pop_tested': '120',
+         'pop_tested_negative': '118', 'pop_tested_positive': '2'},
+        {'facility_id': '516', 'date': '2020-04-08'},
+    ]
+    metadata_rows = [
+        {'facility_id': '1', 'facility_name': 'Example Jail', 'state': 'Alabama',
+         'facility_type': 'County Jails', 'capacity': '100', 'county': 'Jefferson County',
+         'population_year_updated': '2019', 'population': '90'},
+        {'facility_id': '2', 'facility_name': 'Example Prison', 'state': 'Alaska',
+         'facility_type': 'State Prisons', 'capacity': '', 'county': 'Not found',
+         'population_year_updated': '', 'population': '50'},
+        {'facility_id': '3', 'facility_name': 'Example Center', 'state': 'Arizona',
+         'facility_type': 'Other', 'capacity': '0', 'county': 'Maricopa',
+         'population_year_updated': '2020', 'population': '75'},
+    ]
+
+    def write_csv_file(self, rows):
+        fd, file_location = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        pd.DataFrame(rows).to_csv(file_location, index=False)
+        self.addCleanup(os.remove, file_location)
+        return file_location
+
+    def write_parquet_file(self, rows):
+        fd, file_location = tempfile.mkstemp(suffix='.parquet')
+        os.close(fd)
+        pd.DataFrame(rows).to_parquet(file_location)
+        self.addCleanup(os.remove, file_location)
+        return file_location
+
+    def assert_case_data_matches(self, file_location):
+        expected = data_ingest.reshape_facilities_data(self.write_json_lines_file(self.case_rows))
+        self.assertEqual(
+            data_ingest.reshape_case_data_table(data_ingest.read_table(file_location)), expected)
+
+    def assert_metadata_matches(self, file_location):
+        expected = [data_ingest.build_facility_update(row) for row in self.metadata_rows]
+        self.assertEqual(
+            data_ingest.build_facility_updates_from_table(data_ingest.read_table(file_location)),
+            expected)
+
+    def test_json_lines(self):
+        self.assert_case_data_matches(self.write_json_lines_file(self.case_rows))
+        self.assert_metadata_matches(self.write_json_lines_file(self.metadata_rows))
+
+    def test_csv(self):
+        self.assert_case_data_matches(self.write_csv_file(self.case_rows))
+        self.assert_metadata_matches(self.write_csv_file(self.metadata_rows))
+
+    @skipUnless(pyarrow, 'requires pyarrow')
+    def test_parquet(self):
+        self.assert_case_data_matches(self.write_parquet_file(self.case_rows))
+        self.assert_metadata_matches(self.write_parquet_file(self.metadata_rows))
+
+    def test_ingest_csv(self):
+        file_location = self.write_csv_file(self.metadata_rows)
+        with patch.object(data_ingest, 'download_from_cloud_storage', return_value=file_location):
+            data_ingest.ingest_facility_metadata_file('bucket', 'facilities.csv')
+
+        self.assertEqual(self.fs_client.documents['reference_facilities/1']['county'], 'Jefferson')
+        self.assertEqual(self.fs_client.documents['reference_facilities/3']['facilityType'], 'Other')
+
+
+class TestIngestMetrics(FakeFirestoreTestCase):
+    def test_case_data_metrics(self):
+        rows = [{'facility_id': facility_id, 'date': f'2020-04-{day:02}',
+                 'pop_tested_positive': str(day)}
+                for facility_id in ['1', '2'] for day in range(1, 21)]
+        blob = self.storage_client.get_bucket('bucket').blob('cases.jsonl')
+        blob.upload_from_string(''.join(json.dumps(row) + '\n' for row in rows))
+
+        with patch.object(data_ingest, 'log') as log:
+            data_ingest.ingest_daily_covid_case_data('bucket', 'cases.jsonl')
+            data_ingest.ingest_daily_covid_case_data('bucket', 'cases.jsonl', streaming=True)
+
+        for metrics in get_logged_metrics(log):
+            self.assertEqual(metrics['function'], 'ingest_daily_covid_case_data')
+            self.assertEqual(metrics['file'], 'bucket/cases.jsonl')
+            self.assertEqual(metrics['status'], 'ok')
+            self.assertEqual(metrics['rowsParsed'], 40)
+            for name in ['download', 'parse', 'read_existing', 'save_case_data',
+                         'compute_rt', 'save_rt_data', 'save_manifests']:
+                self.assertIn(name, metrics['phasesMs'])
+
+        full, streamed = get_logged_metrics(log)
+        self.assertEqual((full['daysWritten'], full['daysSkipped']), (40, 0))
+        self.assertEqual((full['rtDaysWritten'], full['rtDaysSkipped']), (38, 0))
+        self.assertGreater(full['batchesCommitted'], 0)
+        self.assertIn('commit', full['phasesMs'])
+        # nothing changed, so nothing is written the second time
+        self.assertEqual((streamed['daysWritten'], streamed['daysSkipped']), (0, 40))
+        self.assertEqual((streamed['rtDaysWritten'], streamed['rtDaysSkipped']), (0, 38))
+        self.assertEqual(streamed['batchesCommitted'], 0)
+        self.assertEqual(streamed['streaming'], True)
+
+    def test_failures_are_recorded(self):
+        self.storage_client.get_bucket('bucket').blob('facilities.jsonl').upload_from_string(
+            '{"facility_id": "1"}\n')
+
+        with patch.object(data_ingest, 'log') as log:
+            with self.assertRaises(KeyError):
+                data_ingest.ingest_facility_metadata_file('bucket', 'facilities.jsonl')
+
+        [metrics] = get_logged_metrics(log)
+        self.assertEqual(metrics['function'], 'ingest_facility_metadata_file')
+        self.assertEqual(metrics['status'], 'error')
+        self.assertEqual(metrics['rowsParsed'], 1)
+
+
+class TestIngestBenchmark(TestCase):
+    def test_run_benchmarks(self):
+        results = bench_ingest.run_benchmarks(3, 10, trace_memory=False)
+
+        self.assertEqual(results['cases']['rows'], 30)
+        # 30 case docs, 3 facility docs, 27 R(t) docs, 3 series docs and 3
+        # manifests, written once for case data and once for R(t)
+        self.assertEqual(results['cases']['docsWritten'], 69)
+        self.assertEqual(results['cases (streaming)']['docsWritten'], 69)
+        self.assertEqual(results['cases (asyncio)']['docsWritten'], 69)
+        self.assertEqual(results['cases (columnar csv)']['docsWritten'], 69)
+        self.assertEqual(results['cases (unchanged)']['docsWritten'], 0)
+        self.assertEqual(results['metadata (unchanged)']['docsWritten'], 0)
+
+
+class TestRtBenchmark(TestCase):
+    def test_run_benchmarks(self):
+        results = bench_rt.run_benchmarks(series_lengths=[7], batch_sizes=[2], repeats=1)
+        self.assertEqual(set(results), {
+            'compute_r_t/7d', 'prepare_cases/7d', 'get_posteriors/7d',
+            'highest_density_interval/7d', 'smoothing/7d', 'compute_r_t_batch/2x120d'})
+        for result in results.values():
+            self.assertLessEqual(result['p50'], result['p99'])
+
+    def test_compare_to_baseline(self):
+        baseline = {
+            'fast': {'p50': .5, 'peakMemoryMB': .1},
+            'slow': {'p50': 100, 'peakMemoryMB': 10},
+            'same': {'p50': 100, 'peakMemoryMB': 10},
+            'bigger': {'p50': 100, 'peakMemoryMB': 10},
+        }
+        results = {
+            'fast': {'p50': 1, 'peakMemoryMB': .5},
+            'slow': {'p50': 130, 'peakMemoryMB': 10},
+            'same': {'p50': 110, 'peakMemoryMB': 10.5},
+            'bigger': {'p50': 100, 'peakMemoryMB': 12},
+            'new': {'p50': 1000, 'peakMemoryMB': 100},
+        }
+
+        regressions = bench_rt.compare_to_baseline(results, baseline, threshold=.25)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith('slow: median'))
+        self.assertTrue(regressions[1].startswith('bigger: peak memory'))
+
+
+class TestServer(TestCase):
+    CASE_COUNTS = bench_rt.generate_case_counts(30)
+
+    def test_calculate_rt(self):
+        client = server.create_app().test_client()
+
+        response = client.post('/calculate_rt', json=self.CASE_COUNTS)
+        self.assertEqual(response.status_code, 200)
+        (expected_body, _, _) = calculate_rt(Mock(get_json=Mock(return_value=self.CASE_COUNTS)))
+        self.assertEqual(json.loads(response.data), json.loads(expected_body))
+        self.assertIn('dispatch;dur=', response.headers['Server-Timing'])
+
+        response = client.post('/calculate_rt', json={'dates': ['2020-04-01']})
+        self.assertEqual(response.status_code, 500)
+
+        response = client.options('/calculate_rt')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response.headers['Access-Control-Allow-Origin'], '*')
+
+    def test_ingest(self):
+        client = server.create_app().test_client()
+
+        with patch.object(main, 'ingest_covid_case_data') as ingest:
+            response = client.post('/ingest_covid_case_data', json={'bucket': 'b', 'name': 'cases.jsonl'})
+            self.assertEqual(response.status_code, 204)
+            ingest.assert_called_once_with({'bucket': 'b', 'name': 'cases.jsonl'}, None)
+
+            response = client.post('/ingest_covid_case_data', json={'bucket': 'b'})
+            self.assertEqual(response.status_code, 400)
+
+            ingest.side_effect = ValueError('bad file')
+            response = client.post('/ingest_covid_case_data', json={'bucket': 'b', 'name': 'x'})
+            self.assertEqual(response.status_code, 500)
+            self.assertEqual(json.loads(response.data), {'error': 'bad file'})
+
+    def test_load_test_on_worker_pool(self):
+        bodies = bench_server.generate_bodies(6, 2, 30)
+        self.assertEqual(bodies[0], bodies[2])
+
+        with bench_server.local_server(1) as url:
+            results = bench_server.run_load_test(url, bodies, concurrency=3)
+
+        self.assertEqual((results['requests'], results['errors']), (6, 0))
+        self.assertLessEqual(results['p50'], results['p99'])
+
+
+class TestImportTime(TestCase):
+    """
+        Cold start cost of each entry point: the time to import its module in
+        a fresh interpreter, and which heavy dependencies that pulls in.
+    """
+    # generous, so that it holds on slow machines too
+    COLD_START_BUDGET_SECONDS = 5
+
+    def profile_import(self, statements):
+        script = '\n'.join([
+            'import json, sys, time',
+            'start = time.perf_counter()',
+            *statements,
+            'seconds = time.perf_counter() - start',
+            'print(json.dumps({"seconds": seconds, "modules": list(sys.modules)}))',
+        ])
+        output = subprocess.run([sys.executable, '-c', script], check=True,
+                                stdout=subprocess.PIPE,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        profile = json.loads(output)
+        self.assertLess(profile['seconds'], self.COLD_START_BUDGET_SECONDS)
+        return profile
+
+    def test_calculate_rt(self):
+        profile = self.profile_import(['from main import calculate_rt'])
+        for module in ['data_ingest', 'google.cloud.firestore', 'google.cloud.storage', 'scipy']:
+            self.assertNotIn(module, profile['modules'])
+
+    def test_ingest(self):
+        profile = self.profile_import([
+            'from main import ingest_covid_case_data',
+            'import data_ingest',
+            # clients are only created once they're needed
+            'assert data_ingest.get_firestore_client.cache_info().currsize == 0',
+            'assert data_ingest.get_storage_client.cache_info().currsize == 0',
+        ])
+        self.assertIn('google.cloud.firestore', profile['modules'])
+        self.assertNotIn('scipy', profile['modules'])
@@ -0,0 +1,268 @@
+"""
+    In-memory stand-ins for the Google Cloud clients used by the ingest
+    functions, so they can be exercised without credentials or an emulator.
+    Only the parts of the client APIs that this package uses are implemented.
+"""
+import copy
+from datetime import datetime, timezone
+from google.cloud.firestore import SERVER_TIMESTAMP
+import json
+import os
+import threading
+import time
+
+
+def merge_fields(document, updates):
+    # like Firestore, merging into a map field only replaces the given keys,
+    # but merging an empty map replaces the whole field with it
+    for key, value in updates.items():
+        if isinstance(value, dict) and value and isinstance(document.get(key), dict):
+            merge_fields(document[key], value)
+        else:
+            document[key] = value
+
+
+class FakeDocumentSnapshot():
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+class FakeDocumentReference():
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = path.split('/')[-1]
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def collection(self, collection_id):
+        return FakeCollectionReference(self._client, f'{self.path}/{collection_id}')
+
+    def get(self):
+        self._client.reads += 1
+        return FakeDocumentSnapshot(self, copy.deepcopy(self._client.documents.get(self.path)))
+
+    def set(self, document_data, merge=False):
+        self._client._write(self.path, document_data, merge)
+
+
+class FakeCollectionReference():
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = path.split('/')[-1]
+
+    def document(self, document_id):
+        return FakeDocumentReference(self._client, f'{self.path}/{document_id}')
+
+    def stream(self):
+        # one round trip for the whole query
+        self._client.reads += 1
+        prefix = f'{self.path}/'
+        for path in sorted(self._client.documents):
+            if path.startswith(prefix) and '/' not in path[len(prefix):]:
+                yield FakeDocumentSnapshot(FakeDocumentReference(self._client, path),
+                                           copy.deepcopy(self._client.documents[path]))
+
+
+class FakeCollectionGroup():
+    def __init__(self, client, collection_id):
+        self._client = client
+        self.collection_id = collection_id
+
+    def stream(self):
+        # one round trip for the whole query
+        self._client.reads += 1
+        for path in sorted(self._client.documents):
+            if path.split('/')[-2] == self.collection_id:
+                yield FakeDocumentSnapshot(FakeDocumentReference(self._client, path),
+                                           copy.deepcopy(self._client.documents[path]))
+
+
+class FakeWriteBatch():
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append((reference.path, copy.deepcopy(document_data), merge))
+
+    def commit(self):
+        time.sleep(self._client.latency)
+        # batches may be committed from several threads at once
+        with self._client.lock:
+            for path, document_data, merge in self._writes:
+                self._client._write(path, document_data, merge)
+                self._client.bytes_written += len(json.dumps(document_data, default=str))
+            self._client.commits.append(len(self._writes))
+        self._writes = []
+
+
+class FakeFirestoreClient():
+    """
+        Stores documents in a dict keyed by their full path, e.g.
+        `reference_facilities/510/covidCases/2020-04-30`. Counts read round
+        trips, the size of each batch commit and (roughly, as JSON) the bytes
+        committed, so tests and benchmarks can make assertions about them.
+        Commits and get_all calls can be given a `latency` in seconds.
+    """
+    def __init__(self, *args, latency=0, **kwargs):
+        self.latency = latency
+        self.documents = {}
+        self.reads = 0
+        self.commits = []
+        self.bytes_written = 0
+        self.lock = threading.RLock()
+        # source of the times stored for SERVER_TIMESTAMP
+        self.clock = lambda: datetime.now(timezone.utc)
+
+    def _write(self, path, document_data, merge):
+        # like Firestore, store the commit time in place of SERVER_TIMESTAMP
+        document_data = {key: self.clock() if value is SERVER_TIMESTAMP else value
+                         for key, value in document_data.items()}
+        if merge and path in self.documents:
+            merge_fields(self.documents[path], copy.deepcopy(document_data))
+        else:
+            self.documents[path] = copy.deepcopy(document_data)
+
+    def collection(self, collection_id):
+        return FakeCollectionReference(self, collection_id)
+
+    def collection_group(self, collection_id):
+        return FakeCollectionGroup(self, collection_id)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def get_all(self, references):
+        self.reads += 1
+        time.sleep(self.latency)
+        for reference in references:
+            yield FakeDocumentSnapshot(
+                reference, copy.deepcopy(self.documents.get(reference.path)))
+
+
+class FakeBlob():
+    def __init__(self, name, data=b'', latency=0):
+        self.name = name
+        self._data = data
+        self.latency = latency
+        self.range_reads = 0
+        self.bytes_read = 0
+
+    @property
+    def size(self):
+        return len(self._data)
+
+    def download_as_string(self, start=None, end=None):
+        # like the real client, `end` is inclusive
+        self.range_reads += 1
+        time.sleep(self.latency)
+        start = 0 if start is None else start
+        end = len(self._data) - 1 if end is None else end
+        self.bytes_read += len(self._data[start:end + 1])
+        return self._data[start:end + 1]
+
+    def download_to_filename(self, filename):
+        self.bytes_read += len(self._data)
+        with open(filename, 'wb') as f:
+            f.write(self._data)
+
+    def upload_from_string(self, data, content_type=None):
+        self._data = data.encode() if isinstance(data, str) else data
+        self.content_type = content_type
+
+    def upload_from_file(self, file_obj, rewind=False, content_type=None):
+        if rewind:
+            file_obj.seek(0)
+        self.upload_from_string(file_obj.read(), content_type)
+
+
+class FakeBucket():
+    def __init__(self, name, latency=0):
+        self.name = name
+        self.latency = latency
+        self.blobs = {}
+
+    def blob(self, blob_name):
+        return self.blobs.setdefault(blob_name, FakeBlob(blob_name, latency=self.latency))
+
+    def get_blob(self, blob_name):
+        return self.blobs.get(blob_name)
+
+
+class FakeStorageClient():
+    """
+        Buckets and blobs held in memory; buckets are created on first use.
+        Ranged reads can be given a `latency` in seconds.
+    """
+    def __init__(self, *args, latency=0, **kwargs):
+        self.latency = latency
+        self.buckets = {}
+
+    def get_bucket(self, bucket_name):
+        return self.buckets.setdefault(bucket_name, FakeBucket(bucket_name, self.latency))
+
+
+class LocalFileBlob():
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.directory, name)
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def download_as_string(self, start=None, end=None):
+        # like the real client, `end` is inclusive
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        start = 0 if start is None else start
+        end = len(data) - 1 if end is None else end
+        return data[start:end + 1]
+
+    def download_to_filename(self, filename):
+        with open(self.path, 'rb') as src, open(filename, 'wb') as dst:
+            dst.write(src.read())
+
+    def upload_from_string(self, data, content_type=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'wb') as f:
+            f.write(data.encode() if isinstance(data, str) else data)
+        self.content_type = content_type
+
+    def upload_from_file(self, file_obj, rewind=False, content_type=None):
+        if rewind:
+            file_obj.seek(0)
+        self.upload_from_string(file_obj.read(), content_type)
+
+
+class LocalDirectoryBucket():
+    """
+        A bucket backed by a local directory, with blob names as paths under
+        it, so exported files can be inspected on disk.
+    """
+    def __init__(self, directory, name='local'):
+        self.directory = directory
+        self.name = name
+
+    def blob(self, blob_name):
+        return LocalFileBlob(self, blob_name)
+
+    def get_blob(self, blob_name):
+        blob = LocalFileBlob(self, blob_name)
+        return blob if os.path.isfile(blob.path) else None
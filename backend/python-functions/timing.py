@@ -0,0 +1,137 @@
+"""
+    Per-invocation timing of named phases, plus counters such as the length
+    of a series or the number of rows parsed.
+
+    A PhaseTimer is made current for the duration of an invocation; code
+    further down the call stack reports to it through the module-level
+    `phase`, `timed`, `record` and `add` helpers, which do nothing when no
+    timer is current. Phases may nest, in which case the inner phase's time
+    is also counted in the outer one's.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import contextvars
+import functools
+import json
+import time
+
+current_timer = contextvars.ContextVar('current_timer', default=None)
+
+# whether this instance has served an invocation yet
+_cold_start = True
+
+
+def take_cold_start():
+    """ True for the first invocation served by this instance, then False """
+    global _cold_start
+    cold_start, _cold_start = _cold_start, False
+    return cold_start
+
+
+class PhaseTimer():
+    def __init__(self):
+        self.start = time.perf_counter()
+        # phase name => total seconds, in the order phases first started
+        self.phases = OrderedDict()
+        self.metrics = OrderedDict()
+        self._active = set()
+
+    @contextmanager
+    def phase(self, name):
+        # a phase that is re-entered, e.g. by recursion, is only timed once
+        if name in self._active:
+            yield
+            return
+
+        self._active.add(name)
+        self.phases.setdefault(name, 0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+            self._active.discard(name)
+
+    def record(self, **metrics):
+        self.metrics.update(metrics)
+
+    def add(self, name, amount=1):
+        self.metrics[name] = self.metrics.get(name, 0) + amount
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        """ Value of a Server-Timing header listing each phase and the total, in ms """
+        phases = list(self.phases.items()) + [('total', self.elapsed())]
+        return ', '.join(f'{name};dur={1000 * seconds:.1f}' for name, seconds in phases)
+
+    def to_dict(self):
+        return {
+            'totalMs': round(1000 * self.elapsed(), 1),
+            'phasesMs': {name: round(1000 * seconds, 1) for name, seconds in self.phases.items()},
+            **self.metrics,
+        }
+
+
+@contextmanager
+def activate(timer):
+    token = current_timer.set(timer)
+    try:
+        yield timer
+    finally:
+        current_timer.reset(token)
+
+
+@contextmanager
+def invocation(name, logger, invocation_id=None):
+    """
+    Times the body with a new current PhaseTimer, then logs one structured
+    record of its phases and metrics, along with whether the instance was
+    cold and whether the body raised.
+    """
+    timer = PhaseTimer()
+    timer.record(function=name, invocationId=invocation_id, coldStart=take_cold_start())
+    status = 'error'
+    try:
+        with activate(timer):
+            yield timer
+        status = 'ok'
+    finally:
+        # the body may have recorded a handled failure itself
+        timer.metrics.setdefault('status', status)
+        logger.info("Invocation metrics: %s", json.dumps(timer.to_dict(), default=str))
+
+
+@contextmanager
+def phase(name):
+    timer = current_timer.get()
+    if timer is None:
+        yield
+        return
+
+    with timer.phase(name):
+        yield
+
+
+def timed(name):
+    """ Decorator that counts each call of a function towards phase `name` """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            with phase(name):
+                return f(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+def record(**metrics):
+    timer = current_timer.get()
+    if timer is not None:
+        timer.record(**metrics)
+
+
+def add(name, amount=1):
+    timer = current_timer.get()
+    if timer is not None:
+        timer.add(name, amount)